@@ -1,21 +1,30 @@
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import streamlit_authenticator as stauth
 import json
 import pandas as pd
 import numpy as np
-import io
+import time
 import pytz
-from config import get_openai_api_key, is_production, load_config, get_line_channel_access_token
-from parser_infomart import parse_infomart
-from parser_iporter import parse_iporter
-from parser_mitsubishi import parse_mitsubishi
+from config import get_openai_api_key, is_production, load_config, get_line_channel_access_token, get_llm_max_concurrency
+from config import get_text_pack_size, get_text_pack_max_chars, get_llm_worker_mode, get_eager_parse_default
+from config import get_ingest_process_workers
+from format_detect import parse_upload
+from order_filter import OrderFilter, split_terms
 from parser_pdf import parse_pdf_handwritten
+from pdf_document import PdfDocument
+from parser_line import parse_line_order_with_openai
+from parser_text import plan_text_order_requests, parse_text_order_group
+from batch_runner import run_concurrently, run_parallel
+from llm_worker import (enqueue_line_order, enqueue_text_order, enqueue_pdf, ensure_worker_running,
+                        remove_pdf_job_file, PRIORITY_INTERACTIVE, PRIORITY_EAGER)
+import llm_cache
+import openai_client
 from prompt_line import get_line_order_prompt
+from prompt_pdf import PDF_ORDER_SYSTEM_PROMPT
 from prompt_text import get_text_order_prompt
 from docx import Document
-import pdfplumber
 from PIL import Image
-import base64
 import os
 from datetime import datetime, timezone, timedelta
 import requests
@@ -23,7 +32,18 @@ import sqlite3
 from pathlib import Path
 import tempfile
 import filelock
-from db import init_db, save_order_lines, list_batches, load_batch, get_batch_stats, DB_PATH, _conn
+from db import init_db, save_order_lines, list_batches, load_batch, get_batch_stats, DB_PATH
+from db import delete_order_lines, delete_batch, delete_all_order_lines, get_org_summary
+from db import count_history, list_history_page, list_history_batches, list_history_partners, history_ids
+from db import search_history_page, get_data_version
+from history_export import export_history, FORMATS as EXPORT_FORMATS
+from excel_export import frame_digest, order_workbook, org_summary_workbook, recent_builds, cache_info
+from db import (insert_line_order, mark_line_order_parsed, mark_line_orders_parsed, list_line_orders,
+                delete_line_orders_by_timestamp, delete_processed_line_order_rows, import_line_orders_json)
+from db import (insert_text_order, mark_text_orders_parsed, list_text_orders,
+                delete_text_orders_by_timestamp, delete_processed_text_order_rows, import_text_orders_json)
+from db import get_jobs, claim_job_results, list_jobs, job_counts, active_job_refs, requeue_job, delete_job
+from db import unprocessed_order_counts, get_account_setting, set_account_setting
 
 # ========= Product Taxonomy (分類 + ソート) =========
 from dataclasses import dataclass
@@ -204,11 +224,34 @@ LINE_ORDERS_DIR = str(DATA_DIR / "line_orders")
 if not os.path.exists(LINE_ORDERS_DIR):
     os.makedirs(LINE_ORDERS_DIR, exist_ok=True)
 
+# 旧形式（orders.json）のLINE注文キューをSQLiteへ一度だけ移行
+try:
+    _migrated = import_line_orders_json(os.path.join(LINE_ORDERS_DIR, "orders.json"))
+    if _migrated:
+        print(f"LINE注文キューをSQLiteへ移行しました: {_migrated}件")
+except Exception as e:
+    print(f"LINE注文キュー移行エラー: {e}")
+
 # テキスト注文データ管理用のディレクトリ
 TEXT_ORDERS_DIR = str(DATA_DIR / "text_orders")
 if not os.path.exists(TEXT_ORDERS_DIR):
     os.makedirs(TEXT_ORDERS_DIR, exist_ok=True)
 
+# 旧形式（orders.json）のテキスト注文キューをSQLiteへ一度だけ移行
+try:
+    _migrated = import_text_orders_json(os.path.join(TEXT_ORDERS_DIR, "orders.json"))
+    if _migrated:
+        print(f"テキスト注文キューをSQLiteへ移行しました: {_migrated}件")
+except Exception as e:
+    print(f"テキスト注文キュー移行エラー: {e}")
+
+# LLM解析をワーカープロセスへ任せるか（LLM_WORKER_MODE=off で従来どおり画面内で解析）
+USE_LLM_WORKER = get_llm_worker_mode() != "off"
+
+# アップロードしたCSV/XLSXの合計がこれ未満なら、プロセスを起動せずスレッドで解析
+# （forkserver のワーカー起動に毎回2秒以上かかり、約30MB未満の解析ではそのほうが遅いため）
+INGEST_PROCESS_MIN_BYTES = 32 * 1024 * 1024
+
 # --- 認証情報ファイル管理（統一されたDATA_DIRを使用） ---
 CRED_PATH = DATA_DIR / "credentials.yml"
 LOCK_PATH = CRED_PATH.with_suffix(".lock")
@@ -318,18 +361,16 @@ def save_line_order_data(line_account, sender_name, image_data, message_text="")
         with open(image_path, "wb") as f:
             f.write(image_data)
         
-        # 注文データをJSONファイルに保存（ファイルロック付き）
-        orders_file = os.path.join(LINE_ORDERS_DIR, "orders.json")
-        with get_file_lock(orders_file):
-            orders = []
-            if os.path.exists(orders_file):
-                with open(orders_file, "r", encoding="utf-8") as f:
-                    orders = json.load(f)
-            
-            orders.append(order_data)
-            
-            with open(orders_file, "w", encoding="utf-8") as f:
-                json.dump(orders, f, ensure_ascii=False, indent=4)
+        # 注文データをキュー（SQLite）に1行追加
+        insert_line_order(order_data)
+        
+        # 自動解析が有効なアカウントは受信と同時に解析ジョブを登録
+        if is_eager_parse_enabled(line_account):
+            try:
+                enqueue_line_order(order_data, line_account, PRIORITY_EAGER)
+                ensure_worker_running()
+            except Exception as e:
+                print(f"自動解析の登録エラー: {e}")
         
         return True, "LINE注文データを保存しました。"
     except Exception as e:
@@ -340,36 +381,9 @@ def save_parsed_line_order_data(timestamp, parsed_data):
     LINE注文の解析結果を保存
     """
     try:
-        orders_file = os.path.join(LINE_ORDERS_DIR, "orders.json")
-        if not os.path.exists(orders_file):
-            return False, "注文データファイルが見つかりません"
-        
-        with get_file_lock(orders_file):
-            with open(orders_file, "r", encoding="utf-8") as f:
-                orders = json.load(f)
-            
-            updated = False
-            
-            # ① まず"未処理"の同timestampを優先して更新
-            for order in orders:
-                if order.get('timestamp') == timestamp and not order.get('processed', False):
-                    order['parsed_data'] = parsed_data
-                    order['processed'] = True
-                    updated = True
-                    break
-            
-            # ② 念のためフォールバック（既に処理済みばかりでも1件は更新）
-            if not updated:
-                for order in orders:
-                    if order.get('timestamp') == timestamp:
-                        order['parsed_data'] = parsed_data
-                        order['processed'] = True
-                        updated = True
-                        break
-            
-            with open(orders_file, "w", encoding="utf-8") as f:
-                json.dump(orders, f, ensure_ascii=False, indent=4)
-        
+        # 未処理の同timestampを優先して1行だけ更新（なければ処理済みを上書き）
+        if not mark_line_order_parsed(timestamp, parsed_data):
+            return False, "注文データが見つかりません"
         return True, "解析結果を保存しました"
     except Exception as e:
         return False, f"解析結果保存エラー: {e}"
@@ -379,25 +393,9 @@ def get_line_orders_for_user(email):
     ユーザーに関連するLINE注文データを取得
     """
     try:
-        orders_file = os.path.join(LINE_ORDERS_DIR, "orders.json")
-        if not os.path.exists(orders_file):
-            print(f"❌ orders.jsonファイルが存在しません: {orders_file}")
-            return []
-        
-        with open(orders_file, "r", encoding="utf-8") as f:
-            all_orders = json.load(f)
-        
-        print(f"📊 全注文データ数: {len(all_orders)}")
-        print(f"👤 ユーザー: {email}")
-        
         # ユーザー名で直接フィルタ（手動アップロード用）
-        user_orders = [order for order in all_orders if order.get("line_account") == email]
-        print(f"🔍 ユーザー名でフィルタ: {len(user_orders)}件")
-        
-        # デバッグ: 全注文データの詳細を表示
-        for i, order in enumerate(all_orders):
-            print(f"📋 注文{i+1}: line_account={order.get('line_account')}, sender_name={order.get('sender_name')}")
-        
+        user_orders = list_line_orders(email)
+        print(f"👤 ユーザー: {email} / LINE注文: {len(user_orders)}件")
         return user_orders
     except Exception as e:
         print(f"LINE注文データ取得エラー: {e}")
@@ -408,50 +406,29 @@ def get_all_line_orders():
     すべてのLINE注文データを取得（管理者用）
     """
     try:
-        orders_file = os.path.join(LINE_ORDERS_DIR, "orders.json")
-        if not os.path.exists(orders_file):
-            return []
-        
-        with open(orders_file, "r", encoding="utf-8") as f:
-            all_orders = json.load(f)
-        
-        return all_orders
+        return list_line_orders()
     except Exception as e:
         print(f"全LINE注文データ取得エラー: {e}")
         return []
 
-
+def _remove_line_images(image_filenames):
+    """削除したLINE注文の画像ファイルを削除"""
+    for image_filename in image_filenames:
+        if not image_filename:
+            continue
+        image_path = os.path.join(LINE_ORDERS_DIR, image_filename)
+        if os.path.exists(image_path):
+            os.remove(image_path)
 
 def delete_processed_line_orders():
     """
     処理済みのLINE注文データを削除
     """
     try:
-        orders_file = os.path.join(LINE_ORDERS_DIR, "orders.json")
-        if not os.path.exists(orders_file):
-            return True, "削除対象のデータがありません"
-        
-        with get_file_lock(orders_file):
-            with open(orders_file, "r", encoding="utf-8") as f:
-                all_orders = json.load(f)
-            
-            # 処理済みの注文を削除
-            original_count = len(all_orders)
-            remaining_orders = [order for order in all_orders if not order.get("processed", False)]
-            deleted_count = original_count - len(remaining_orders)
-            
-            # 削除された注文の画像ファイルも削除
-            deleted_orders = [order for order in all_orders if order.get("processed", False)]
-            for order in deleted_orders:
-                image_path = os.path.join(LINE_ORDERS_DIR, order['image_filename'])
-                if os.path.exists(image_path):
-                    os.remove(image_path)
-            
-            # 残りの注文データを保存
-            with open(orders_file, "w", encoding="utf-8") as f:
-                json.dump(remaining_orders, f, ensure_ascii=False, indent=4)
-        
-        return True, f"{deleted_count}件の処理済みデータを削除しました"
+        deleted_files = delete_processed_line_order_rows()
+        # 削除された注文の画像ファイルも削除
+        _remove_line_images(deleted_files)
+        return True, f"{len(deleted_files)}件の処理済みデータを削除しました"
     except Exception as e:
         return False, f"削除エラー: {e}"
 
@@ -460,42 +437,16 @@ def delete_line_order_by_timestamp(timestamp):
     指定されたタイムスタンプのLINE注文データを削除
     """
     try:
-        orders_file = os.path.join(LINE_ORDERS_DIR, "orders.json")
-        if not os.path.exists(orders_file):
-            return False, "データファイルが見つかりません"
-        
-        with get_file_lock(orders_file):
-            with open(orders_file, "r", encoding="utf-8") as f:
-                all_orders = json.load(f)
-            
-            # 指定されたタイムスタンプの注文を削除
-            original_count = len(all_orders)
-            remaining_orders = [order for order in all_orders if order['timestamp'] != timestamp]
-            deleted_count = original_count - len(remaining_orders)
-            
-            if deleted_count == 0:
-                return False, "指定されたデータが見つかりません"
-            
-            # 削除された注文の画像ファイルも削除
-            deleted_orders = [order for order in all_orders if order['timestamp'] == timestamp]
-            for order in deleted_orders:
-                image_path = os.path.join(LINE_ORDERS_DIR, order['image_filename'])
-                if os.path.exists(image_path):
-                    os.remove(image_path)
-            
-            # 残りの注文データを保存
-            with open(orders_file, "w", encoding="utf-8") as f:
-                json.dump(remaining_orders, f, ensure_ascii=False, indent=4)
-        
+        deleted_files = delete_line_orders_by_timestamp(timestamp)
+        if not deleted_files:
+            return False, "指定されたデータが見つかりません"
+        # 削除された注文の画像ファイルも削除
+        _remove_line_images(deleted_files)
         return True, f"データを削除しました"
     except Exception as e:
         return False, f"削除エラー: {e}"
 
 # テキスト注文データ管理関数群
-def _text_orders_file():
-    """テキスト注文データファイルのパスを取得"""
-    return os.path.join(TEXT_ORDERS_DIR, "orders.json")
-
 def save_text_order_data(account, customer_name, message_text, delivery_date_opt=None):
     """
     テキスト注文データを保存
@@ -517,15 +468,16 @@ def save_text_order_data(account, customer_name, message_text, delivery_date_opt
             "parsed_data": None
         }
 
-        path = _text_orders_file()
-        with get_file_lock(path):
-            arr = []
-            if os.path.exists(path):
-                with open(path, "r", encoding="utf-8") as f:
-                    arr = json.load(f)
-            arr.append(data)
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(arr, f, ensure_ascii=False, indent=4)
+        # 注文データをキュー（SQLite）に1行追加
+        insert_text_order(data)
+
+        # 自動解析が有効なアカウントは受信と同時に解析ジョブを登録
+        if is_eager_parse_enabled(account):
+            try:
+                enqueue_text_order(data, account, PRIORITY_EAGER)
+                ensure_worker_running()
+            except Exception as e:
+                print(f"自動解析の登録エラー: {e}")
         return True, "テキスト注文を保存しました。", ts
     except Exception as e:
         return False, f"テキスト注文保存エラー: {e}", None
@@ -535,12 +487,7 @@ def get_text_orders_for_user(account):
     ユーザーに関連するテキスト注文データを取得
     """
     try:
-        path = _text_orders_file()
-        if not os.path.exists(path):
-            return []
-        with open(path, "r", encoding="utf-8") as f:
-            all_ = json.load(f)
-        return [o for o in all_ if o.get("account") == account]
+        return list_text_orders(account)
     except Exception as e:
         print(f"get_text_orders_for_user error: {e}")
         return []
@@ -550,29 +497,9 @@ def save_parsed_text_order_data(timestamp, parsed):
     テキスト注文の解析結果を保存
     """
     try:
-        path = _text_orders_file()
-        if not os.path.exists(path):
-            return False, "データファイルがありません"
-        with get_file_lock(path):
-            with open(path, "r", encoding="utf-8") as f:
-                arr = json.load(f)
-            updated = False
-            for o in arr:
-                if o["timestamp"] == timestamp and not o.get("processed", False):
-                    o["parsed_data"] = parsed
-                    o["processed"] = True
-                    updated = True
-                    break
-            if not updated:
-                # 念のため二段階目（同timestamp強制更新）
-                for o in arr:
-                    if o["timestamp"] == timestamp:
-                        o["parsed_data"] = parsed
-                        o["processed"] = True
-                        updated = True
-                        break
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(arr, f, ensure_ascii=False, indent=4)
+        # 未処理の同timestampを優先して1行だけ更新（なければ処理済みを上書き）
+        if not mark_text_orders_parsed([(timestamp, parsed)]):
+            return False, "データがありません"
         return True, "解析結果を保存しました"
     except Exception as e:
         return False, f"解析結果保存エラー: {e}"
@@ -582,15 +509,7 @@ def delete_text_order_by_timestamp(timestamp):
     指定されたタイムスタンプのテキスト注文データを削除
     """
     try:
-        path = _text_orders_file()
-        if not os.path.exists(path):
-            return False, "データファイルがありません"
-        with get_file_lock(path):
-            with open(path, "r", encoding="utf-8") as f:
-                arr = json.load(f)
-            new_arr = [o for o in arr if o["timestamp"] != timestamp]
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(new_arr, f, ensure_ascii=False, indent=4)
+        delete_text_orders_by_timestamp(timestamp)
         return True, "データを削除しました"
     except Exception as e:
         return False, f"削除エラー: {e}"
@@ -600,153 +519,108 @@ def delete_processed_text_orders():
     処理済みのテキスト注文データを削除
     """
     try:
-        path = _text_orders_file()
-        if not os.path.exists(path):
-            return True, "削除対象なし"
-        with get_file_lock(path):
-            with open(path, "r", encoding="utf-8") as f:
-                arr = json.load(f)
-            remain = [o for o in arr if not o.get("processed", False)]
-            deleted = len(arr) - len(remain)
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(remain, f, ensure_ascii=False, indent=4)
+        deleted = delete_processed_text_order_rows()
         return True, f"{deleted}件の処理済みテキストを削除しました"
     except Exception as e:
         return False, f"削除エラー: {e}"
 
-def parse_text_order_with_openai(customer_name, message_text, order_date, delivery_date_override=""):
+def is_eager_parse_enabled(account):
+    """受信と同時に自動解析するアカウントか（ワーカー使用時のみ有効）"""
+    if not USE_LLM_WORKER:
+        return False
+    value = get_account_setting(account, "eager_parse")
+    return get_eager_parse_default() if value is None else value == "1"
+
+def enqueue_unprocessed_orders(account, priority=PRIORITY_EAGER):
+    """未解析のLINE注文・テキスト注文をすべて解析ジョブに登録し、登録件数を返す"""
+    count = 0
+    for order in list_line_orders(account):
+        if not order.get("processed", False):
+            enqueue_line_order(order, account, priority)
+            count += 1
+    for t in list_text_orders(account):
+        if not t.get("processed", False):
+            enqueue_text_order(t, account, priority)
+            count += 1
+    if count:
+        ensure_worker_running()
+    return count
+
+def _on_eager_parse_toggle(account):
+    """自動解析の切り替えを保存。有効にしたときは溜まっている未解析分も登録する"""
+    enabled = st.session_state.get("eager_parse_toggle", False)
+    set_account_setting(account, "eager_parse", "1" if enabled else "0")
+    if enabled:
+        enqueue_unprocessed_orders(account)
+
+_JOB_KIND_LABELS = {"line": "LINE画像", "text": "テキスト", "pdf": "手書きPDF"}
+
+def _llm_job_metrics(account):
     """
-    OpenAI APIを使用してテキスト注文を解析
+    未解析バックログと解析ジョブの件数を表示
+    完了したジョブがあれば画面全体を再実行して解析結果を反映する
     """
-    try:
-        api_key = get_openai_api_key()
-        if not api_key:
-            raise Exception("OPENAI_API_KEYが設定されていません")
-        
-        import openai
-        client = openai.OpenAI(api_key=api_key)
-
-        system_prompt = get_text_order_prompt()
-        user_text = (
-            f"顧客名: {customer_name}\n"
-            f"受信日(基準日): {order_date}\n"
-            f"本文:\n{message_text}\n"
-            "上記を解析して構造化JSONで返してください。"
-        )
-
-        resp = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role":"system","content":system_prompt},
-                      {"role":"user","content":user_text}],
-            max_tokens=2000,
-            temperature=0.1
-        )
-        content = resp.choices[0].message.content.strip()
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.endswith("```"):
-            content = content[:-3]
-        parsed = json.loads(content)
-
-        # 最低限の補正（発注日/納品日）
-        if not parsed.get("order_date"):
-            parsed["order_date"] = order_date
-        if delivery_date_override:
-            parsed["delivery_date"] = delivery_date_override
-        if not parsed.get("partner_name"):
-            parsed["partner_name"] = customer_name
-        return parsed
-    except Exception as e:
-        raise Exception(f"テキスト注文解析エラー: {e}")
+    counts = job_counts(account)
+    backlog = unprocessed_order_counts(account)
+    active = counts["queued"] + counts["running"]
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("未解析バックログ", backlog["line"] + backlog["text"],
+                  help=f"LINE {backlog['line']}件 / テキスト {backlog['text']}件")
+    with col2:
+        st.metric("解析待ち", counts["queued"])
+    with col3:
+        st.metric("解析中", counts["running"])
+    if active:
+        st.caption("⏳ バックグラウンドで解析中です（画面を閉じても解析は続きます）")
+    prev = st.session_state.get("llm_active_jobs", active)
+    st.session_state.llm_active_jobs = active
+    if active < prev:
+        st.rerun()
 
-def parse_line_order_with_openai(image_path, sender_name, message_text="", order_date=""):
-    """
-    OpenAI APIを使用してLINE注文画像を解析
-    """
-    try:
-        api_key = get_openai_api_key()
-        if not api_key:
-            raise Exception("OPENAI_API_KEYが設定されていません")
-        
-        import openai
-        client = openai.OpenAI(api_key=api_key)
-        
-        # 画像をbase64エンコード
-        with open(image_path, "rb") as image_file:
-            image_data = base64.b64encode(image_file.read()).decode('utf-8')
-        
-        # システムプロンプト
-        system_prompt = get_line_order_prompt()
-        
-        # 受信日時を含むユーザーメッセージ
-        user_message = f"送信者: {sender_name}\n受信日: {order_date}\nメッセージ: {message_text}\n\nこのLINE注文を解析してください。受信日を基準に納品日を計算してください。"
-        
-        # OpenAI APIを呼び出し
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": system_prompt
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": user_message},
-                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_data}"}}
-                    ]
-                }
-            ],
-            max_tokens=2000,
-            temperature=0.1
-        )
-        
-        # レスポンスを解析
-        content = response.choices[0].message.content
-        
-        # JSONとして解析
-        try:
-            cleaned_content = content.strip()
-            if cleaned_content.startswith('```json'):
-                cleaned_content = cleaned_content[7:]
-            if cleaned_content.endswith('```'):
-                cleaned_content = cleaned_content[:-3]
-            cleaned_content = cleaned_content.strip()
-            
-            parsed_data = json.loads(cleaned_content)
-            
-            # 発注日が空の場合は受信日を設定
-            if not parsed_data.get("order_date"):
-                parsed_data["order_date"] = order_date
-            
-            return parsed_data
-        except json.JSONDecodeError as e:
-            raise Exception(f"JSON解析エラー: {e}")
-            
-    except Exception as e:
-        raise Exception(f"LINE注文解析エラー: {e}")
+# 数秒ごとに自動更新する版（解析中・自動解析有効時のみ使用）
+_llm_job_metrics_live = st.fragment(run_every=3)(_llm_job_metrics)
+
+def render_llm_job_panel(account):
+    """自動解析の切り替え・バックログ表示と、失敗ジョブ（デッドレター）の再実行・削除"""
+    eager = st.toggle("📥 受信と同時に自動解析", value=is_eager_parse_enabled(account),
+                      key="eager_parse_toggle", on_change=_on_eager_parse_toggle, args=(account,),
+                      help="LINE画像・テキスト注文を保存した時点でバックグラウンド解析を開始します（アカウントごとの設定）")
+    counts = job_counts(account)
+    if counts["queued"] + counts["running"]:
+        ensure_worker_running()  # ワーカーが止まっていれば起動し直す
+    if eager or counts["queued"] + counts["running"]:
+        _llm_job_metrics_live(account)
+    else:
+        _llm_job_metrics(account)
+
+    if counts["dead"]:
+        with st.expander(f"⚠️ 解析に失敗したジョブ（{counts['dead']}件）", expanded=False):
+            for job in list_jobs(account, ["dead"], limit=50):
+                label = job["payload"].get("filename") or job["payload"].get("sender_name") \
+                    or job["payload"].get("customer_name") or job["ref"]
+                col1, col2, col3 = st.columns([4, 1, 1])
+                with col1:
+                    st.write(f"**{_JOB_KIND_LABELS.get(job['kind'], job['kind'])}**: {label}（試行 {job['attempts']}回）")
+                    st.caption(job["error"] or "")
+                with col2:
+                    if st.button("再実行", key=f"job_retry_{job['id']}"):
+                        requeue_job(job["id"])
+                        ensure_worker_running()
+                        st.rerun()
+                with col3:
+                    if st.button("削除", key=f"job_delete_{job['id']}"):
+                        remove_pdf_job_file(delete_job(job["id"]))
+                        st.rerun()
 
-def extract_pdf_images(pdf_bytes):
+def extract_pdf_images(pdf_bytes, filename=""):
     """
-    PDFからページ全体を画像として抽出してPIL Imageオブジェクトのリストを返す
+    PDFのページ画像を [{'page', 'image'(PIL Image)}] で返す
+    描画結果はディスクにキャッシュされ、OpenAIへの送信時にも再利用される
     """
     try:
-        with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-            page_images = []
-            for page_num, page in enumerate(pdf.pages):
-                try:
-                    # ページを画像としてレンダリング
-                    page_image = page.to_image()
-                    if page_image:
-                        pil_image = page_image.original
-                        page_images.append({
-                            'page': page_num + 1,
-                            'image': pil_image
-                        })
-                except Exception as e:
-                    st.warning(f"ページ {page_num + 1} の画像化に失敗: {e}")
-            
-            return page_images
+        with PdfDocument(pdf_bytes, filename) as doc:
+            return doc.page_images()
     except Exception as e:
         st.error(f"PDF画像抽出エラー: {e}")
         return []
@@ -777,6 +651,42 @@ def display_pdf_images(images, filename):
                         st.write(f"**ページ {img_data['page']}**")
                         st.image(img_data['image'], caption=f"ページ {img_data['page']}", width=400)
 
+# --- 履歴・組織内集計の読み取りキャッシュ ---
+# タブはフラグメントとして個別に再実行されるため、同じ条件の読み取りはキャッシュから返す。
+# version（db.get_data_version）は注文明細の保存・削除のたびに進むので、その時点で読み直される
+_HISTORY_QUERIES = {
+    "count": count_history,
+    "page": list_history_page,
+    "search": search_history_page,
+    "batches": list_history_batches,
+    "partners": lambda account, filters=None: list_history_partners(account),
+    "ids": history_ids,
+}
+
+def rerun_fragment():
+    """実行中のフラグメント（タブ）だけを再実行（全体実行の途中で呼ばれた場合はアプリ全体を再実行）"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+@st.cache_data(show_spinner=False, max_entries=512)
+def cached_history_query(query: str, version: int, account: str, filters: dict = None, **kwargs):
+    """履歴タブの読み取り（query は _HISTORY_QUERIES のキー）"""
+    return _HISTORY_QUERIES[query](account, filters, **kwargs)
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def cached_org_summary(company: str, version: int, date_type: str = "created", day_from: int = None, day_to: int = None):
+    """組織内集計（商品別は表示順にソート済み）"""
+    df_acc, df_prd, df_ptn = get_org_summary(company, date_type, day_from, day_to)
+    if not df_prd.empty:
+        df_prd = sort_by_simple_order(
+            df_prd,
+            drop_non_product=True,         # 集計は非商品を除外
+            secondary_keys=None
+        )
+    return df_acc, df_prd, df_ptn
+
 def is_admin(username):
     """
     管理者かどうかを判定
@@ -924,27 +834,6 @@ def load_docx_html(filepath):
         html += f"{para.text}<br>"
     return html
 
-def detect_csv_type(content_bytes):
-    ENCODINGS = ["utf-8-sig", "utf-8", "cp932", "shift_jis"]
-    debug_log = []
-    for enc in ENCODINGS:
-        try:
-            file_str = content_bytes.decode(enc)
-            sio = io.StringIO(file_str)
-            first_line = sio.readline().strip().split(",")
-            debug_log.append(f"[{enc}] first_line={first_line}")
-            cell0 = first_line[0].replace('"', '').replace("'", '').strip() if first_line else ""
-            if cell0 == "H":
-                debug_log.append(f"判定: infomart ({enc})")
-                return 'infomart', enc, debug_log
-            elif cell0 == "伝票番号":
-                debug_log.append(f"判定: iporter ({enc})")
-                return 'iporter', enc, debug_log
-        except Exception as e:
-            debug_log.append(f"[{enc}] error: {e}")
-    debug_log.append("判定: unknown")
-    return 'unknown', None, debug_log
-
 def validate_email(email):
     """
     メールアドレスの形式を検証する
@@ -1047,6 +936,11 @@ def load_credentials_from_yaml(use_lock=True):
         # ロックなしで読み込み（既にロックを取得している場合）
         return _load_without_lock()
 
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_credentials_cached(mtime_ns: int, size: int):
+    """認証情報の読み込み（ファイルの更新時刻・サイズが同じ間は再実行のたびに読み直さない）"""
+    return load_credentials_from_yaml()
+
 def save_credentials_to_yaml(config, use_lock=True) -> bool:
     """認証情報をYAMLファイルに原子的に保存"""
     try:
@@ -1222,7 +1116,8 @@ try:
     else:
         # 2回目以降：純粋に読むだけ（副作用なし）
         print("既存ファイルから読み込みます")
-        credentials_config = load_credentials_from_yaml()
+        cred_stat = CRED_PATH.stat()
+        credentials_config = load_credentials_cached(cred_stat.st_mtime_ns, cred_stat.st_size)
     print("=== 認証情報初期化完了 ===")
     
     # デバッグ情報
@@ -1581,6 +1476,69 @@ if st.session_state.get("authentication_status"):
                     else:
                         st.error(message)
             
+            # 解析キャッシュ（OpenAI解析結果）
+            st.subheader("🧠 解析キャッシュ")
+            try:
+                cache_stats = llm_cache.stats()
+                col1, col2, col3, col4 = st.columns(4)
+                with col1:
+                    st.metric("キャッシュ件数", cache_stats["entries"])
+                with col2:
+                    st.metric("サイズ", f"{cache_stats['bytes'] / 1024 / 1024:.1f} MB")
+                with col3:
+                    st.metric("ヒット / ミス", f"{cache_stats['hits']} / {cache_stats['misses']}")
+                with col4:
+                    st.metric("ヒット率", f"{cache_stats['hit_rate'] * 100:.0f}%")
+                
+                col1, col2 = st.columns(2)
+                with col1:
+                    if st.button("🧹 プロンプト変更分のキャッシュを無効化", key="cache_invalidate_stale"):
+                        current_versions = {
+                            "line": llm_cache.prompt_version(get_line_order_prompt()),
+                            "text": llm_cache.prompt_version(get_text_order_prompt()),
+                            "pdf": llm_cache.prompt_version(PDF_ORDER_SYSTEM_PROMPT),
+                        }
+                        deleted = llm_cache.invalidate_stale(current_versions)
+                        st.success(f"{deleted}件のキャッシュを無効化しました")
+                with col2:
+                    if st.button("🗑️ キャッシュを全削除", key="cache_clear_all"):
+                        deleted = llm_cache.clear()
+                        st.success(f"{deleted}件のキャッシュを削除しました")
+            except Exception as e:
+                st.error(f"解析キャッシュ情報の取得エラー: {e}")
+            
+            # OpenAI APIスケジューラ
+            st.subheader("📮 解析ジョブ")
+            all_job_counts = job_counts()
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("待機中", all_job_counts["queued"])
+            with col2:
+                st.metric("処理中", all_job_counts["running"])
+            with col3:
+                st.metric("完了", all_job_counts["done"])
+            with col4:
+                st.metric("失敗（デッドレター）", all_job_counts["dead"])
+            st.caption(f"実行方式: {get_llm_worker_mode()}（LLM_WORKER_MODE）")
+
+            st.subheader("🌐 OpenAI API送信状況")
+            api_metrics = openai_client.metrics()
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("待機中", api_metrics["queue_depth"])
+                st.metric("送信中", api_metrics["in_flight"])
+            with col2:
+                st.metric("送信数", api_metrics["requests"])
+                st.metric("再試行数", api_metrics["retries"])
+            with col3:
+                st.metric("平均待ち時間", f"{api_metrics['avg_wait_ms']:.0f} ms")
+                st.metric("最大待ち時間", f"{api_metrics['max_wait_ms']:.0f} ms")
+            with col4:
+                st.metric("RPM残", api_metrics["rpm_available"])
+                st.metric("TPM残", api_metrics["tpm_available"])
+            if api_metrics["rate_limited"]:
+                st.warning(f"429（レート制限）応答: {api_metrics['rate_limited']}回")
+            
             # システム情報
             st.subheader("⚙️ システム情報")
             col1, col2 = st.columns(2)
@@ -1627,6 +1585,18 @@ if st.session_state.get("authentication_status"):
         st.sidebar.info(f"is_production(): {is_production()}")
         st.sidebar.info(f"OpenAI API Key: {'設定済み' if get_openai_api_key() else '未設定'}")
 
+        # Excel生成の内訳（直近の「Excelを作成」）
+        with st.sidebar.expander("📊 Excel生成の内訳"):
+            info = cache_info()
+            st.caption(f"保持中のブック: {info['entries']}件 / {info['bytes'] / 1024 / 1024:.1f}MB")
+            builds = recent_builds()
+            if not builds:
+                st.caption("まだ生成していません")
+            for b in builds:
+                st.markdown(f"**{b['profile']}** {b['at']} {b['bytes'] / 1024:,.0f}KB"
+                            + ("（再利用）" if b["cached"] else ""))
+                st.text("\n".join(f"{label}: {sec * 1000:,.0f}ms" for label, sec in b["timings"]))
+
     # OpenAI APIキー設定（開発環境のみ）
     if not is_production():
         st.sidebar.markdown("---")
@@ -1678,6 +1648,21 @@ if st.session_state.get("authentication_status"):
         if 'parsed_records' not in st.session_state:
             st.session_state.parsed_records = []
         
+        # 解析時の絞り込み（各パーサーが伝票の見出しで判定し、対象外の伝票は明細を作らない）
+        with st.expander("🔍 解析時の絞り込み（Infomart / IPORTER / 三菱）", expanded=False):
+            pf1, pf2 = st.columns(2)
+            with pf1:
+                parse_from = st.date_input("納品日（開始）", value=None, format="YYYY-MM-DD", key="parse_delivery_from")
+            with pf2:
+                parse_to = st.date_input("納品日（終了）", value=None, format="YYYY-MM-DD", key="parse_delivery_to")
+            pf3, pf4 = st.columns(2)
+            with pf3:
+                parse_partners = st.text_input("取引先名（部分一致、カンマ区切りで複数）", key="parse_partners")
+            with pf4:
+                parse_order_ids = st.text_input("伝票番号（カンマ区切りで複数）", key="parse_order_ids")
+            st.caption("これから解析するファイルに適用されます（解析済みのファイルは「解析済ファイルリセット」後に再アップロード）。PDF・LINE・テキスト注文は対象外です。")
+        parse_filter = OrderFilter.build(parse_from, parse_to, split_terms(parse_partners), split_terms(parse_order_ids))
+        
         # PDF画像表示設定（カラムレイアウトを調整して縦位置を合わせる）
         col1, col2 = st.columns([4, 1])
         with col1:
@@ -1709,6 +1694,10 @@ if st.session_state.get("authentication_status"):
                 st.success("解析済みファイルをリセットしました。")
                 st.rerun()
 
+        # バックグラウンド解析ジョブの状況
+        if USE_LLM_WORKER:
+            render_llm_job_panel(username)
+
         # PDF解析結果の表示（注文データファイルアップロードセクション内）
         pdf_contents = {}  # PDFファイルの内容を保存
         if uploaded_files:
@@ -1736,7 +1725,7 @@ if st.session_state.get("authentication_status"):
                         st.session_state.pdf_status_placeholders[file.name] = status_placeholder
                         
                         if show_pdf_images:
-                            pdf_images = extract_pdf_images(content)
+                            pdf_images = extract_pdf_images(content, file.name)
                             if pdf_images:
                                 display_pdf_images(pdf_images, file.name)
 
@@ -1833,7 +1822,24 @@ if st.session_state.get("authentication_status"):
                 # 一括解析ボタンを追加
                 col1, col2 = st.columns([1, 1])
                 with col1:
-                    if st.button("🚀 一括解析開始", type="primary", key="batch_parse"):
+                    if not USE_LLM_WORKER:
+                        max_workers = st.number_input(
+                            "同時解析数", min_value=1, max_value=16,
+                            value=get_llm_max_concurrency(), step=1, key="batch_parse_workers",
+                            help="OpenAI APIへ同時に送信するリクエスト数の上限です"
+                        )
+                    start_batch_parse = st.button("🚀 一括解析開始", type="primary", key="batch_parse")
+                    if start_batch_parse and USE_LLM_WORKER:
+                        # 解析はワーカープロセスで実行（画面は登録して進捗を表示するだけ）
+                        try:
+                            for order in sorted(unprocessed_orders, key=lambda x: x['timestamp']):
+                                enqueue_line_order(order, username)
+                            ensure_worker_running()
+                            st.success(f"{len(unprocessed_orders)}件のLINE注文をバックグラウンド解析に登録しました。")
+                            st.rerun()
+                        except Exception as e:
+                            st.error(f"一括解析の登録エラー: {e}")
+                    elif start_batch_parse:
                         try:
                             with st.spinner(f"{len(unprocessed_orders)}件のLINE注文を一括解析中..."):
                                 processed_count = 0
@@ -1843,35 +1849,41 @@ if st.session_state.get("authentication_status"):
                                 sorted_orders = sorted(unprocessed_orders, key=lambda x: x['timestamp'])
                                 
                                 # デバッグ情報
-                                st.info(f"処理対象: {len(sorted_orders)}件の注文")
+                                st.info(f"処理対象: {len(sorted_orders)}件の注文（同時解析数: {max_workers}）")
+                                progress = st.progress(0.0)
+                                
+                                def _parse_line_order(order):
+                                    image_path = os.path.join(LINE_ORDERS_DIR, order['image_filename'])
+                                    if not os.path.exists(image_path):
+                                        raise FileNotFoundError(f"画像ファイルが見つかりません: {order['image_filename']}")
+                                    # OpenAI APIで解析
+                                    return parse_line_order_with_openai(
+                                        image_path, 
+                                        order['sender_name'], 
+                                        order.get('message_text', ''),
+                                        order['order_date'] # 受信日時を渡す
+                                    )
                                 
-                                for i, order in enumerate(sorted_orders, 1):
-                                    st.info(f"処理中 ({i}/{len(sorted_orders)}): {order['sender_name']} - {order['timestamp']}")
+                                # 完了した順に進捗表示し、結果は最後にまとめて保存
+                                parsed_results = []
+                                for done, (order, parsed_data, error) in enumerate(
+                                        run_concurrently(_parse_line_order, sorted_orders, int(max_workers)), 1):
+                                    progress.progress(done / len(sorted_orders),
+                                                      text=f"完了 ({done}/{len(sorted_orders)}): {order['sender_name']} - {order['timestamp']}")
+                                    if error is not None:
+                                        error_count += 1
+                                        st.error(f"解析エラー ({order['sender_name']}): {error}")
+                                    else:
+                                        parsed_results.append((order['timestamp'], parsed_data))
+                                
+                                # 解析結果を1トランザクションで保存（processedフラグも更新される）
+                                if parsed_results:
                                     try:
-                                        image_path = os.path.join(LINE_ORDERS_DIR, order['image_filename'])
-                                        if os.path.exists(image_path):
-                                            # OpenAI APIで解析
-                                            parsed_data = parse_line_order_with_openai(
-                                                image_path, 
-                                                order['sender_name'], 
-                                                order.get('message_text', ''),
-                                                order['order_date'] # 受信日時を渡す
-                                            )
-                                            
-                                            # 解析結果を保存（processedフラグも更新される）
-                                            success, message = save_parsed_line_order_data(order['timestamp'], parsed_data)
-                                            if success:
-                                                processed_count += 1
-                                            else:
-                                                error_count += 1
-                                                st.error(f"解析結果の保存に失敗 ({order['sender_name']}): {message}")
-                                            
-                                        else:
-                                            error_count += 1
-                                            st.error(f"画像ファイルが見つかりません ({order['sender_name']}): {order['image_filename']}")
+                                        processed_count = mark_line_orders_parsed(parsed_results)
+                                        error_count += len(parsed_results) - processed_count
                                     except Exception as e:
-                                        error_count += 1
-                                        st.error(f"解析エラー ({order['sender_name']}): {e}")
+                                        error_count += len(parsed_results)
+                                        st.error(f"解析結果の保存に失敗: {e}")
                                 
                                 st.success(f"一括解析完了！ 成功: {processed_count}件, エラー: {error_count}件")
                                 st.rerun()
@@ -1894,8 +1906,10 @@ if st.session_state.get("authentication_status"):
                 
                 st.markdown("---")
                 
+                queued_line_refs = active_job_refs("line", username) if USE_LLM_WORKER else set()
                 for i, order in enumerate(unprocessed_orders):
-                    with st.expander(f"📋 {order['sender_name']} - {order['order_date']} ({order['timestamp']})"):
+                    pending_mark = "⏳ " if order['timestamp'] in queued_line_refs else ""
+                    with st.expander(f"{pending_mark}📋 {order['sender_name']} - {order['order_date']} ({order['timestamp']})"):
                         col1, col2 = st.columns([2, 1])
                         
                         with col1:
@@ -1912,7 +1926,16 @@ if st.session_state.get("authentication_status"):
                         
                         with col2:
                             # 解析ボタン
-                            if st.button(f"解析開始", key=f"parse_{i}_{order['timestamp']}"):
+                            start_parse = st.button(f"解析開始", key=f"parse_{i}_{order['timestamp']}")
+                            if start_parse and USE_LLM_WORKER:
+                                try:
+                                    enqueue_line_order(order, username, PRIORITY_INTERACTIVE)
+                                    ensure_worker_running()
+                                    st.success("解析を登録しました。完了すると自動で反映されます。")
+                                    st.rerun()
+                                except Exception as e:
+                                    st.error(f"解析の登録エラー: {e}")
+                            elif start_parse:
                                 try:
                                     with st.spinner("LINE注文を解析中..."):
                                         # OpenAI APIで解析
@@ -1976,22 +1999,13 @@ if st.session_state.get("authentication_status"):
                             
                             # 削除ボタン
                             if st.button(f"削除", key=f"delete_{i}_{order['timestamp']}"):
-                                # 注文データを削除
-                                orders_file = os.path.join(LINE_ORDERS_DIR, "orders.json")
-                                with open(orders_file, "r", encoding="utf-8") as f:
-                                    all_orders = json.load(f)
-                                
-                                all_orders = [o for o in all_orders if o['timestamp'] != order['timestamp']]
-                                
-                                with open(orders_file, "w", encoding="utf-8") as f:
-                                    json.dump(all_orders, f, ensure_ascii=False, indent=4)
-                                
-                                # 画像ファイルも削除
-                                if os.path.exists(image_path):
-                                    os.remove(image_path)
-                                
-                                st.success("LINE注文を削除しました。")
-                                st.rerun()
+                                # 注文データと画像ファイルを削除
+                                success, message = delete_line_order_by_timestamp(order['timestamp'])
+                                if success:
+                                    st.success("LINE注文を削除しました。")
+                                    st.rerun()
+                                else:
+                                    st.error(message)
             else:
                 st.info("未処理のLINE注文はありません。")
         else:
@@ -2058,18 +2072,47 @@ if st.session_state.get("authentication_status"):
         st.info(f"未処理テキスト: {len(unproc_texts)} / 解析済み: {len(proc_texts)}")
         
         if unproc_texts:
-            if st.button("🚀 テキスト一括解析", type="primary", key="btn_text_batch"):
+            start_text_batch = st.button("🚀 テキスト一括解析", type="primary", key="btn_text_batch")
+            if start_text_batch and USE_LLM_WORKER:
+                # 解析はワーカープロセスで実行（短文のまとめ送信もワーカー側で行う）
+                try:
+                    for t in sorted(unproc_texts, key=lambda x: x["timestamp"]):
+                        enqueue_text_order(t, username)
+                    ensure_worker_running()
+                    st.success(f"{len(unproc_texts)}件のテキスト注文をバックグラウンド解析に登録しました。")
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"一括解析の登録エラー: {e}")
+            elif start_text_batch:
                 success_cnt = err_cnt = 0
-                for t in sorted(unproc_texts, key=lambda x: x["timestamp"]):
+                sorted_texts = sorted(unproc_texts, key=lambda x: x["timestamp"])
+                # 短文はまとめて1リクエスト、リクエスト同士は同時実行数の範囲で並列
+                groups = plan_text_order_requests(sorted_texts, get_text_pack_size(), get_text_pack_max_chars())
+                st.info(f"処理対象: {len(sorted_texts)}件（APIリクエスト {len(groups)}回 / 同時解析数: {get_llm_max_concurrency()}）")
+                progress = st.progress(0.0)
+                
+                done = 0
+                parsed_results = []
+                for group, outcomes, error in run_concurrently(parse_text_order_group, groups, get_llm_max_concurrency()):
+                    if error is not None:
+                        outcomes = [(t, error) for t in group]
+                    for t, parsed in outcomes:
+                        done += 1
+                        if isinstance(parsed, Exception):
+                            err_cnt += 1
+                            st.error(f"解析エラー ({t['customer_name']}): {parsed}")
+                        else:
+                            parsed_results.append((t["timestamp"], parsed))
+                    progress.progress(done / len(sorted_texts), text=f"完了 ({done}/{len(sorted_texts)})")
+                
+                # 解析結果を1トランザクションで保存
+                if parsed_results:
                     try:
-                        parsed = parse_text_order_with_openai(
-                            t["customer_name"], t["message_text"], t["order_date"], t.get("delivery_date_opt","")
-                        )
-                        ok, _ = save_parsed_text_order_data(t["timestamp"], parsed)
-                        success_cnt += 1 if ok else 0
+                        success_cnt = mark_text_orders_parsed(parsed_results)
+                        err_cnt += len(parsed_results) - success_cnt
                     except Exception as e:
-                        err_cnt += 1
-                        st.error(f"解析エラー ({t['customer_name']}): {e}")
+                        err_cnt += len(parsed_results)
+                        st.error(f"解析結果の保存に失敗: {e}")
                 st.success(f"一括解析 完了：成功 {success_cnt} / 失敗 {err_cnt}")
                 st.rerun()
         
@@ -2077,8 +2120,10 @@ if st.session_state.get("authentication_status"):
         if unproc_texts:
             st.markdown("#### 未処理テキスト注文")
             with st.expander("📋 未処理TEXT注文詳細", expanded=False):
+                queued_text_refs = active_job_refs("text", username) if USE_LLM_WORKER else set()
                 for i, t in enumerate(unproc_texts):
-                    st.write(f"**{i+1}. {t['customer_name']} - {t['order_date']} ({t['timestamp']})**")
+                    pending_mark = "⏳ " if t["timestamp"] in queued_text_refs else ""
+                    st.write(f"**{pending_mark}{i+1}. {t['customer_name']} - {t['order_date']} ({t['timestamp']})**")
                     st.write(f"本文: {t['message_text'][:300]}{'...' if len(t['message_text'])>300 else ''}")
                     if t.get('delivery_date_opt'):
                         st.write(f"指定納品日: {t['delivery_date_opt']}")
@@ -2223,6 +2268,38 @@ if st.session_state.get("authentication_status"):
                             "data_source": src
                         })
             
+            # バックグラウンド解析が終わった手書きPDFの結果を取り込む
+            # （アカウント単位で取り込むので、アップロードした画面を閉じていても次に開いた画面で取り込まれる）
+            pending_pdfs = st.session_state.setdefault("pending_pdf_jobs", {})
+            pending_by_job = {p["job_id"]: file_hash for file_hash, p in pending_pdfs.items()}
+            for job in claim_job_results(username, "pdf"):
+                pdf_records = job["result"] or []
+                records += pdf_records
+                if pdf_records and pdf_records[0].get('product_name') == "商品情報なし":
+                    st.warning("商品情報の抽出に失敗しました。手書き文字の認識精度を確認してください。")
+                st.success(f"{job['payload'].get('filename', '')} の解析が完了しました")
+                file_hash = pending_by_job.get(job["id"])
+                if file_hash:
+                    st.session_state.processed_files.add(file_hash)
+                    del pending_pdfs[file_hash]
+            if pending_pdfs:
+                pdf_jobs = get_jobs(p["job_id"] for p in pending_pdfs.values())
+                for file_hash, p in list(pending_pdfs.items()):
+                    job = pdf_jobs.get(p["job_id"])
+                    if job is None:
+                        # ジョブが削除された場合は次回のアップロード時に登録し直す
+                        del pending_pdfs[file_hash]
+                    elif job["status"] == "done":
+                        # 同じアカウントの別の画面で取り込み済み
+                        st.info(f"{p['filename']} の解析結果は別の画面で取り込まれました")
+                        st.session_state.processed_files.add(file_hash)
+                        del pending_pdfs[file_hash]
+                    elif job["status"] == "dead":
+                        # エラーは1回だけ表示する（再実行は「解析に失敗したジョブ」から。アップロードし直せば登録し直す）
+                        st.error(f"{p['filename']} の解析に失敗しました: {job['error']}")
+                        st.session_state.setdefault("failed_pdf_uploads", set()).add(p.get("upload_id"))
+                        del pending_pdfs[file_hash]
+
             if uploaded_files:
                 # ファイルの重複チェックと多重解析防止
                 new_files = []
@@ -2234,99 +2311,127 @@ if st.session_state.get("authentication_status"):
                     new_files.append(file)
                 
                 if new_files:
+                    # 並列に解析するタスクを作る（CSV/XLSXはプロセスプール、手書きPDFはOpenAIの応答待ちなのでスレッドで同時実行）
+                    ingest_tasks = []
                     for file in new_files:
                         filename = file.name
                         content = file.read()
 
-                        if filename.lower().endswith((".txt", ".csv")):
-                            filetype, detected_enc, debug_log = detect_csv_type(content)
-                            debug_details.append(f"【{filename}】\n" + "\n".join(debug_log))
-                            file_like = io.BytesIO(content)
-                            if filetype == 'infomart':
-                                records += parse_infomart(file_like, filename)
-                                st.success(f"{filename} の解析が完了しました")
-                                # 解析成功の末尾で必ず登録
-                                file_hash = f"{file.name}_{file.size}_{file.type}"
-                                st.session_state.processed_files.add(file_hash)
-                            elif filetype == 'iporter':
-                                records += parse_iporter(file_like, filename)
-                                st.success(f"{filename} の解析が完了しました")
-                                # 解析成功の末尾で必ず登録
-                                file_hash = f"{file.name}_{file.size}_{file.type}"
-                                st.session_state.processed_files.add(file_hash)
-                            else:
-                                st.warning(f"{filename} は未対応のフォーマットです")
+                        if filename.lower().endswith((".txt", ".csv", ".xlsx")):
+                            # 形式・エンコーディングの判定から解析までワーカー側で1回に行う
+                            ingest_tasks.append((file, parse_upload, (content, filename, parse_filter), True))
 
-                        elif filename.lower().endswith(".xlsx"):
-                            try:
-                                df_excel = pd.read_excel(io.BytesIO(content), sheet_name=0, header=None)
-                                if df_excel.shape[0] > 5 and str(df_excel.iloc[4, 1]).strip() == "伝票番号":
-                                    file_like = io.BytesIO(content)
-                                    try:
-                                        mitsubishi_records = parse_mitsubishi(file_like, filename)
-                                        records += mitsubishi_records
-                                        st.success(f"{filename} の解析が完了しました")
-                                        
-                                        # 解析成功の末尾で必ず登録
-                                        file_hash = f"{file.name}_{file.size}_{file.type}"
-                                        st.session_state.processed_files.add(file_hash)
-                                    except Exception as parse_error:
-                                        st.error(f"{filename} の解析に失敗しました: {parse_error}")
-                                        # ログから詳細情報を取得
-                                        import logging
-                                        logger = logging.getLogger('parser_mitsubishi')
-                                        if logger.handlers:
-                                            for handler in logger.handlers:
-                                                if hasattr(handler, 'baseFilename'):
-                                                    st.info(f"詳細ログ: {handler.baseFilename}")
-                                else:
-                                    st.warning(f"{filename} は未対応のExcelフォーマットです")
-                            except Exception as e:
-                                st.error(f"{filename} の読み込みに失敗しました: {e}")
-                        
                         elif filename.lower().endswith(".pdf"):
                             # 保存されたPDF内容を使用
                             if filename in pdf_contents:
                                 content = pdf_contents[filename]
-                            else:
-                                content = file.read()
                             
-                            # PDF解析の実行
+                            # APIキーの事前確認
                             try:
-                                # APIキーの事前確認
-                                try:
-                                    from config import get_openai_api_key
-                                    api_key = get_openai_api_key()
-                                    if not api_key:
-                                        st.error("OpenAI APIキーが設定されていません")
-                                        continue
-                                except Exception as api_error:
-                                    st.error(f"APIキー取得エラー: {api_error}")
+                                from config import get_openai_api_key
+                                api_key = get_openai_api_key()
+                                if not api_key:
+                                    st.error("OpenAI APIキーが設定されていません")
                                     continue
-                                
-                                pdf_records = parse_pdf_handwritten(content, filename)
-                                records += pdf_records
-                                # 商品情報の抽出状況を確認
-                                if pdf_records and pdf_records[0].get('product_name') == "商品情報なし":
-                                    st.warning("商品情報の抽出に失敗しました。手書き文字の認識精度を確認してください。")
-                                
-                                # 解析完了メッセージをプレースホルダーで表示
-                                if "pdf_status_placeholders" in st.session_state and filename in st.session_state.pdf_status_placeholders:
-                                    placeholder = st.session_state.pdf_status_placeholders[filename]
-                                    placeholder.success(f"**{filename}** の解析が完了しました")
-                                
-                                # 解析成功の末尾で必ず登録
+                            except Exception as api_error:
+                                st.error(f"APIキー取得エラー: {api_error}")
+                                continue
+                            
+                            if USE_LLM_WORKER:
+                                # 解析はワーカープロセスで実行し、完了後の再実行で結果を取り込む
                                 file_hash = f"{file.name}_{file.size}_{file.type}"
-                                st.session_state.processed_files.add(file_hash)
-                            except Exception as e:
-                                st.error(f"{filename} の解析に失敗しました: {e}")
-                                st.error(f"詳細エラー: {str(e)}")
-                                # 本番環境での追加情報
-                                if is_production():
-                                    st.info("本番環境でのトラブルシューティング:")
-                                    st.info("1. Render Secrets FilesでOPENAI_API_KEYが正しく設定されているか確認")
-                                    st.info("2. アプリケーションを再デプロイして環境変数を反映")
-                                    st.info("3. Renderのログで詳細なエラー情報を確認")
+                                upload_id = getattr(file, "file_id", file_hash)
+                                if upload_id in st.session_state.get("failed_pdf_uploads", ()):
+                                    # 解析に失敗したアップロードは自動では登録し直さない
+                                    continue
+                                if file_hash not in pending_pdfs:
+                                    job_id = enqueue_pdf(content, filename, username)
+                                    pending_pdfs[file_hash] = {"job_id": job_id, "filename": filename,
+                                                               "upload_id": upload_id}
+                                    ensure_worker_running()
+                                if "pdf_status_placeholders" in st.session_state and filename in st.session_state.pdf_status_placeholders:
+                                    st.session_state.pdf_status_placeholders[filename].info(
+                                        f"**{filename}** をバックグラウンドで解析中...")
+                                continue
+                            
+                            ingest_tasks.append((file, parse_pdf_handwritten, (content, filename), False))
+
+                    # 終わったファイルから順に取り込む（1件の失敗は他のファイルに影響しない）
+                    if ingest_tasks:
+                        ingest_total = len(ingest_tasks)
+                        cpu_bytes = sum(len(args[0]) for _, _, args, cpu_bound in ingest_tasks if cpu_bound)
+                        # 小さなファイルだけならプロセスの起動のほうが遅いのでスレッドで解析
+                        process_workers = get_ingest_process_workers() if cpu_bytes >= INGEST_PROCESS_MIN_BYTES else 0
+                        ingest_progress = st.progress(0.0, text=f"解析中... 0/{ingest_total}件")
+                        ingest_started = time.perf_counter()
+                        ingest_seconds = 0.0
+                        for done, (file, result, error, seconds) in enumerate(
+                                run_parallel(ingest_tasks, process_workers, get_llm_max_concurrency()), 1):
+                            filename = file.name
+                            file_hash = f"{file.name}_{file.size}_{file.type}"
+                            ingest_seconds += seconds or 0.0
+
+                            if filename.lower().endswith(".pdf"):
+                                if error is not None:
+                                    st.error(f"{filename} の解析に失敗しました: {error}")
+                                    st.error(f"詳細エラー: {str(error)}")
+                                    # 本番環境での追加情報
+                                    if is_production():
+                                        st.info("本番環境でのトラブルシューティング:")
+                                        st.info("1. Render Secrets FilesでOPENAI_API_KEYが正しく設定されているか確認")
+                                        st.info("2. アプリケーションを再デプロイして環境変数を反映")
+                                        st.info("3. Renderのログで詳細なエラー情報を確認")
+                                else:
+                                    pdf_records = result
+                                    records += pdf_records
+                                    # 商品情報の抽出状況を確認
+                                    if pdf_records and pdf_records[0].get('product_name') == "商品情報なし":
+                                        st.warning("商品情報の抽出に失敗しました。手書き文字の認識精度を確認してください。")
+                                    
+                                    # 解析完了メッセージをプレースホルダーで表示
+                                    if "pdf_status_placeholders" in st.session_state and filename in st.session_state.pdf_status_placeholders:
+                                        placeholder = st.session_state.pdf_status_placeholders[filename]
+                                        placeholder.success(f"**{filename}** の解析が完了しました（{seconds:.1f}秒）")
+                                    
+                                    # 解析成功の末尾で必ず登録
+                                    st.session_state.processed_files.add(file_hash)
+
+                            elif error is not None:
+                                st.error(f"{filename} の解析に失敗しました: {error}")
+                                if filename.lower().endswith(".xlsx"):
+                                    # ログから詳細情報を取得
+                                    import logging
+                                    logger = logging.getLogger('parser_mitsubishi')
+                                    if logger.handlers:
+                                        for handler in logger.handlers:
+                                            if hasattr(handler, 'baseFilename'):
+                                                st.info(f"詳細ログ: {handler.baseFilename}")
+
+                            else:
+                                debug_details.append(f"【{filename}】\n" + "\n".join(result["log"]))
+                                if result["records"] is None:
+                                    label = "Excel" if filename.lower().endswith(".xlsx") else ""
+                                    st.warning(f"{filename} は未対応の{label}フォーマットです")
+                                else:
+                                    records += result["records"]
+                                    st.success(f"{filename} の解析が完了しました")
+                                    st.caption(f"形式: {result['format']}"
+                                               + (f"（{result['encoding']}）" if result["encoding"] else "")
+                                               + f" / 確からしさ {result['confidence']:.0%}"
+                                               + f" / 判定 {result['detect_seconds'] * 1000:.0f}ms・解析 {result['parse_seconds']:.2f}秒")
+                                    if parse_filter and result["skipped_slips"]:
+                                        st.info(f"{filename}: 絞り込み（{parse_filter.describe()}）で {result['skipped_slips']} 伝票を除外しました")
+                                    # 解析成功の末尾で必ず登録
+                                    st.session_state.processed_files.add(file_hash)
+
+                            # 解析済みの分は都度セッションに保存（途中で再実行されても、終わったファイルは編集タブに残る）
+                            st.session_state.parsed_records = records
+                            ingest_progress.progress(done / ingest_total,
+                                                     text=f"解析中... {done}/{ingest_total}件（{time.perf_counter() - ingest_started:.1f}秒）")
+                        ingest_elapsed = time.perf_counter() - ingest_started
+                        ingest_progress.progress(1.0, text=f"⏱ {ingest_total}ファイルを {ingest_elapsed:.1f}秒で解析しました"
+                                                           f"（各ファイルの解析時間の合計 {ingest_seconds:.1f}秒"
+                                                           + (f"・{process_workers}プロセス" if process_workers > 1 else "") + "）")
                 else:
                     st.info("📝 すべてのファイルが既に解析済みです。新しいファイルをアップロードしてください。")
             
@@ -2344,7 +2449,12 @@ if st.session_state.get("authentication_status"):
         # ファイルアップロード時は自動DB保存しない（Excelダウンロード時に保存）
         # データは画面表示のみで、DB保存は明示的な操作（Excelダウンロード）時のみ実行
 
-    with tab2:
+    # タブ2〜4はフラグメント：タブ内の操作ではそのタブだけが再実行される（解析・他タブの読み取りは走らない）
+    # タブ1（アップロード/解析）は結果がタブ2に流れるため、従来どおりスクリプト全体で実行する
+    @st.fragment
+    def render_tab2():
+        # 解析結果（タブ1で session_state に保存済み）
+        records = st.session_state.parsed_records
         # レコードが存在する場合（空でも表示）
         if records:        
             df = pd.DataFrame(records)
@@ -2384,155 +2494,48 @@ if st.session_state.get("authentication_status"):
 
             edited_df["数量"] = pd.to_numeric(edited_df["数量"], errors="coerce").fillna(0)
 
-            # OpenAIクライアントを取得
-            try:
-                # 注文一覧シートのソート（非商品は末尾に残す）
-                df_sorted = sort_by_simple_order(
-                    edited_df,
-                    drop_non_product=False,        # 注文一覧は非商品も末尾に残す
-                    secondary_keys=["納品日", "発注日"]
-                )
-                
-                # 集計結果シートの作成（新しい厳格集計関数を使用）
-                df_agg = build_aggregate_for_output(df_sorted)
-            except Exception as e:
-                # エラー時は新しいシンプルソートを使用
-                st.warning(f"ソート処理でエラーが発生しました。シンプルソートを使用します: {e}")
-                df_sorted = sort_by_simple_order(
-                    edited_df,
-                    drop_non_product=False,        # 注文一覧は非商品も末尾に残す
-                    secondary_keys=["納品日", "発注日"]
-                )
-                df_agg = (
-                    df_sorted
-                    .groupby(["商品名", "サイズ", "備考", "単位"], dropna=False, as_index=False)
-                    .agg({"数量": "sum"})
-                )
-                df_agg = df_agg[["商品名", "数量", "単位", "サイズ", "備考"]]
-                df_agg = sort_by_simple_order(
-                    df_agg,
-                    drop_non_product=True,         # 集計は非商品を除外
-                    secondary_keys=None
-                )
-                
-                # 数量整合チェック（エラー時の場合）
-                check_df = check_quantity_integrity(df_before=edited_df, df_after=df_agg, qty_col="数量")
-                
-                # Streamlitの通知（エラー時のみ表示）
-                if not check_df.empty and check_df.iloc[0]["結果"] == "NG":
-                    st.error("⚠️ 数量の総和に差異があります。Excelの 'CHECK_数量整合性' シートを確認してください。")
-            output = io.BytesIO()
             jst = pytz.timezone("Asia/Tokyo")
             now_str = datetime.now(jst).strftime("%y%m%d_%H%M")
 
-            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                workbook = writer.book
-                header_format = workbook.add_format({'bold': False, 'border': 0})
-                
-                # 罫線フォーマット（薄い黒 RGB:50,50,50）
-                border_format = workbook.add_format({
-                    'border': 1,
-                    'border_color': '#323232'  # RGB(50,50,50)を16進数で
-                })
-
-                # ▼ 注文一覧シート
-                sheet1 = "注文一覧"
-                edited_df.to_excel(writer, index=False, sheet_name=sheet1, startrow=1, header=False)
-                worksheet1 = writer.sheets[sheet1]
-                for col_num, value in enumerate(edited_df.columns.values):
-                    worksheet1.write(0, col_num, value, header_format)
-
-                # ▼ 注文一覧(層別結果)シート
-                sheet2 = "注文一覧(層別結果)"
-                df_sorted.to_excel(writer, index=False, sheet_name=sheet2, startrow=1, header=False)
-                worksheet2 = writer.sheets[sheet2]
-                for col_num, value in enumerate(df_sorted.columns.values):
-                    worksheet2.write(0, col_num, value, header_format)
-
-                # ▼ 集計結果シート
-                sheet3 = "集計結果"
-                df_agg.to_excel(writer, index=False, sheet_name=sheet3, startrow=1, header=False)
-                worksheet3 = writer.sheets[sheet3]
-                for col_num, value in enumerate(df_agg.columns.values):
-                    worksheet3.write(0, col_num, value, header_format)
-                
-
-                # ヘルパー：列名からピクセルで幅を設定（古いXlsxWriterなら文字幅換算）
-                def _set_px(ws, name_to_idx: dict, col_label: str, px: int):
-                    if col_label not in name_to_idx:
-                        return
-                    c = name_to_idx[col_label]
-                    try:
-                        ws.set_column_pixels(c, c, px)        # ぴったりピクセル指定（推奨）
-                    except AttributeError:
-                        ws.set_column(c, c, round((px - 5) / 7, 2))  # フォールバック：概算（px→文字幅）
-
-                # ヘルパー：表全体に罫線を適用
-                def _apply_borders(ws, df, start_row=0):
-                    """データフレームの範囲に罫線を適用"""
-                    if df.empty:
-                        return
-                    # データの範囲を取得（ヘッダー行 + データ行）
-                    end_row = start_row + len(df)
-                    end_col = len(df.columns) - 1
-                    # 罫線を適用
-                    ws.conditional_format(start_row, 0, end_row, end_col, {
-                        'type': 'cell',
-                        'criteria': '>=',
-                        'value': 0,
-                        'format': border_format
-                    })
-
-                # === 列幅設定 ===
-                # 注文一覧
-                cols1 = list(edited_df.columns)
-                idx1  = {v: i for i, v in enumerate(cols1)}
-                _set_px(worksheet1, idx1, "発注日", 105)
-                _set_px(worksheet1, idx1, "納品日", 105)
-                _set_px(worksheet1, idx1, "商品名", 244)
-                _set_px(worksheet1, idx1, "備考",   244)
-
-                # 注文一覧(層別結果)
-                cols2 = list(df_sorted.columns)
-                idx2  = {v: i for i, v in enumerate(cols2)}
-                _set_px(worksheet2, idx2, "発注日", 105)
-                _set_px(worksheet2, idx2, "納品日", 105)
-                _set_px(worksheet2, idx2, "商品名", 244)
-                _set_px(worksheet2, idx2, "備考",   244)
-
-                # 集計結果（このシートは 発注日/納品日 が無い想定）
-                cols3 = list(df_agg.columns)
-                idx3  = {v: i for i, v in enumerate(cols3)}
-                _set_px(worksheet3, idx3, "商品名", 244)
-                _set_px(worksheet3, idx3, "備考",   244)
-
-                # === 罫線適用 ===
-                _apply_borders(worksheet1, edited_df, 0)    # 注文一覧
-                _apply_borders(worksheet2, df_sorted, 0)    # 注文一覧(層別結果)
-                _apply_borders(worksheet3, df_agg, 0)       # 集計結果
-
-                # === 印刷設定（複数ページ対応） ===
-                for ws in (worksheet1, worksheet2, worksheet3):
-                    ws.set_landscape()     # 横向き
-                    ws.set_paper(9)        # A4
-                    # 横1ページ・縦は複数ページ可（最後の行が途切れないように）
-                    ws.fit_to_pages(1, None)  # 横1ページ・縦は制限なし
-                    ws.set_margins(left=0.3, right=0.3, top=0.5, bottom=0.5)
-                    ws.repeat_rows(0, 0)   # 1行目（見出し）を各ページに繰り返し
+            def _sort_and_aggregate(edited_df):
+                """層別結果・集計結果シート用のソートと集計（Excel作成時のみ実行）"""
+                try:
+                    # 注文一覧シートのソート（非商品は末尾に残す）
+                    df_sorted = sort_by_simple_order(
+                        edited_df,
+                        drop_non_product=False,        # 注文一覧は非商品も末尾に残す
+                        secondary_keys=["納品日", "発注日"]
+                    )
                     
-                    # 印刷品質を向上させる設定（メソッドが存在する場合のみ）
-                    try:
-                        ws.set_print_quality(600)  # 高品質印刷
-                    except AttributeError:
-                        pass  # メソッドが存在しない場合はスキップ
+                    # 集計結果シートの作成（新しい厳格集計関数を使用）
+                    df_agg = build_aggregate_for_output(df_sorted)
+                except Exception as e:
+                    # エラー時は新しいシンプルソートを使用
+                    st.warning(f"ソート処理でエラーが発生しました。シンプルソートを使用します: {e}")
+                    df_sorted = sort_by_simple_order(
+                        edited_df,
+                        drop_non_product=False,        # 注文一覧は非商品も末尾に残す
+                        secondary_keys=["納品日", "発注日"]
+                    )
+                    df_agg = (
+                        df_sorted
+                        .groupby(["商品名", "サイズ", "備考", "単位"], dropna=False, as_index=False)
+                        .agg({"数量": "sum"})
+                    )
+                    df_agg = df_agg[["商品名", "数量", "単位", "サイズ", "備考"]]
+                    df_agg = sort_by_simple_order(
+                        df_agg,
+                        drop_non_product=True,         # 集計は非商品を除外
+                        secondary_keys=None
+                    )
                     
-                    try:
-                        ws.set_h_pagebreaks([])    # 水平改ページをクリア
-                        ws.set_v_pagebreaks([])    # 垂直改ページをクリア
-                    except AttributeError:
-                        pass  # メソッドが存在しない場合はスキップ
-
-            output.seek(0)
+                    # 数量整合チェック（エラー時の場合）
+                    check_df = check_quantity_integrity(df_before=edited_df, df_after=df_agg, qty_col="数量")
+                    
+                    # Streamlitの通知（エラー時のみ表示）
+                    if not check_df.empty and check_df.iloc[0]["結果"] == "NG":
+                        st.error("⚠️ 数量の総和に差異があります。Excelの 'CHECK_数量整合性' シートを確認してください。")
+                return df_sorted, df_agg
             
             # 編集タブでExcel出力時にDB保存（Excelダウンロードボタンが押された時のみ）
             # 注意: この部分はExcelダウンロードボタンのクリック時にのみ実行される
@@ -2541,17 +2544,35 @@ if st.session_state.get("authentication_status"):
             col1, col2 = st.columns([3, 1])
             
             with col1:
-                downloaded = st.download_button(
-                    label="Excelをダウンロード",
-                    data=output,
-                    file_name=f"{now_str}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    key="download_excel_btn"
-                )
+                # Excelは「作成」ボタン押下時のみ生成（編集のたびには作らない）。作成後に表が編集されたら作り直す
+                order_source = frame_digest(edited_df)
+                order_excel = st.session_state.get("order_excel")
+                if order_excel and order_excel["source"] != order_source:
+                    order_excel = None
                 
-                # ダウンロード完了時の通知のみ（履歴自動移行は無効化）
-                if downloaded:
-                    st.success("Excelファイルをダウンロードしました")
+                if st.button("📊 Excelを作成", key="build_order_excel", disabled=order_excel is not None):
+                    with st.spinner("Excelを作成中..."):
+                        df_sorted, df_agg = _sort_and_aggregate(edited_df)
+                        data, stats = order_workbook(edited_df, df_sorted, df_agg)
+                    order_excel = {"source": order_source, "data": data, "file_name": f"{now_str}.xlsx",
+                                   "cached": stats["cached"], "seconds": stats["timings"][-1][1]}
+                    st.session_state.order_excel = order_excel
+                
+                if order_excel:
+                    downloaded = st.download_button(
+                        label="Excelをダウンロード",
+                        data=order_excel["data"],
+                        file_name=order_excel["file_name"],
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        key="download_excel_btn"
+                    )
+                    
+                    # ダウンロード完了時の通知のみ（履歴自動移行は無効化）
+                    if downloaded:
+                        st.success("Excelファイルをダウンロードしました")
+                    st.caption(f"作成 {order_excel['seconds']:.2f}秒" + ("（作成済みのブックを再利用）" if order_excel["cached"] else ""))
+                else:
+                    st.caption("表の内容でExcelを作成してからダウンロードできます")
             
             with col2:
                 # 履歴に移行するボタン
@@ -2575,6 +2596,9 @@ if st.session_state.get("authentication_status"):
                         st.session_state.data_edited = False
                         st.session_state.processed_files = set()
                         st.session_state.pop("editor", None)   # Data Editorの保持値を破棄
+                        st.session_state.pop("history_export", None)  # 履歴タブのエクスポートを作り直す
+                        st.session_state.pop("order_excel", None)
+                        st.session_state.pop("org_excel", None)
 
                         st.rerun()  # ← これが無いと同一表示が残って見える
                     except Exception as e:
@@ -2651,8 +2675,13 @@ if st.session_state.get("authentication_status"):
         else:
             st.info("注文ファイルをアップロードしてください")
     
-    with tab3:
+    with tab2:
+        render_tab2()
+
+    @st.fragment
+    def render_tab3():
         st.subheader("🕘 保存済みデータ履歴")
+        history_version = get_data_version()
         
         # --- 削除用セッション状態 ---
         if "pending_delete_ids" not in st.session_state:
@@ -2665,59 +2694,84 @@ if st.session_state.get("authentication_status"):
         if "confirm_delete_batch" not in st.session_state:
             st.session_state.confirm_delete_batch = False
         
-        # 自分のデータのみを取得
-        init_db()
-        with _conn() as c:
-            cur = c.execute("""
-            SELECT
-                id,
-                order_id     AS '伝票番号',
-                order_date   AS '発注日',
-                delivery_date AS '納品日',
-                partner_name AS '取引先名',
-                product_code AS '商品コード',
-                product_name AS '商品名',
-                size         AS 'サイズ',
-                quantity     AS '数量',
-                unit         AS '単位',
-                unit_price   AS '単価',
-                amount       AS '金額',
-                remark       AS '備考',
-                data_source  AS 'データ元',
-                batch_id     AS 'バッチID',
-                created_at   AS '登録日時',
-                account_name AS '登録アカウント'
-            FROM order_lines
-            WHERE account_email = ?
-            ORDER BY created_at DESC
-            """, (username,))
-            rows = cur.fetchall()
-            cols = [d[0] for d in cur.description]
-        
-        if not rows:
-            st.info("保存済みのデータはまだありません。")
+        # --- キーワード検索・絞り込み（SQL側で絞り込み・件数計算、ページ送りはキーセット） ---
+        h_search = st.text_input(
+            "🔎 キーワード検索",
+            placeholder="例: 銀座着 / 玉レタス ○○商店（スペース区切りですべてを含む行）",
+            help="商品名・備考・取引先名・伝票番号を検索し、関連度の高い順に表示します",
+            key="history_search"
+        )
+        with st.expander("🔍 絞り込み", expanded=False):
+            fcol1, fcol2, fcol3 = st.columns(3)
+            with fcol1:
+                h_date_type = st.radio("日付の種類", ["登録日時", "発注日", "納品日"], horizontal=True,
+                                       key="history_date_type")
+            with fcol2:
+                h_from = st.date_input("開始日", value=None, format="YYYY-MM-DD", key="history_from")
+            with fcol3:
+                h_to = st.date_input("終了日", value=None, format="YYYY-MM-DD", key="history_to")
+            fcol4, fcol5, fcol6 = st.columns(3)
+            with fcol4:
+                h_partner = st.selectbox("取引先", ["（すべて）"] + cached_history_query("partners", history_version, username),
+                                         key="history_partner")
+            with fcol5:
+                h_product = st.text_input("商品名（部分一致）", key="history_product")
+            with fcol6:
+                h_batch = st.selectbox("バッチ", ["（すべて）"] + [b[0] for b in cached_history_query("batches", history_version, username)],
+                                       key="history_batch")
+        history_filters = {
+            "date_type": {"発注日": "order", "納品日": "delivery"}.get(h_date_type, "created"),
+            "day_from": int(h_from.strftime("%Y%m%d")) if h_from else None,
+            "day_to": int(h_to.strftime("%Y%m%d")) if h_to else None,
+            "partner": h_partner if h_partner != "（すべて）" else None,
+            "product": h_product.strip() or None,
+            "batch_id": h_batch if h_batch != "（すべて）" else None,
+            "search": h_search.strip() or None,
+        }
+        is_filtered = any(v for k, v in history_filters.items() if k != "date_type")
+        page_size = st.session_state.get("history_page_size", 100)
+
+        # 条件やページ行数が変わったら1ページ目に戻す
+        filter_sig = json.dumps([history_filters, page_size], sort_keys=True)
+        if st.session_state.get("history_filter_sig") != filter_sig:
+            st.session_state.history_filter_sig = filter_sig
+            st.session_state.history_cursors = [None]  # 各ページの直前の行の (登録日時, id)
+
+        history_stats = cached_history_query("count", history_version, username, history_filters)
+
+        if history_stats["rows"] == 0:
+            st.info("条件に一致するデータがありません。" if is_filtered else "保存済みのデータはまだありません。")
         else:
-            df_all = pd.DataFrame(rows, columns=cols)
+            cursors = st.session_state.history_cursors
+            page_no = len(cursors)
+            total_pages = max(1, -(-history_stats["rows"] // page_size))
+            page_start = (page_no - 1) * page_size
+            if history_filters["search"]:
+                # 検索結果は関連度順のためページ番号で取得
+                df_page = cached_history_query("search", history_version, username, history_filters,
+                                                offset=page_start, limit=page_size)
+            else:
+                df_page = cached_history_query("page", history_version, username, history_filters,
+                                                after=cursors[-1], limit=page_size)
+            next_cursor = (df_page['登録日時'].iloc[-1], int(df_page['id'].iloc[-1])) if not df_page.empty else None
             
             # 登録日時の表示形式を修正（2025-09-15T07:27:18 → 2025/09/15）
-            if '登録日時' in df_all.columns:
-                df_all['登録日時'] = df_all['登録日時'].apply(
-                    lambda x: x.split('T')[0].replace('-', '/') if x and 'T' in str(x) else x
-                )
+            def _format_created(x):
+                return x.split('T')[0].replace('-', '/') if x and 'T' in str(x) else x
+            df_page['登録日時'] = df_page['登録日時'].apply(_format_created)
             
-            # 統計情報
+            # 統計情報（絞り込み結果全体をSQLで集計）
             col1, col2, col3 = st.columns(3)
             with col1:
-                st.metric("総データ行数", len(df_all))
+                st.metric("検索結果" if history_filters["search"] else "該当データ行数" if is_filtered else "総データ行数",
+                          history_stats["rows"])
             with col2:
-                unique_batches = df_all['バッチID'].nunique()
-                st.metric("総バッチ数", unique_batches)
+                st.metric("バッチ数" if is_filtered else "総バッチ数", history_stats["batches"])
             with col3:
-                latest_date = df_all['登録日時'].iloc[0] if not df_all.empty else "なし"
-                st.metric("最新登録", latest_date)
+                st.metric("最新登録", _format_created(history_stats["latest"]) or "なし")
             
             # データ表示（編集不可、ID列は非表示、登録アカウント列を右端に配置）
-            df_display = df_all.drop('id', axis=1)  # ID列を非表示
+            df_display = df_page.drop('id', axis=1)  # ID列を非表示
             
             # 登録アカウント列を右端に配置
             if '登録アカウント' in df_display.columns:
@@ -2726,45 +2780,60 @@ if st.session_state.get("authentication_status"):
             
             st.dataframe(df_display, use_container_width=True, hide_index=True)
 
+            # ページ送り
+            nav1, nav2, nav3, nav4 = st.columns([1, 3, 1, 1])
+            with nav1:
+                if st.button("◀ 前へ", disabled=page_no == 1, key="history_prev"):
+                    cursors.pop()
+                    rerun_fragment()
+            with nav2:
+                st.caption(f"{page_no} / {total_pages} ページ"
+                           f"（{page_start + 1}〜{page_start + len(df_page)}行目 / {history_stats['rows']}行）")
+            with nav3:
+                if st.button("次へ ▶", disabled=page_no >= total_pages or next_cursor is None, key="history_next"):
+                    cursors.append(next_cursor)
+                    rerun_fragment()
+            with nav4:
+                st.selectbox("表示行数", [50, 100, 200, 500], index=1, key="history_page_size",
+                             label_visibility="collapsed")
+
             # 行削除機能
             st.subheader("🗑️ データ削除")
             
-            # 削除する行の選択（連番表示）
-            if not df_all.empty:
-                # 連番で表示するためのformat_func
-                def format_row_option(row_id):
-                    try:
-                        row_data = df_all[df_all['id'] == row_id]
-                        if not row_data.empty:
-                            product_name = str(row_data['商品名'].iloc[0]) if pd.notna(row_data['商品名'].iloc[0]) else "商品名なし"
-                            partner_name = str(row_data['取引先名'].iloc[0]) if pd.notna(row_data['取引先名'].iloc[0]) else "取引先名なし"
-                            batch_id = str(row_data['バッチID'].iloc[0]) if pd.notna(row_data['バッチID'].iloc[0]) else "バッチIDなし"
-                            # 連番を取得（IDの順序で連番を付与）
-                            row_index = df_all[df_all['id'] == row_id].index[0] + 1
-                            return f"{batch_id}_{row_index}: {product_name} - {partner_name}"
-                        else:
-                            return f"ID {row_id}: データなし"
-                    except Exception:
-                        return f"ID {row_id}: エラー"
+            delete_scope_page = "このページで選択した行"
+            delete_scope = st.radio(
+                "削除の対象",
+                [delete_scope_page, f"絞り込み結果すべて（{history_stats['rows']}行）"],
+                horizontal=True,
+                key="history_delete_scope"
+            )
+            if delete_scope == delete_scope_page:
+                # 表示中のページの行だけを選択肢にする（ラベルは1回だけ作成）
+                row_labels = {}
+                for i, (row_id, product_name, partner_name, batch_id) in enumerate(
+                        zip(df_page['id'], df_page['商品名'], df_page['取引先名'], df_page['バッチID'])):
+                    product_name = str(product_name) if pd.notna(product_name) else "商品名なし"
+                    partner_name = str(partner_name) if pd.notna(partner_name) else "取引先名なし"
+                    batch_id = str(batch_id) if pd.notna(batch_id) else "バッチIDなし"
+                    row_labels[int(row_id)] = f"{batch_id}_{page_start + i + 1}: {product_name} - {partner_name}"
                 
                 selected_ids = st.multiselect(
                     "削除する行を選択",
-                    options=df_all['id'].tolist(),
-                    format_func=format_row_option,
-                    help="削除したい行のIDを選択してください",
+                    options=list(row_labels),
+                    format_func=lambda row_id: row_labels.get(row_id, f"ID {row_id}"),
+                    help="削除したい行を選択してください（表示中のページのみ）",
                     key="row_delete_picker"
                 )
             else:
-                selected_ids = []
-                st.info("削除可能なデータがありません")
+                selected_ids = cached_history_query("ids", history_version, username, history_filters)
 
             st.write(f"選択中: {len(selected_ids)} 行")
 
             # 1回目: 削除対象を保存してrerun
             if st.button("選択した行を削除", type="secondary", disabled=len(selected_ids)==0):
-                st.session_state.pending_delete_ids = selected_ids.copy()
+                st.session_state.pending_delete_ids = list(selected_ids)
                 st.session_state.confirm_delete_rows = True
-                st.rerun()
+                rerun_fragment()
 
             # 2回目: 確認フェーズを表示
             if st.session_state.confirm_delete_rows:
@@ -2777,17 +2846,16 @@ if st.session_state.get("authentication_status"):
                 # ボタンを縦並びに配置
                 if st.button("確認して削除", type="primary", key="confirm_delete_rows_go"):
                     try:
-                        deleted_count = 0
-                        with _conn() as c:
-                            c.executemany("DELETE FROM order_lines WHERE id = ?", [(i,) for i in ids])
-                            deleted_count = c.execute("SELECT changes()").fetchone()[0]  # sqliteの変更件数確認
+                        deleted_count = delete_order_lines(ids)  # ロールアップも同じトランザクションで減算
                         st.success(f"✅ {deleted_count} 行を削除しました")
                     except Exception as e:
                         st.error(f"削除エラー: {e}")
                     finally:
                         st.session_state.confirm_delete_rows = False
                         st.session_state.pending_delete_ids = []
-                        st.rerun()
+                        st.session_state.pop("history_export", None)  # 作成済みのエクスポートは古くなる
+                        st.session_state.pop("org_excel", None)  # 組織内集計のExcelも作り直す
+                        rerun_fragment()
                 
                 if st.button("キャンセル", key="cancel_delete_rows"):
                     st.session_state.confirm_delete_rows = False
@@ -2797,20 +2865,14 @@ if st.session_state.get("authentication_status"):
             # バッチ単位での削除
             st.subheader("🗑️ バッチ単位削除")
             
-            # バッチ選択（連番表示）
-            unique_batches = df_all['バッチID'].unique()
-            if len(unique_batches) > 0:
-                # 連番で表示するためのformat_func
-                def format_batch_option(batch_id):
-                    row_count = len(df_all[df_all['バッチID'] == batch_id])
-                    # バッチの順序で連番を付与
-                    batch_index = list(unique_batches).index(batch_id) + 1
-                    return f"{batch_id}_{batch_index}（{row_count}行）"
-                
+            # バッチ選択（連番表示、行数はSQLで集計）
+            batch_summary = cached_history_query("batches", history_version, username, history_filters)
+            batch_labels = {b: f"{b}_{i}（{n}行）" for i, (b, n, _) in enumerate(batch_summary, 1)}
+            if batch_labels:
                 selected_batch = st.selectbox(
                     "削除するバッチを選択",
-                    options=unique_batches,
-                    format_func=format_batch_option,
+                    options=list(batch_labels),
+                    format_func=batch_labels.get,
                     key="batch_delete_picker"
                 )
 
@@ -2819,12 +2881,12 @@ if st.session_state.get("authentication_status"):
                 if st.button("選択したバッチを削除", type="secondary", disabled=selected_batch is None):
                     st.session_state.pending_delete_batch = selected_batch
                     st.session_state.confirm_delete_batch = True
-                    st.rerun()
+                    rerun_fragment()
 
                 # 確認フェーズ
                 if st.session_state.confirm_delete_batch:
                     b = st.session_state.pending_delete_batch
-                    cnt = len(df_all[df_all['バッチID'] == b])
+                    cnt = cached_history_query("count", history_version, username, {"batch_id": b})["rows"]
                     # 黄色枠の幅を狭める
                     col_warning, col_empty = st.columns([2, 1])
                     with col_warning:
@@ -2833,18 +2895,16 @@ if st.session_state.get("authentication_status"):
                     # ボタンを縦並びに配置
                     if st.button("確認してバッチ削除", type="primary", key="confirm_delete_batch_go"):
                         try:
-                            with _conn() as c:
-                                c.execute("DELETE FROM order_lines WHERE batch_id = ?", (b,))
-                                c.execute("DELETE FROM batches WHERE batch_id = ?", (b,))
-                                # 念のため件数チェック
-                                remain = c.execute("SELECT COUNT(*) FROM order_lines WHERE batch_id = ?", (b,)).fetchone()[0]
-                            st.success(f"✅ バッチ '{b}' を削除しました（{cnt}→残{remain}行）")
+                            deleted = delete_batch(b)  # ロールアップも同じトランザクションで減算
+                            st.success(f"✅ バッチ '{b}' を削除しました（{cnt}→削除{deleted}行）")
                         except Exception as e:
                             st.error(f"バッチ削除エラー: {e}")
                         finally:
                             st.session_state.confirm_delete_batch = False
                             st.session_state.pending_delete_batch = None
-                            st.rerun()
+                            st.session_state.pop("history_export", None)
+                            st.session_state.pop("org_excel", None)  # 組織内集計のExcelも作り直す
+                            rerun_fragment()
                     
                     if st.button("キャンセル", key="cancel_delete_batch"):
                         st.session_state.confirm_delete_batch = False
@@ -2853,82 +2913,39 @@ if st.session_state.get("authentication_status"):
             else:
                 st.info("削除可能なバッチがありません")
 
-            # 全履歴Excelをダウンロード
-            jst = pytz.timezone("Asia/Tokyo")
-            now_str = datetime.now(jst).strftime("%y%m%d_%H%M")
-            
-            # Excel生成（日本語列名のまま使用）
-            output_all = io.BytesIO()
-            with pd.ExcelWriter(output_all, engine='xlsxwriter') as writer:
-                workbook = writer.book
-                header_format = workbook.add_format({'bold': False, 'border': 0})
-                
-                # 罫線フォーマット（薄い黒 RGB:50,50,50）
-                border_format = workbook.add_format({
-                    'border': 1,
-                    'border_color': '#323232'  # RGB(50,50,50)を16進数で
-                })
-                
-                # 注文一覧シート
-                df_all.to_excel(writer, index=False, sheet_name="全注文履歴", startrow=1, header=False)
-                worksheet = writer.sheets["全注文履歴"]
-                for col_num, value in enumerate(df_all.columns.values):
-                    worksheet.write(0, col_num, value, header_format)
-
-                # ヘルパー：列名からピクセルで幅を設定（古いXlsxWriterなら文字幅換算）
-                def _set_px(ws, name_to_idx: dict, col_label: str, px: int):
+            # 履歴のエクスポート（ボタンを押したときだけ、SQLiteからチャンク単位で一時ファイルに書き出す）
+            st.subheader("📥 履歴のエクスポート")
+            ecol1, ecol2, ecol3 = st.columns([1, 1, 1])
+            with ecol1:
+                export_fmt = st.selectbox("形式", list(EXPORT_FORMATS), format_func=lambda f: EXPORT_FORMATS[f][0],
+                                          key="history_export_fmt")
+            with ecol2:
+                export_scope = st.radio("範囲", ["全履歴", "絞り込み・検索結果"], horizontal=True,
+                                        key="history_export_scope", disabled=not is_filtered)
+            with ecol3:
+                if st.button("📊 エクスポートを作成", key="build_all_history"):
+                    scope_filters = history_filters if is_filtered and export_scope != "全履歴" else None
                     try:
-                        c = name_to_idx[col_label]
-                        try:
-                            ws.set_column_pixels(c, c, px)
-                        except AttributeError:
-                            ws.set_column(c, c, round((px - 5) / 7, 2))
-                    except KeyError:
-                        pass
-
-                # ヘルパー：表全体に罫線を適用
-                def _apply_borders(ws, df, start_row=0):
-                    """データフレームの範囲に罫線を適用"""
-                    if df.empty:
-                        return
-                    # データの範囲を取得（ヘッダー行 + データ行）
-                    end_row = start_row + len(df)
-                    end_col = len(df.columns) - 1
-                    # 罫線を適用
-                    ws.conditional_format(start_row, 0, end_row, end_col, {
-                        'type': 'cell',
-                        'criteria': '>=',
-                        'value': 0,
-                        'format': border_format
-                    })
-
-                colsH = list(df_all.columns)
-                idxH  = {v: i for i, v in enumerate(colsH)}
-                wsH   = worksheet  # 既存の "全注文履歴" ワークシート
-
-                _set_px(wsH, idxH, "発注日", 105)
-                _set_px(wsH, idxH, "納品日", 105)
-                _set_px(wsH, idxH, "商品名", 244)
-                _set_px(wsH, idxH, "備考",   244)
-
-                # === 罫線適用 ===
-                _apply_borders(wsH, df_all, 0)  # 全注文履歴
-
-                wsH.set_landscape()
-                wsH.set_paper(9)
-                wsH.fit_to_pages(1, 0)
-                wsH.set_margins(left=0.3, right=0.3, top=0.5, bottom=0.5)
-                wsH.repeat_rows(0, 0)
-            
-            output_all.seek(0)
-            
-            st.download_button(
-                label="全履歴Excelをダウンロード",
-                data=output_all,
-                file_name=f"全注文履歴_{now_str}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                key="download_all_history"
-            )
+                        with st.spinner("エクスポートを作成中..."):
+                            result = export_history(username, export_fmt, scope_filters)
+                        jst = pytz.timezone("Asia/Tokyo")
+                        result["file_name"] = f"全注文履歴_{datetime.now(jst).strftime('%y%m%d_%H%M')}.{export_fmt}"
+                        st.session_state.history_export = result
+                    except Exception as e:
+                        st.error(f"エクスポートエラー: {e}")
+            
+            history_export_result = st.session_state.get("history_export")
+            if history_export_result and os.path.exists(history_export_result["path"]):
+                st.caption(f"{history_export_result['rows']:,}行 / {history_export_result['bytes'] / 1024 / 1024:.1f}MB "
+                           f"（作成 {history_export_result['seconds']:.1f}秒）")
+                with open(history_export_result["path"], "rb") as f:
+                    st.download_button(
+                        label=f"{history_export_result['file_name']} をダウンロード",
+                        data=f,
+                        file_name=history_export_result["file_name"],
+                        mime=history_export_result["mime"],
+                        key="download_all_history"
+                    )
             
             # 全データ削除機能
             st.markdown("---")
@@ -2942,56 +2959,44 @@ if st.session_state.get("authentication_status"):
                 with col1:
                     if st.button("🗑️ 全データ削除", type="secondary", key="delete_all_btn"):
                         st.session_state.confirm_delete_all = True
-                        st.rerun()
+                        rerun_fragment()
                 with col2:
                     st.info("全注文データと全バッチ情報を削除します")
             else:
                 st.error("⚠️ **最終確認**: 本当に全てのデータを削除しますか？")
-                st.warning(f"削除対象: {len(df_all)}行の注文データ + {unique_batches}個のバッチ")
+                total_stats = cached_history_query("count", history_version, username)
+                st.warning(f"削除対象: {total_stats['rows']}行の注文データ + {total_stats['batches']}個のバッチ")
                 
                 col1, col2, col3 = st.columns([1, 1, 2])
                 with col1:
                     if st.button("✅ 削除実行", type="primary", key="confirm_delete_all_btn"):
                         try:
-                            with _conn() as c:
-                                # トランザクションで安全に削除
-                                c.execute("BEGIN TRANSACTION")
-                                try:
-                                    # 全注文データを削除
-                                    c.execute("DELETE FROM order_lines")
-                                    deleted_rows = c.rowcount
-                                    
-                                    # 全バッチ情報を削除
-                                    c.execute("DELETE FROM batches")
-                                    deleted_batches = c.rowcount
-                                    
-                                    # コミット
-                                    c.execute("COMMIT")
-                                    
-                                    st.success(f"✅ 全データを削除しました（{deleted_rows}行の注文データ + {deleted_batches}個のバッチ）")
-                                    st.info("ページを再読み込みして最新状態を確認してください。")
-                                    
-                                except Exception as e:
-                                    # エラー時はロールバック
-                                    c.execute("ROLLBACK")
-                                    raise e
-                                    
+                            # 注文データ・バッチ情報・集計ロールアップを1トランザクションで削除
+                            deleted_rows, deleted_batches = delete_all_order_lines()
+                            st.success(f"✅ 全データを削除しました（{deleted_rows}行の注文データ + {deleted_batches}個のバッチ）")
+                            st.info("ページを再読み込みして最新状態を確認してください。")
                         except Exception as e:
                             st.error(f"削除エラー: {e}")
                         finally:
                             st.session_state.confirm_delete_all = False
-                            st.rerun()
+                            st.session_state.pop("history_export", None)
+                            st.session_state.pop("org_excel", None)  # 組織内集計のExcelも作り直す
+                            rerun_fragment()
                 
                 with col2:
                     if st.button("❌ キャンセル", key="cancel_delete_all_btn"):
                         st.session_state.confirm_delete_all = False
                         st.info("削除をキャンセルしました")
-                        st.rerun()
+                        rerun_fragment()
                 
                 with col3:
                     st.info("この操作は取り消せません")
 
-    with tab4:
+    with tab3:
+        render_tab3()
+
+    @st.fragment
+    def render_tab4():
         st.subheader("🏢 組織内集計（会社単位）")
         
         # ログイン情報を取得
@@ -3020,250 +3025,83 @@ if st.session_state.get("authentication_status"):
             with col2:
                 dto = st.date_input("終了日", value=None, format="YYYY-MM-DD")
             
-            # 期間条件を組み立て
-            where = ["company = ?"]
-            params = [company]
-            
-            if date_type == "発注日":
-                date_column = "order_date"
-            elif date_type == "納品日":
-                date_column = "delivery_date"
-            else:  # 登録日時
-                date_column = "created_at"
-            
-            if dfrom:
-                if date_type == "登録日時":
-                    where.append(f"{date_column} >= ?")
-                    params.append(f"{str(dfrom)}T00:00:00")
-                else:
-                    # 発注日・納品日はYYYY/MM/DD形式で保存されているため、スラッシュ形式に変換
-                    where.append(f"{date_column} >= ?")
-                    params.append(str(dfrom).replace('-', '/'))
-            
-            if dto:
-                if date_type == "登録日時":
-                    where.append(f"{date_column} <= ?")
-                    params.append(f"{str(dto)}T23:59:59")
-                else:
-                    # 発注日・納品日はYYYY/MM/DD形式で保存されているため、スラッシュ形式に変換
-                    where.append(f"{date_column} <= ?")
-                    params.append(str(dto).replace('-', '/'))
-            
-            where_sql = " AND ".join(where)
+            # 期間（YYYYMMDD）。登録日時も日単位で集計済み
+            date_type_key = {"発注日": "order", "納品日": "delivery"}.get(date_type, "created")
+            day_from = int(dfrom.strftime("%Y%m%d")) if dfrom else None
+            day_to = int(dto.strftime("%Y%m%d")) if dto else None
             
-            # データベースから集計データを取得
-            init_db()
-            with _conn() as c:
+            # 日次ロールアップ（保存・削除時に更新済み）を合計して集計
+            try:
+                # 同じ条件・同じデータ版数ならキャッシュから（商品別はソート済み）
+                df_acc, df_prd, df_ptn = cached_org_summary(company, get_data_version(), date_type_key, day_from, day_to)
+                
                 # アカウント別集計
-                q1 = f"""
-                    SELECT account_name AS 'アカウント', COUNT(*) AS '行数', 
-                           COALESCE(SUM(CAST(amount AS REAL)), 0) AS '金額合計'
-                    FROM order_lines
-                    WHERE {where_sql}
-                    GROUP BY account_name
-                    ORDER BY 金額合計 DESC
-                """
+                st.markdown("### 📊 アカウント別集計")
+                if not df_acc.empty:
+                    st.dataframe(df_acc, use_container_width=True, hide_index=True)
+                else:
+                    st.info("該当期間のデータがありません")
                 
-                # 商品別集計（サイズ含む）
-                q2 = f"""
-                    SELECT product_name AS '商品名', size AS 'サイズ', unit AS '単位',
-                           COALESCE(SUM(CAST(quantity AS REAL)), 0) AS '数量合計', 
-                           COALESCE(SUM(CAST(amount AS REAL)), 0) AS '金額合計'
-                    FROM order_lines
-                    WHERE {where_sql}
-                    GROUP BY product_name, size, unit
-                    ORDER BY 数量合計 DESC
-                """
+                # 商品別集計
+                st.markdown("### 📦 商品別集計")
+                if not df_prd.empty:
+                    st.dataframe(df_prd, use_container_width=True, hide_index=True)
+                else:
+                    st.info("該当期間のデータがありません")
                 
                 # 取引先別集計
-                q3 = f"""
-                    SELECT partner_name AS '取引先名', COUNT(*) AS '行数', 
-                           COALESCE(SUM(CAST(amount AS REAL)), 0) AS '金額合計'
-                    FROM order_lines
-                    WHERE {where_sql}
-                    GROUP BY partner_name
-                    ORDER BY 金額合計 DESC
-                """
+                st.markdown("### 🏢 取引先別集計")
+                if not df_ptn.empty:
+                    st.dataframe(df_ptn, use_container_width=True, hide_index=True)
+                else:
+                    st.info("該当期間のデータがありません")
                 
-                try:
-                    df_acc = pd.DataFrame(c.execute(q1, params).fetchall(), 
-                                        columns=['アカウント','行数','金額合計'])
-                    df_prd = pd.DataFrame(c.execute(q2, params).fetchall(), 
-                                        columns=['商品名','サイズ','単位','数量合計','金額合計'])
-                    df_ptn = pd.DataFrame(c.execute(q3, params).fetchall(), 
-                                        columns=['取引先名','行数','金額合計']                    )
-                    
-                    # 商品別集計のソート
-                    if not df_prd.empty:
-                        df_prd = sort_by_simple_order(
-                            df_prd,
-                            drop_non_product=True,         # 集計は非商品を除外
-                            secondary_keys=None
-                        )
+                # 組織内集計のExcelダウンロード
+                if not df_acc.empty or not df_prd.empty or not df_ptn.empty:
+                    st.markdown("---")
+                    st.subheader("📥 組織内集計Excelダウンロード")
                     
-                    # アカウント別集計
-                    st.markdown("### 📊 アカウント別集計")
-                    if not df_acc.empty:
-                        st.dataframe(df_acc, use_container_width=True, hide_index=True)
-                    else:
-                        st.info("該当期間のデータがありません")
+                    # Excel（検索結果・全データ）は「作成」ボタン押下時のみ生成。条件・集計が変わったら作り直す
+                    org_source = "|".join([company, date_type_key, str(day_from), str(day_to),
+                                           frame_digest(df_acc), frame_digest(df_prd), frame_digest(df_ptn)])
+                    org_excel = st.session_state.get("org_excel")
+                    if org_excel and org_excel["source"] != org_source:
+                        org_excel = None
                     
-                    # 商品別集計
-                    st.markdown("### 📦 商品別集計")
-                    if not df_prd.empty:
-                        st.dataframe(df_prd, use_container_width=True, hide_index=True)
-                    else:
-                        st.info("該当期間のデータがありません")
-                    
-                    # 取引先別集計
-                    st.markdown("### 🏢 取引先別集計")
-                    if not df_ptn.empty:
-                        st.dataframe(df_ptn, use_container_width=True, hide_index=True)
-                    else:
-                        st.info("該当期間のデータがありません")
-                    
-                    # 組織内集計のExcelダウンロード
-                    if not df_acc.empty or not df_prd.empty or not df_ptn.empty:
-                        st.markdown("---")
-                        st.subheader("📥 組織内集計Excelダウンロード")
-                        
-                        # 全データ用の集計を取得（日付フィルターなし）
-                        q1_all = f"""
-                            SELECT account_name AS 'アカウント', COUNT(*) AS '行数', 
-                                   COALESCE(SUM(CAST(amount AS REAL)), 0) AS '金額合計'
-                            FROM order_lines
-                            WHERE company = ?
-                            GROUP BY account_name
-                            ORDER BY 金額合計 DESC
-                        """
-                        
-                        q2_all = f"""
-                            SELECT product_name AS '商品名', size AS 'サイズ', unit AS '単位',
-                                   COALESCE(SUM(CAST(quantity AS REAL)), 0) AS '数量合計', 
-                                   COALESCE(SUM(CAST(amount AS REAL)), 0) AS '金額合計'
-                            FROM order_lines
-                            WHERE company = ?
-                            GROUP BY product_name, size, unit
-                            ORDER BY 数量合計 DESC
-                        """
-                        
-                        q3_all = f"""
-                            SELECT partner_name AS '取引先名', COUNT(*) AS '行数', 
-                                   COALESCE(SUM(CAST(amount AS REAL)), 0) AS '金額合計'
-                            FROM order_lines
-                            WHERE company = ?
-                            GROUP BY partner_name
-                            ORDER BY 金額合計 DESC
-                        """
-                        
-                        try:
-                            df_acc_all = pd.DataFrame(c.execute(q1_all, [company]).fetchall(), 
-                                                    columns=['アカウント','行数','金額合計'])
-                            df_prd_all = pd.DataFrame(c.execute(q2_all, [company]).fetchall(), 
-                                                    columns=['商品名','サイズ','単位','数量合計','金額合計'])
-                            df_ptn_all = pd.DataFrame(c.execute(q3_all, [company]).fetchall(), 
-                                                    columns=['取引先名','行数','金額合計'])
-                            
-                            # 全データ用の商品別集計のソート
-                            if not df_prd_all.empty:
-                                df_prd_all = sort_by_simple_order(
-                                    df_prd_all,
-                                    drop_non_product=True,         # 集計は非商品を除外
-                                    secondary_keys=None
-                                )
-                        except Exception as e:
-                            st.error(f"全データ集計の取得エラー: {e}")
-                            df_acc_all = pd.DataFrame()
-                            df_prd_all = pd.DataFrame()
-                            df_ptn_all = pd.DataFrame()
-                        
-                        # Excel生成ヘルパー関数
-                        def build_org_summary_excel(df_acc, df_prd, df_ptn, suffix=""):
-                            output = io.BytesIO()
-                            with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                                workbook = writer.book
-                                header_format = workbook.add_format({'bold': False, 'border': 0})
-                                
-                                # 罫線フォーマット
-                                border_format = workbook.add_format({
-                                    'border': 1,
-                                    'border_color': '#323232'
-                                })
-                                
-                                # 各シートに出力
-                                if not df_acc.empty:
-                                    df_acc.to_excel(writer, index=False, sheet_name="アカウント別集計", startrow=1, header=False)
-                                    worksheet1 = writer.sheets["アカウント別集計"]
-                                    for col_num, value in enumerate(df_acc.columns.values):
-                                        worksheet1.write(0, col_num, value, header_format)
-                                    
-                                    # 罫線適用
-                                    end_row = len(df_acc)
-                                    end_col = len(df_acc.columns) - 1
-                                    worksheet1.conditional_format(0, 0, end_row, end_col, {
-                                        'type': 'cell',
-                                        'criteria': '>=',
-                                        'value': 0,
-                                        'format': border_format
-                                    })
-                                
-                                if not df_prd.empty:
-                                    df_prd.to_excel(writer, index=False, sheet_name="商品別集計", startrow=1, header=False)
-                                    worksheet2 = writer.sheets["商品別集計"]
-                                    for col_num, value in enumerate(df_prd.columns.values):
-                                        worksheet2.write(0, col_num, value, header_format)
-                                    
-                                    # 罫線適用
-                                    end_row = len(df_prd)
-                                    end_col = len(df_prd.columns) - 1
-                                    worksheet2.conditional_format(0, 0, end_row, end_col, {
-                                        'type': 'cell',
-                                        'criteria': '>=',
-                                        'value': 0,
-                                        'format': border_format
-                                    })
-                                
-                                if not df_ptn.empty:
-                                    df_ptn.to_excel(writer, index=False, sheet_name="取引先別集計", startrow=1, header=False)
-                                    worksheet3 = writer.sheets["取引先別集計"]
-                                    for col_num, value in enumerate(df_ptn.columns.values):
-                                        worksheet3.write(0, col_num, value, header_format)
-                                    
-                                    # 罫線適用
-                                    end_row = len(df_ptn)
-                                    end_col = len(df_ptn.columns) - 1
-                                    worksheet3.conditional_format(0, 0, end_row, end_col, {
-                                        'type': 'cell',
-                                        'criteria': '>=',
-                                        'value': 0,
-                                        'format': border_format
-                                    })
-                                
-                                # 印刷設定
-                                for ws in [worksheet1, worksheet2, worksheet3]:
-                                    if ws:
-                                        ws.set_landscape()
-                                        ws.set_paper(9)
-                                        ws.fit_to_pages(1, 0)
-                                        ws.set_margins(left=0.3, right=0.3, top=0.5, bottom=0.5)
-                                        ws.repeat_rows(0, 0)
+                    if st.button("📊 Excelを作成", key="build_org_excel"):
+                        with st.spinner("Excelを作成中..."):
+                            # 全データ用の集計を取得（日付フィルターなし）
+                            try:
+                                df_acc_all, df_prd_all, df_ptn_all = cached_org_summary(company, get_data_version())
+                            except Exception as e:
+                                st.error(f"全データ集計の取得エラー: {e}")
+                                df_acc_all = pd.DataFrame()
+                                df_prd_all = pd.DataFrame()
+                                df_ptn_all = pd.DataFrame()
                             
-                            output.seek(0)
-                            return output
-                        
+                            jst = pytz.timezone("Asia/Tokyo")
+                            now_str = datetime.now(jst).strftime("%y%m%d_%H%M")
+                            filtered_excel, filtered_stats = org_summary_workbook(df_acc, df_prd, df_ptn)
+                            all_excel, all_stats = org_summary_workbook(df_acc_all, df_prd_all, df_ptn_all)
+                        org_excel = {
+                            "source": org_source,
+                            "filtered": filtered_excel,
+                            "all": all_excel,
+                            "now_str": now_str,
+                            "seconds": filtered_stats["timings"][-1][1] + all_stats["timings"][-1][1],
+                        }
+                        st.session_state.org_excel = org_excel
+                    
+                    if org_excel:
                         # 2つのダウンロードボタン
                         col1, col2 = st.columns(2)
                         
-                        jst = pytz.timezone("Asia/Tokyo")
-                        now_str = datetime.now(jst).strftime("%y%m%d_%H%M")
-                        
                         with col1:
                             # 検索結果のみダウンロード
-                            filtered_excel = build_org_summary_excel(df_acc, df_prd, df_ptn, "検索結果")
                             st.download_button(
                                 label="🔽 検索結果をダウンロード",
-                                data=filtered_excel,
-                                file_name=f"組織内集計_検索結果_{company}_{now_str}.xlsx",
+                                data=org_excel["filtered"],
+                                file_name=f"組織内集計_検索結果_{company}_{org_excel['now_str']}.xlsx",
                                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                 use_container_width=True,
                                 key="download_org_filtered"
@@ -3271,18 +3109,21 @@ if st.session_state.get("authentication_status"):
                         
                         with col2:
                             # 全データダウンロード
-                            all_excel = build_org_summary_excel(df_acc_all, df_prd_all, df_ptn_all, "全データ")
                             st.download_button(
                                 label="🔽 全データをダウンロード",
-                                data=all_excel,
-                                file_name=f"組織内集計_全データ_{company}_{now_str}.xlsx",
+                                data=org_excel["all"],
+                                file_name=f"組織内集計_全データ_{company}_{org_excel['now_str']}.xlsx",
                                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                                 use_container_width=True,
                                 key="download_org_all"
                             )
-                
-                except Exception as e:
-                    st.error(f"集計データの取得エラー: {e}")
+                        st.caption(f"作成 {org_excel['now_str']}（{org_excel['seconds']:.2f}秒）。その後に保存された注文を含めるには作り直してください")
+            
+            except Exception as e:
+                st.error(f"集計データの取得エラー: {e}")
+
+    with tab4:
+        render_tab4()
 
 elif st.session_state.get("authentication_status") is False:
     st.error("ユーザー名またはパスワードが正しくありません。")
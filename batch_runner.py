@@ -0,0 +1,82 @@
+# batch_runner.py
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+import time
+import logging
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+def process_context():
+    """
+    プロセスプール用の起動方式（forkserver、使えない環境では spawn）
+    Streamlitのサーバーはスレッドやロック・SQLite接続を持ったまま動いているので fork は使わない
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+def run_concurrently(func, items, max_workers=4):
+    """
+    itemsの各要素に対してfuncをスレッドプールで並列実行し、
+    完了した順に (item, result, error) を返すジェネレータ。
+    - 同時実行数は max_workers で制限（LLM APIのin-flight数の上限）
+    - 1件の失敗は error に格納して他の処理は継続（例外は外に投げない）
+    - Streamlitの描画は呼び出し側（メインスレッド）で行うこと
+    """
+    items = list(items)
+    if not items:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                logger.warning(f"[並列処理エラー] {item!r}: {e}")
+                yield item, None, e
+
+def _timed(func, *args):
+    """func(*args) の結果と所要秒数（プロセスプールから呼べるようトップレベルに置く）"""
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+def run_parallel(tasks, max_processes=0, max_threads=4):
+    """
+    tasks [(key, func, args, cpu_bound), ...] を並列実行し、
+    完了した順に (key, result, error, seconds) を返すジェネレータ。
+    - cpu_bound=True のタスク（CSV/XLSX解析等）はプロセスプールで実行（max_processes 件まで）
+      プロセスは forkserver（または spawn）で起動する（Streamlitのプロセスを fork しない）
+      max_processes が1以下、または cpu_bound のタスクが1件だけならスレッドプールで他のタスクと一緒に実行
+    - それ以外（LLM APIの応答待ち等）はスレッドプールで同時実行（max_threads 件まで）
+    - プロセスに渡す func / args は pickle できること（トップレベル関数・bytes 等）
+    - 1件の失敗は error に格納して他の処理は継続（例外は外に投げない）
+    - Streamlitの描画は呼び出し側（メインスレッド）で行うこと
+    """
+    tasks = list(tasks)
+    if not tasks:
+        return
+    cpu_tasks = [t for t in tasks if t[3]]
+    use_processes = max_processes > 1 and len(cpu_tasks) > 1
+    thread_tasks = [t for t in tasks if not (use_processes and t[3])]
+    processes = ProcessPoolExecutor(max_workers=min(max_processes, len(cpu_tasks)),
+                                    mp_context=process_context()) if use_processes else None
+    threads = ThreadPoolExecutor(max_workers=max(1, min(max_threads, len(thread_tasks)))) if thread_tasks else None
+    try:
+        futures = {}
+        for key, func, args, cpu_bound in tasks:
+            executor = processes if (use_processes and cpu_bound) else threads
+            futures[executor.submit(_timed, func, *args)] = key
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                result, seconds = future.result()
+                yield key, result, None, seconds
+            except Exception as e:
+                logger.warning(f"[並列処理エラー] {key!r}: {e}")
+                yield key, None, e, None
+    finally:
+        for executor in (processes, threads):
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
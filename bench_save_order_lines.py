@@ -0,0 +1,92 @@
+# bench_save_order_lines.py
+# db.save_order_lines の書き込み性能を測るベンチマーク
+#   python bench_save_order_lines.py                    # 10k / 100k / 1M 行
+#   python bench_save_order_lines.py --rows 5000 --legacy  # 従来の1行ずつINSERTとも比較
+# 一時ディレクトリの app.db に書き込むため、本番データには触れない
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+def make_orders(n: int, seed: int = 0) -> pd.DataFrame:
+    """IPORTER等の解析結果と同じ日本語列の注文明細（重複行を含む）を作る"""
+    rng = np.random.default_rng(seed)
+    products = np.array(["玉レタス", "青ネギ", "トマト", "きゅうり", "梨", "いちじく", "大根", "キャベツ"])
+    partners = np.array(["○○商店", "△△食堂", "□□ホテル", "××給食センター"])
+    order_no = rng.integers(100000, 999999, n)
+    qty = rng.integers(1, 50, n)
+    price = rng.integers(50, 2000, n)
+    df = pd.DataFrame({
+        "伝票番号": order_no.astype(str),
+        "発注日": "2025/08/01",
+        "納品日": pd.to_datetime("2025-08-02") + pd.to_timedelta(rng.integers(0, 30, n), unit="D"),
+        "取引先名": partners[rng.integers(0, len(partners), n)],
+        "商品コード": "",
+        "商品名": products[rng.integers(0, len(products), n)],
+        "サイズ": np.where(rng.random(n) < 0.3, "L", ""),
+        "数量": qty,
+        "単位": "箱",
+        "単価": price,
+        "金額": qty * price,
+        "備考": np.where(rng.random(n) < 0.1, "高い", ""),
+        "データ元": "IPORTER.csv",
+    })
+    # 同一行の重複もそのまま保存されることを確認するため1%を複製
+    dup = df.sample(frac=0.01, random_state=seed) if n >= 100 else df.head(0)
+    return pd.concat([df, dup], ignore_index=True).head(n)
+
+def legacy_save(db, df, batch_id):
+    """従来実装（iterrows + 1行ずつINSERT）の再現（当時の列構成の一時テーブルに書き込む）"""
+    import datetime
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    df = db._normalize_df(df)
+    with db._conn() as c:
+        c.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS legacy_order_lines (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, batch_id TEXT NOT NULL,
+            order_id TEXT, order_date TEXT, delivery_date TEXT, partner_name TEXT,
+            product_code TEXT, product_name TEXT, size TEXT, quantity REAL, unit TEXT,
+            unit_price REAL, amount REAL, remark TEXT, data_source TEXT,
+            row_hash TEXT, created_at TEXT NOT NULL
+        )
+        """)
+        for _, r in df.iterrows():
+            row = {k: r.get(k) for k in db._ORDER_LINE_COLS}
+            row["batch_id"] = batch_id
+            c.execute("""
+            INSERT INTO legacy_order_lines
+            (batch_id, order_id, order_date, delivery_date, partner_name,
+             product_code, product_name, size, quantity, unit, unit_price, amount, remark, data_source,
+             row_hash, created_at)
+            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+            """, (batch_id, *[row[k] for k in db._ORDER_LINE_COLS], db._calc_hash(row), now))
+
+def main():
+    parser = argparse.ArgumentParser(description="save_order_lines のベンチマーク")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--legacy", action="store_true", help="従来実装も計測（10万行以下のみ）")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="bench_db_")
+    os.environ["APP_DATA_DIR"] = tmp
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import db
+    db.init_db()
+
+    print(f"DB: {db.DB_PATH}")
+    print(f"{'行数':>10} {'方式':<8} {'秒':>8} {'行/秒':>12}")
+    for n in args.rows:
+        df = make_orders(n)
+        stats = db.save_order_lines(df, f"BENCH_{n}", note="benchmark")
+        print(f"{n:>10,} {'bulk':<8} {stats['seconds']:>8.2f} {stats['rows_per_sec']:>12,.0f}")
+        if args.legacy and n <= 100_000:
+            started = time.perf_counter()
+            legacy_save(db, df, f"LEGACY_{n}")
+            seconds = time.perf_counter() - started
+            print(f"{n:>10,} {'legacy':<8} {seconds:>8.2f} {n / seconds:>12,.0f}")
+
+if __name__ == "__main__":
+    main()
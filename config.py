@@ -44,3 +44,93 @@ def load_config(user_id=None):
         'app_data_dir': os.getenv('APP_DATA_DIR', str(Path(__file__).parent / 'data'))
     }
     return config
+
+def get_llm_max_concurrency():
+    """LLM解析の同時実行数（一括解析のワーカー数）を取得"""
+    try:
+        return max(1, int(os.getenv('LLM_MAX_CONCURRENCY', '4')))
+    except ValueError:
+        return 4
+
+def get_ingest_process_workers():
+    """アップロードしたCSV/XLSXを並列に解析するプロセス数（1以下でプロセスを使わない。既定はCPU数、最大4）"""
+    try:
+        return max(0, int(os.getenv('INGEST_PROCESS_WORKERS', str(min(4, os.cpu_count() or 1)))))
+    except ValueError:
+        return min(4, os.cpu_count() or 1)
+
+def get_text_pack_size():
+    """1リクエストにまとめる短文テキスト注文の最大件数を取得（1でまとめない）"""
+    try:
+        return max(1, int(os.getenv('TEXT_PACK_SIZE', '5')))
+    except ValueError:
+        return 5
+
+def get_text_pack_max_chars():
+    """まとめて解析する対象とするテキスト注文の最大文字数を取得"""
+    try:
+        return max(0, int(os.getenv('TEXT_PACK_MAX_CHARS', '200')))
+    except ValueError:
+        return 200
+
+def get_openai_rate_limits():
+    """OpenAI APIのレート制限（RPM, TPM）を取得（アカウントのTierに合わせて設定）"""
+    try:
+        rpm = max(1, int(os.getenv('OPENAI_RPM_LIMIT', '500')))
+        tpm = max(1, int(os.getenv('OPENAI_TPM_LIMIT', '30000')))
+    except ValueError:
+        rpm, tpm = 500, 30000
+    return rpm, tpm
+
+def get_llm_worker_mode():
+    """
+    LLM解析の実行方式を取得
+    - embedded: アプリが必要に応じてワーカープロセスを起動（既定）
+    - external: ワーカーは別途 `python llm_worker.py` で起動する
+    - off: ワーカーを使わず画面操作のスレッド内で解析する
+    """
+    mode = os.getenv('LLM_WORKER_MODE', 'embedded').strip().lower()
+    return mode if mode in ('embedded', 'external', 'off') else 'embedded'
+
+def get_eager_parse_default():
+    """受信と同時に自動解析する設定の既定値（アカウントごとに画面で切り替え可能）"""
+    return os.getenv('EAGER_PARSE_DEFAULT', '0') in ('1', 'true', 'True')
+
+def get_text_local_min_confidence():
+    """
+    テキスト注文をルールベース解析で確定する信頼度の下限を取得（0〜1、1より大きくすると常にLLMで解析）
+    """
+    try:
+        return float(os.getenv('TEXT_LOCAL_MIN_CONFIDENCE', '0.8'))
+    except ValueError:
+        return 0.8
+
+def get_pdf_render_dpi():
+    """PDFページ画像（プレビュー・Vision送信用）の描画解像度を取得"""
+    try:
+        return max(36, int(os.getenv('PDF_RENDER_DPI', '144')))
+    except ValueError:
+        return 144
+
+def get_sqlite_settings():
+    """
+    app.db の接続設定を取得
+    cache_mb: 接続ごとのページキャッシュ / mmap_mb: メモリマップ読み込みの上限 / busy_timeout_ms: ロック待ちの上限
+    """
+    def _int(name, default, minimum=0):
+        try:
+            return max(minimum, int(os.getenv(name, str(default))))
+        except ValueError:
+            return default
+    return {
+        'cache_mb': _int('SQLITE_CACHE_MB', 32, 1),
+        'mmap_mb': _int('SQLITE_MMAP_MB', 256),
+        'busy_timeout_ms': _int('SQLITE_BUSY_TIMEOUT_MS', 10000),
+    }
+
+def get_excel_cache_max_mb():
+    """生成済みExcelブックをメモリに保持する上限(MB)を取得（0でキャッシュしない）"""
+    try:
+        return max(0, int(os.getenv('EXCEL_CACHE_MAX_MB', '64')))
+    except ValueError:
+        return 64
@@ -1,10 +1,19 @@
 from pathlib import Path
+import os
 import sqlite3
+import threading
 import hashlib
+import json
+import time
 import datetime
+import logging
 from contextlib import contextmanager
+import numpy as np
 import pandas as pd
-from config import load_config
+from config import load_config, get_sqlite_settings
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
 
 # データベースファイルのパス設定（APP_DATA_DIRを使用）
 CONFIG = load_config()
@@ -49,80 +58,582 @@ def _normalize_df(df: pd.DataFrame) -> pd.DataFrame:
     # 型のゆるやかな整形（失敗はNaN→後でNoneになる）
     for num in ["quantity","unit_price","amount"]:
         df2[num] = pd.to_numeric(df2[num], errors="coerce")
-    for dcol in ["order_date","delivery_date"]:
-        df2[dcol] = pd.to_datetime(df2[dcol], errors="coerce").dt.strftime("%Y/%m/%d")
+    for dcol, day_col in [("order_date", "order_day"), ("delivery_date", "delivery_day")]:
+        dt = pd.to_datetime(df2[dcol], errors="coerce")
+        df2[dcol] = dt.dt.strftime("%Y/%m/%d")
+        # 範囲検索・インデックス用の整数日付（YYYYMMDD）
+        df2[day_col] = (dt.dt.year * 10000 + dt.dt.month * 100 + dt.dt.day).astype("Int64")
+
+    # 集計用の整数円（四捨五入、SQLiteの ROUND と同じく0から遠い方へ）
+    amount = df2["amount"]
+    df2["amount_yen"] = (np.sign(amount) * np.floor(np.abs(amount) + 0.5)).astype("Int64")
 
     return df2
 
+# ========= 接続管理 =========
+# - 接続はスレッドごとに1本を使い回す（WAL・各種PRAGMAは接続時に1回だけ設定）
+# - WALモードでは読み取り（履歴・集計タブ）が書き込み（履歴保存・解析ジョブ）を待たせない
+# - スキーマは PRAGMA user_version で版管理し、移行はプロセスごとに1回だけ実行
+
+_local = threading.local()
+_migrate_lock = threading.Lock()
+_migrated = False
+
+def _connect() -> sqlite3.Connection:
+    """PRAGMAを設定した新しい接続を開く"""
+    settings = get_sqlite_settings()
+    conn = sqlite3.connect(DB_PATH, timeout=settings["busy_timeout_ms"] / 1000)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")  # WALではNORMALでも破損しない（電源断時に直近のコミットのみ失う可能性）
+    conn.execute(f"PRAGMA cache_size={-settings['cache_mb'] * 1024}")
+    conn.execute(f"PRAGMA mmap_size={settings['mmap_mb'] * 1024 * 1024}")
+    conn.execute(f"PRAGMA busy_timeout={settings['busy_timeout_ms']}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
 @contextmanager
 def _conn():
-    """データベース接続のコンテキストマネージャー"""
-    conn = sqlite3.connect(DB_PATH)
+    """
+    データベース接続のコンテキストマネージャー
+    スレッドごとの接続を再利用し、ブロックを抜けるとコミット（例外時はロールバック）
+    入れ子で使った場合は一番外側のブロックでまとめてコミットする
+    """
+    if not _migrated:
+        init_db()
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        conn = _local.conn = _connect()
+        _local.pid = os.getpid()
+        _local.depth = 0
+    _local.depth += 1
     try:
         yield conn
-        conn.commit()
+        if _local.depth == 1:
+            conn.commit()
+    except BaseException:
+        if _local.depth == 1:
+            conn.rollback()
+        raise
     finally:
-        conn.close()
+        _local.depth -= 1
+
+def _ensure_column(c, table, col, type_sql="TEXT"):
+    cols = [r[1] for r in c.execute(f"PRAGMA table_info({table})").fetchall()]
+    if col not in cols:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {col} {type_sql};")
 
 def init_db():
-    """データベースの初期化（テーブル作成）"""
-    with _conn() as c:
-        # 注文明細テーブル
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS order_lines (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            batch_id TEXT NOT NULL,
-            order_id TEXT, 
-            order_date TEXT, 
-            delivery_date TEXT, 
-            partner_name TEXT,
-            product_code TEXT, 
-            product_name TEXT, 
-            size TEXT,                 -- 追加
-            quantity REAL, 
-            unit TEXT,
-            unit_price REAL, 
-            amount REAL, 
-            remark TEXT, 
-            data_source TEXT,
-            row_hash TEXT,  -- UNIQUE制約を削除（重複行も保存するため）
-            created_at TEXT NOT NULL
-        );
+    """
+    データベースのスキーマを最新版に移行（プロセスごとに1回だけ実行し、以降は何もしない）
+    複数プロセス（アプリ・解析ワーカー）が同時に起動しても BEGIN IMMEDIATE で1つずつ移行する
+    """
+    global _migrated
+    if _migrated:
+        return
+    with _migrate_lock:
+        if _migrated:
+            return
+        conn = _connect()
+        conn.isolation_level = None  # DDLを含めて BEGIN/COMMIT を明示的に制御
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    version = conn.execute("PRAGMA user_version").fetchone()[0]
+                    for v in range(version + 1, SCHEMA_VERSION + 1):
+                        started = time.perf_counter()
+                        _MIGRATIONS[v - 1](conn)
+                        conn.execute(f"PRAGMA user_version = {v}")
+                        logger.info(f"[DB移行] v{v} {_MIGRATIONS[v - 1].__doc__.strip()} "
+                                    f"{(time.perf_counter() - started) * 1000:.0f}ms")
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+        finally:
+            conn.close()
+        _migrated = True
+    _start_legacy_migration()
+
+def _migrate_v1(c):
+    """初期スキーマ（注文明細・バッチ・LINE/テキスト注文・アカウント設定・解析ジョブ）"""
+    # 注文明細テーブル
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS order_lines (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        batch_id TEXT NOT NULL,
+        order_id TEXT, 
+        order_date TEXT, 
+        delivery_date TEXT, 
+        partner_name TEXT,
+        product_code TEXT, 
+        product_name TEXT, 
+        size TEXT,                 -- 追加
+        quantity REAL, 
+        unit TEXT,
+        unit_price REAL, 
+        amount REAL, 
+        remark TEXT, 
+        data_source TEXT,
+        row_hash TEXT,  -- UNIQUE制約を削除（重複行も保存するため）
+        created_at TEXT NOT NULL
+    );
+    """)
+    
+    # --- 既存DB移行（size列がなければ追加） ---
+    cols = [r[1] for r in c.execute("PRAGMA table_info(order_lines)").fetchall()]
+    if "size" not in cols:
+        c.execute("ALTER TABLE order_lines ADD COLUMN size TEXT;")
+    
+    # --- 既存DB移行（account_*, company列がなければ追加） ---
+    # バッチ管理テーブル（列追加より前に作成しておく）
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS batches (
+        batch_id TEXT PRIMARY KEY,
+        created_at TEXT NOT NULL,
+        note TEXT
+    );
+    """)
+
+    # order_lines に追加
+    _ensure_column(c, "order_lines", "account_email", "TEXT")
+    _ensure_column(c, "order_lines", "account_name", "TEXT")
+    _ensure_column(c, "order_lines", "company", "TEXT")
+
+    # batches にも追加
+    _ensure_column(c, "batches", "account_email", "TEXT")
+    _ensure_column(c, "batches", "account_name", "TEXT")
+    _ensure_column(c, "batches", "company", "TEXT")
+
+    # インデックス（高速化）
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_lines_account_created ON order_lines(account_email, created_at);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_lines_company_created ON order_lines(company, created_at);")
+
+    # LINE注文キュー（旧 line_orders/orders.json）
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS line_orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        line_account TEXT,
+        sender_name TEXT,
+        order_date TEXT,
+        timestamp TEXT NOT NULL,
+        message_text TEXT,
+        image_filename TEXT,
+        processed INTEGER NOT NULL DEFAULT 0,
+        parsed_data TEXT   -- 解析結果（JSON文字列）
+    );
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_line_orders_account_processed_ts ON line_orders(line_account, processed, timestamp);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_line_orders_timestamp ON line_orders(timestamp);")
+
+    # テキスト注文キュー（旧 text_orders/orders.json）
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS text_orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        account TEXT,
+        customer_name TEXT,
+        message_text TEXT,
+        order_date TEXT,
+        delivery_date_opt TEXT,
+        timestamp TEXT NOT NULL,
+        processed INTEGER NOT NULL DEFAULT 0,
+        parsed_data TEXT   -- 解析結果（JSON文字列）
+    );
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_text_orders_account_processed_ts ON text_orders(account, processed, timestamp);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_text_orders_timestamp ON text_orders(timestamp);")
+
+    # アカウントごとの設定（受信時の自動解析など）
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS account_settings (
+        account TEXT NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT,
+        PRIMARY KEY (account, key)
+    );
+    """)
+
+    # LLM解析ジョブ（LINE画像 / テキスト注文 / 手書きPDF）
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS llm_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,              -- line / text / pdf
+        ref TEXT NOT NULL,               -- line/text: 注文のtimestamp, pdf: 内容のSHA-256
+        account TEXT,
+        payload TEXT NOT NULL,           -- 解析に必要な入力（JSON文字列）
+        priority INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'queued',  -- queued / running / done / dead
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 3,
+        lease_owner TEXT,
+        lease_until REAL,
+        available_at REAL NOT NULL,
+        result TEXT,                     -- 解析結果（JSON文字列）
+        error TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_llm_jobs_status_priority ON llm_jobs(status, priority DESC, available_at, id);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_llm_jobs_account_status ON llm_jobs(account, status);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_llm_jobs_kind_ref ON llm_jobs(kind, ref);")
+
+def _migrate_v2(c):
+    """整数日付（YYYYMMDD）・整数円の列と会社×日付インデックス"""
+    _ensure_column(c, "order_lines", "order_day", "INTEGER")
+    _ensure_column(c, "order_lines", "delivery_day", "INTEGER")
+    _ensure_column(c, "order_lines", "amount_yen", "INTEGER")
+
+    # 既存行の補完（YYYY/MM/DD 以外の日付・空の金額は NULL のまま）
+    for text_col, day_col in [("order_date", "order_day"), ("delivery_date", "delivery_day")]:
+        c.execute(f"""
+            UPDATE order_lines
+            SET {day_col} = CAST(REPLACE(substr({text_col}, 1, 10), '/', '') AS INTEGER)
+            WHERE {text_col} GLOB '[0-9][0-9][0-9][0-9]/[0-9][0-9]/[0-9][0-9]*'
         """)
-        
-        # --- 既存DB移行（size列がなければ追加） ---
-        cols = [r[1] for r in c.execute("PRAGMA table_info(order_lines)").fetchall()]
-        if "size" not in cols:
-            c.execute("ALTER TABLE order_lines ADD COLUMN size TEXT;")
-        
-        # --- 既存DB移行（account_*, company列がなければ追加） ---
-        def _ensure_column(c, table, col, type_sql="TEXT"):
-            cols = [r[1] for r in c.execute(f"PRAGMA table_info({table})").fetchall()]
-            if col not in cols:
-                c.execute(f"ALTER TABLE {table} ADD COLUMN {col} {type_sql};")
-
-        # order_lines に追加
-        _ensure_column(c, "order_lines", "account_email", "TEXT")
-        _ensure_column(c, "order_lines", "account_name", "TEXT")
-        _ensure_column(c, "order_lines", "company", "TEXT")
-
-        # batches にも追加
-        _ensure_column(c, "batches", "account_email", "TEXT")
-        _ensure_column(c, "batches", "account_name", "TEXT")
-        _ensure_column(c, "batches", "company", "TEXT")
-
-        # インデックス（高速化）
-        c.execute("CREATE INDEX IF NOT EXISTS idx_order_lines_account_created ON order_lines(account_email, created_at);")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_order_lines_company_created ON order_lines(company, created_at);")
-        
-        # バッチ管理テーブル
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS batches (
-            batch_id TEXT PRIMARY KEY,
-            created_at TEXT NOT NULL,
-            note TEXT
-        );
+    c.execute("""
+        UPDATE order_lines
+        SET amount_yen = CAST(ROUND(CAST(amount AS REAL)) AS INTEGER)
+        WHERE amount IS NOT NULL AND TRIM(amount) != ''
+    """)
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_lines_company_order_day ON order_lines(company, order_day);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_lines_company_delivery_day ON order_lines(company, delivery_day);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_lines_account_created ON order_lines(account_email, created_at);")
+
+def _migrate_v3(c):
+    """組織内集計用の日次ロールアップ（既存の注文明細から作成）"""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS order_rollups (
+        company TEXT NOT NULL,
+        date_type TEXT NOT NULL,      -- order / delivery / created
+        day INTEGER NOT NULL,         -- YYYYMMDD（日付なし・不正は0）
+        dim TEXT NOT NULL,            -- account / product / partner
+        name TEXT NOT NULL,           -- アカウント名 / 商品名 / 取引先名
+        size TEXT NOT NULL DEFAULT '',
+        unit TEXT NOT NULL DEFAULT '',
+        lines INTEGER NOT NULL DEFAULT 0,
+        quantity REAL NOT NULL DEFAULT 0,
+        amount_yen INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (company, date_type, dim, day, name, size, unit)
+    );
+    """)
+    c.execute("DELETE FROM order_rollups")
+    _apply_rollups(c, "1 = 1", (), 1)
+
+# ========= 注文明細の正規化（ディメンション表） =========
+# 実体は order_facts（文字列の繰り返しを整数IDで参照）。order_lines は互換ビューで、
+# 従来どおりの列名で読み取れる（load_batch・履歴タブ・ロールアップ集計はビュー経由）
+# 旧DBの order_lines は order_lines_legacy に改名し、バックグラウンドで少しずつ移す
+# （移行中もビューが両方を返すので読み取りは止まらず、中断しても続きから再開できる）
+
+# (ディメンション表, order_facts の列, 互換ビューの列)
+_DIMENSIONS = [
+    ("partners", "partner_id", "partner_name"),
+    ("products", "product_id", "product_name"),
+    ("units", "unit_id", "unit"),
+    ("data_sources", "data_source_id", "data_source"),
+    ("companies", "company_id", "company"),
+    ("accounts", "account_id", "account_email"),
+    ("account_names", "account_name_id", "account_name"),
+]
+_LEGACY_TABLE = "order_lines_legacy"
+_LEGACY_CHUNK_ROWS = 5000
+_legacy_thread = None
+
+def _create_order_lines_view(c, with_legacy: bool):
+    """互換ビュー order_lines を作り直す（移行中は未移行の旧テーブルの行も含める）"""
+    joins = "\n".join(f"LEFT JOIN {table} ON {table}.id = f.{fk}" for table, fk, _ in _DIMENSIONS)
+    names = {col: f"{table}.name" for table, _, col in _DIMENSIONS}
+    c.execute("DROP VIEW IF EXISTS order_lines")
+    sql = f"""
+    CREATE VIEW order_lines AS
+    SELECT f.id, f.batch_id, f.order_id, f.order_date, f.delivery_date, {names['partner_name']} AS partner_name,
+           f.product_code, {names['product_name']} AS product_name, f.size, f.quantity, {names['unit']} AS unit,
+           f.unit_price, f.amount, f.remark, {names['data_source']} AS data_source, f.row_hash, f.created_at,
+           {names['account_email']} AS account_email, {names['account_name']} AS account_name,
+           {names['company']} AS company, f.order_day, f.delivery_day, f.amount_yen
+    FROM order_facts f
+    {joins}
+    """
+    if with_legacy:
+        sql += f"""
+    UNION ALL
+    SELECT id, batch_id, order_id, order_date, delivery_date, partner_name,
+           product_code, product_name, size, quantity, unit,
+           unit_price, amount, remark, data_source, row_hash, created_at,
+           account_email, account_name, company,
+           order_day, delivery_day, amount_yen
+    FROM {_LEGACY_TABLE}
+    """
+    c.execute(sql)
+
+def _migrate_v4(c):
+    """注文明細をディメンション表＋整数外部キーの order_facts に正規化（互換ビュー order_lines）"""
+    for table, _, _ in _DIMENSIONS:
+        c.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS order_facts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        batch_id TEXT NOT NULL,
+        order_id TEXT,
+        order_date TEXT,
+        delivery_date TEXT,
+        partner_id INTEGER REFERENCES partners(id),
+        product_code TEXT,
+        product_id INTEGER REFERENCES products(id),
+        size TEXT,
+        quantity REAL,
+        unit_id INTEGER REFERENCES units(id),
+        unit_price REAL,
+        amount REAL,
+        remark TEXT,
+        data_source_id INTEGER REFERENCES data_sources(id),
+        row_hash TEXT,
+        created_at TEXT NOT NULL,
+        account_id INTEGER REFERENCES accounts(id),
+        account_name_id INTEGER REFERENCES account_names(id),
+        company_id INTEGER REFERENCES companies(id),
+        order_day INTEGER,
+        delivery_day INTEGER,
+        amount_yen INTEGER
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_facts_account_created ON order_facts(account_id, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_facts_company_order_day ON order_facts(company_id, order_day)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_facts_company_delivery_day ON order_facts(company_id, delivery_day)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_facts_batch ON order_facts(batch_id)")
+
+    # 旧テーブルを改名（インデックスは移行中の削除を遅くするだけなので外す）
+    for (name,) in c.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'order_lines' "
+                             "AND name LIKE 'idx_%'").fetchall():
+        c.execute(f"DROP INDEX {name}")
+    c.execute(f"ALTER TABLE order_lines RENAME TO {_LEGACY_TABLE}")
+    # 新しい行のIDが旧テーブルのIDと重ならないようにする
+    max_id = c.execute(f"SELECT COALESCE(MAX(id), 0) FROM {_LEGACY_TABLE}").fetchone()[0]
+    c.execute("DELETE FROM sqlite_sequence WHERE name = 'order_facts'")
+    c.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('order_facts', ?)", (max_id,))
+    _create_order_lines_view(c, with_legacy=True)
+
+    # 小さいDBはこの場で移し終える（大きいDBは init_db 後にバックグラウンドで移す）
+    if c.execute(f"SELECT COUNT(*) FROM {_LEGACY_TABLE}").fetchone()[0] <= _LEGACY_CHUNK_ROWS * 10:
+        while _move_legacy_rows(c, _LEGACY_CHUNK_ROWS):
+            pass
+        _finish_legacy_migration(c)
+
+def _legacy_exists(c) -> bool:
+    return c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                     (_LEGACY_TABLE,)).fetchone() is not None
+
+def _move_legacy_rows(c, limit: int) -> int:
+    """旧テーブルの先頭 limit 行を order_facts に移し、移した行数を返す（IDはそのまま）"""
+    row = c.execute(f"SELECT MIN(id), MAX(id), COUNT(*) FROM (SELECT id FROM {_LEGACY_TABLE} ORDER BY id LIMIT ?)",
+                    (limit,)).fetchone()
+    first, upto, moved = row
+    if not moved:
+        return 0
+    for table, _, col in _DIMENSIONS:
+        c.execute(f"""
+            INSERT OR IGNORE INTO {table} (name)
+            SELECT DISTINCT {col} FROM {_LEGACY_TABLE} WHERE id <= ? AND {col} IS NOT NULL
+        """, (upto,))
+    dim_cols = ", ".join(fk for _, fk, _ in _DIMENSIONS)
+    dim_ids = ", ".join(f"(SELECT id FROM {table} WHERE name = l.{col})" for table, _, col in _DIMENSIONS)
+    c.execute(f"""
+        INSERT INTO order_facts
+        (id, batch_id, order_id, order_date, delivery_date, product_code, size, quantity,
+         unit_price, amount, remark, row_hash, created_at, order_day, delivery_day, amount_yen,
+         {dim_cols})
+        SELECT l.id, l.batch_id, l.order_id, l.order_date, l.delivery_date, l.product_code, l.size, l.quantity,
+               l.unit_price, l.amount, l.remark, l.row_hash, l.created_at, l.order_day, l.delivery_day, l.amount_yen,
+               {dim_ids}
+        FROM {_LEGACY_TABLE} l
+        WHERE l.id <= ?
+    """, (upto,))
+    c.execute(f"DELETE FROM {_LEGACY_TABLE} WHERE id <= ?", (upto,))
+    _index_search(c, "id BETWEEN ? AND ?", (first, upto))
+    return moved
+
+def _finish_legacy_migration(c):
+    """旧テーブルが空なら削除し、互換ビューを order_facts だけの定義にする"""
+    if not _legacy_exists(c):
+        return
+    if c.execute(f"SELECT 1 FROM {_LEGACY_TABLE} LIMIT 1").fetchone():
+        return
+    c.execute(f"DROP TABLE {_LEGACY_TABLE}")
+    _create_order_lines_view(c, with_legacy=False)
+    logger.info("[DB移行] 注文明細の正規化が完了しました")
+
+def migrate_legacy_order_lines(chunk_rows: int = _LEGACY_CHUNK_ROWS, pause: float = 0.05) -> int:
+    """
+    旧 order_lines の残りを chunk_rows 行ずつ別トランザクションで移す（書き込みを長く止めない）
+    途中で止まっても、次に呼ばれたとき残りから続ける。移した行数を返す
+    """
+    total = 0
+    while True:
+        with _conn() as c:
+            c.execute("BEGIN IMMEDIATE")  # 他のプロセスの移行・書き込みと1チャンクずつ順番に
+            if not _legacy_exists(c):
+                return total
+            moved = _move_legacy_rows(c, chunk_rows)
+            if not moved:
+                _finish_legacy_migration(c)
+                logger.info(f"[DB移行] 注文明細の移行: このプロセスで{total}行")
+                return total
+        total += moved
+        if total % (chunk_rows * 20) < chunk_rows:
+            logger.info(f"[DB移行] 注文明細を正規化テーブルへ移行中: 累計{total}行")
+        time.sleep(pause)
+
+def _start_legacy_migration():
+    """未移行の旧テーブルが残っていればバックグラウンドスレッドで移行する"""
+    global _legacy_thread
+    with _conn() as c:
+        if not _legacy_exists(c):
+            return
+    if _legacy_thread is None or not _legacy_thread.is_alive():
+        _legacy_thread = threading.Thread(target=_run_legacy_migration, name="order-lines-migration", daemon=True)
+        _legacy_thread.start()
+
+def _run_legacy_migration():
+    try:
+        migrate_legacy_order_lines()
+    except Exception as e:
+        logger.warning(f"[DB移行] 注文明細の移行を中断しました（次回起動時に再開）: {e}")
+
+def _intern(c, table: str, values) -> dict:
+    """ディメンション表に名前を登録し {名前: ID} を返す（名前は文字列として扱う）"""
+    names = sorted({str(v) for v in values if v is not None})
+    if not names:
+        return {}
+    c.executemany(f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", [(n,) for n in names])
+    ids = {}
+    for start in range(0, len(names), 500):
+        chunk = names[start:start + 500]
+        ids.update(c.execute(f"SELECT name, id FROM {table} WHERE name IN ({','.join('?' * len(chunk))})",
+                             chunk).fetchall())
+    return ids
+
+def _delete_order_rows(c, where_sql: str, params=()) -> int:
+    """注文明細の実体（移行中は旧テーブルも）から削除し、削除件数を返す"""
+    deleted = c.execute(f"DELETE FROM order_facts WHERE {where_sql}", params).rowcount
+    if _legacy_exists(c):
+        deleted += c.execute(f"DELETE FROM {_LEGACY_TABLE} WHERE {where_sql}", params).rowcount
+    return deleted
+
+# ========= 履歴の全文検索 =========
+# order_search: 商品名・備考・取引先名・伝票番号の FTS5（trigram）索引
+# 本文は持たず互換ビュー order_lines を参照する（external content）。order_facts のトリガーで追加・削除に追従
+# 移行途中で order_lines_legacy に残っている行は、order_facts に移された時点で索引に入る
+
+_SEARCH_COLS = ["product_name", "remark", "partner_name", "order_id"]
+_search_available = None
+
+def _search_values(row: str) -> str:
+    """トリガー内で索引に渡す値（new/old の行から名前を引く）"""
+    return (f"(SELECT name FROM products WHERE id = {row}.product_id), {row}.remark, "
+            f"(SELECT name FROM partners WHERE id = {row}.partner_id), {row}.order_id")
+
+def _migrate_v5(c):
+    """履歴の全文検索索引（FTS5 trigram）"""
+    try:
+        c.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS order_search USING fts5(
+                {", ".join(_SEARCH_COLS)},
+                content='order_lines', content_rowid='id', tokenize='trigram'
+            )
         """)
+    except sqlite3.OperationalError as e:
+        # FTS5/trigram が使えないSQLiteでは索引を作らず、検索は LIKE で行う
+        logger.warning(f"[DB移行] 全文検索索引を作成できません（LIKE検索で代替）: {e}")
+        return
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS order_facts_search_insert AFTER INSERT ON order_facts BEGIN
+            INSERT INTO order_search (rowid, {", ".join(_SEARCH_COLS)})
+            VALUES (new.id, {_search_values("new")});
+        END
+    """)
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS order_facts_search_delete AFTER DELETE ON order_facts BEGIN
+            INSERT INTO order_search (order_search, rowid, {", ".join(_SEARCH_COLS)})
+            VALUES ('delete', old.id, {_search_values("old")});
+        END
+    """)
+    c.execute(f"""
+        INSERT INTO order_search (rowid, {", ".join(_SEARCH_COLS)})
+        SELECT f.id, {_search_values("f")} FROM order_facts f
+    """)
+
+def _has_search_index(c) -> bool:
+    global _search_available
+    if not _search_available:
+        # 索引は移行の途中（v5）で作られるので、見つかるまでは毎回確かめる
+        _search_available = c.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'order_search'").fetchone() is not None
+    return _search_available
+
+def _index_search(c, where_sql: str, params=()):
+    """
+    追加した注文明細を全文検索索引に1文でまとめて登録する（1行ずつのトリガーは使わない）
+    明細の INSERT 後に同じ接続（トランザクション）で呼ぶ
+    """
+    if not _has_search_index(c):
+        return
+    c.execute(f"""
+        INSERT INTO order_search (rowid, {", ".join(_SEARCH_COLS)})
+        SELECT id, {", ".join(_SEARCH_COLS)} FROM order_lines
+        WHERE {where_sql}
+    """, params)
+
+def _search_terms(text: str):
+    """
+    検索語を (FTS5のMATCH式, 3文字未満の語) に分ける
+    trigram は3文字以上の語だけ索引で引けるため、短い語は LIKE で絞り込む
+    """
+    terms = (text or "").split()  # 全角スペースでも区切る
+    long_terms = [t for t in terms if len(t) >= 3]
+    match = " ".join('"' + t.replace('"', '""') + '"' for t in long_terms) or None
+    return match, [t for t in terms if len(t) < 3]
+
+def _like_pattern(text: str) -> str:
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+def _migrate_v6(c):
+    """データの版数（画面側のキャッシュを無効化する目印。注文明細の保存・削除のたびに進める）"""
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+
+def _bump_data_version(c, name: str = "order_lines"):
+    c.execute("""
+        INSERT INTO data_versions (name, version) VALUES (?, 1)
+        ON CONFLICT(name) DO UPDATE SET version = version + 1
+    """, (name,))
+
+def get_data_version(name: str = "order_lines") -> int:
+    """データの版数（保存・削除のたびに増える。キャッシュのキーに使う）"""
+    with _conn() as c:
+        row = c.execute("SELECT version FROM data_versions WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+def _migrate_v7(c):
+    """解析ジョブの結果の取り込み日時（手書きPDFの結果を同じアカウントのどの画面でも1回だけ取り込む）"""
+    _ensure_column(c, "llm_jobs", "imported_at", "REAL")
+    # 既に完了しているジョブは登録した画面で取り込み済みとみなす
+    c.execute("UPDATE llm_jobs SET imported_at = updated_at WHERE status = 'done'")
+
+def _migrate_v8(c):
+    """全文検索索引の登録を行ごとのトリガーから保存時の一括登録に切り替え（削除はトリガーのまま）"""
+    c.execute("DROP TRIGGER IF EXISTS order_facts_search_insert")
+
+# スキーマ移行（追加するときは末尾に関数を足す。user_version = 適用済みの数）
+_MIGRATIONS = [_migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4, _migrate_v5, _migrate_v6, _migrate_v7,
+               _migrate_v8]
+SCHEMA_VERSION = len(_MIGRATIONS)
 
 def _calc_hash(row: dict) -> str:
     """行データのハッシュ値を計算（重複防止用）"""
@@ -132,13 +643,42 @@ def _calc_hash(row: dict) -> str:
     s = "|".join(str(row.get(k, "")) for k in keys)
     return hashlib.sha256(s.encode("utf-8")).hexdigest()
 
+_ORDER_LINE_COLS = ["order_id", "order_date", "delivery_date", "partner_name",
+                    "product_code", "product_name", "size", "quantity", "unit",
+                    "unit_price", "amount", "remark", "data_source"]
+# 書き込み時に _normalize_df で計算する列（行ハッシュには含めない）
+_TYPED_COLS = ["order_day", "delivery_day", "amount_yen"]
+
+def _calc_hashes(df: pd.DataFrame, batch_id: str) -> list:
+    """
+    _calc_hash と同じハッシュ値を列単位でまとめて計算
+    （文字列化と連結は列ごとに行い、行ごとのPython処理はSHA-256だけにする）
+    """
+    if df.empty:
+        return []
+    joined = df[_ORDER_LINE_COLS[0]].map(str)
+    for k in _ORDER_LINE_COLS[1:]:
+        joined = joined + "|" + df[k].map(str)
+    joined = joined + "|" + str(batch_id)
+    sha256 = hashlib.sha256
+    return [sha256(s.encode("utf-8")).hexdigest() for s in joined.tolist()]
+
 def save_order_lines(df, batch_id: str, note: str = None,
                      account_email: str = None, account_name: str = None, company: str = None):
-    """注文明細をデータベースに保存"""
+    """
+    注文明細をデータベースに保存（重複行も含めて原本どおり全行を保存）
+    行ハッシュは列単位で計算し、全行を1トランザクション・executemanyで書き込む
+    戻り値: {"rows": 保存行数, "seconds": 所要秒, "rows_per_sec": 毎秒行数}
+    """
+    started = time.perf_counter()
     now = datetime.datetime.now().isoformat(timespec="seconds")
-    init_db()
     df = _normalize_df(df)  # ★追加：英語スキーマに統一
-    
+    df = df[_ORDER_LINE_COLS + _TYPED_COLS].reset_index(drop=True)
+
+    # 行ハッシュと書き込み値を列単位で準備（NaN/NaT は NULL）
+    hashes = _calc_hashes(df, batch_id)
+    values = df.astype(object).where(df.notna(), None)
+
     with _conn() as c:
         # バッチ情報を保存（既に存在ならメタ更新）
         c.execute("""
@@ -150,40 +690,48 @@ def save_order_lines(df, batch_id: str, note: str = None,
                 account_name=excluded.account_name,
                 company=excluded.company
         """, (batch_id, now, note, account_email, account_name, company))
-        
-        # 行をINSERT（重複も含めて原本どおり全行を保存）
-        cols = ["order_id", "order_date", "delivery_date", "partner_name",
-                "product_code", "product_name", "size", "quantity", "unit",
-                "unit_price", "amount", "remark", "data_source"]
-        
-        for _, r in df.iterrows():
-            row = {k: (r.get(k) if k in df.columns else None) for k in cols}
-            row["batch_id"] = batch_id
-            h = _calc_hash(row)
-            
-            c.execute("""
-            INSERT INTO order_lines
-            (batch_id, order_id, order_date, delivery_date, partner_name,
-             product_code, product_name, size, quantity, unit, unit_price, amount, remark, data_source,
-             account_email, account_name, company,
-             row_hash, created_at)
-            VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?, ?,?, ?, ?,?)
-            """, (batch_id, row["order_id"], row["order_date"], row["delivery_date"], row["partner_name"],
-                  row["product_code"], row["product_name"], row["size"], row["quantity"], row["unit"],
-                  row["unit_price"], row["amount"], row["remark"], row["data_source"],
-                  account_email, account_name, company,
-                  h, now))
+
+        # 文字列の列はディメンション表のIDに置き換える
+        row_dims = [(table, fk, col) for table, fk, col in _DIMENSIONS if col in values.columns]
+        for table, fk, col in row_dims:
+            # 数値や型の混在した名前も文字列にそろえてから登録・参照する
+            values[col] = values[col].map(lambda v: v if v is None else str(v)).astype(object)
+            ids = _intern(c, table, values[col].unique())
+            values[fk] = values[col].map(ids).astype("Int64").astype(object).where(values[col].notna(), None)
+        # 保存単位で共通の列（会社・アカウント）
+        batch_dims = {"company": company, "account_email": account_email, "account_name": account_name}
+        batch_ids = [_intern(c, table, [batch_dims[col]]).get(str(batch_dims[col]))
+                     for table, _, col in _DIMENSIONS if col in batch_dims]
+        fact_cols = [col for col in _ORDER_LINE_COLS + _TYPED_COLS if col not in {d[2] for d in row_dims}] + \
+                    [fk for _, fk, _ in row_dims]
+        batch_fks = [fk for _, fk, col in _DIMENSIONS if col in batch_dims]
+        rows = [(batch_id, *r, *batch_ids, h, now)
+                for r, h in zip(values[fact_cols].itertuples(index=False, name=None), hashes)]
+
+        first_id = c.execute("SELECT COALESCE(MAX(id), 0) FROM order_lines").fetchone()[0]
+        c.executemany(f"""
+            INSERT INTO order_facts
+            (batch_id, {", ".join(fact_cols + batch_fks)}, row_hash, created_at)
+            VALUES ({", ".join("?" * (len(fact_cols) + len(batch_fks) + 3))})
+        """, rows)
+        _index_search(c, "id > ?", (first_id,))
+        _apply_rollups(c, "id > ?", (first_id,), 1)
+        _bump_data_version(c)
+
+    seconds = time.perf_counter() - started
+    stats = {"rows": len(rows), "seconds": seconds,
+             "rows_per_sec": len(rows) / seconds if seconds > 0 else float(len(rows))}
+    logger.info(f"[履歴保存] batch={batch_id} {stats['rows']}行 {seconds:.2f}秒 ({stats['rows_per_sec']:,.0f}行/秒)")
+    return stats
 
 def list_batches():
     """保存済みバッチの一覧を取得"""
-    init_db()
     with _conn() as c:
         cur = c.execute("SELECT batch_id, created_at, COALESCE(note,'') FROM batches ORDER BY created_at DESC")
         return cur.fetchall()
 
 def load_batch(batch_id: str):
     """指定されたバッチIDのデータを取得"""
-    init_db()
     with _conn() as c:
         cur = c.execute("""
         SELECT order_id as '伝票番号', order_date as '発注日', delivery_date as '納品日', partner_name as '取引先名',
@@ -198,7 +746,6 @@ def load_batch(batch_id: str):
 
 def get_batch_stats():
     """バッチ統計情報を取得"""
-    init_db()
     with _conn() as c:
         # 総バッチ数
         total_batches = c.execute("SELECT COUNT(*) FROM batches").fetchone()[0]
@@ -214,3 +761,736 @@ def get_batch_stats():
             "total_lines": total_lines,
             "latest_batch": latest_batch
         }
+
+
+# ========= 組織内集計ロールアップ =========
+# order_rollups は 会社 × 日付種別 × 日 × 集計軸 ごとの行数・数量・金額
+# 注文明細の追加・削除と同じトランザクションで増減させる
+
+_ROLLUP_DAYS = {
+    "order": "COALESCE(order_day, 0)",
+    "delivery": "COALESCE(delivery_day, 0)",
+    "created": "CAST(REPLACE(substr(created_at, 1, 10), '-', '') AS INTEGER)",
+}
+_ROLLUP_DIMS = {
+    "account": ("account_name", "''", "''"),
+    "product": ("product_name", "size", "unit"),
+    "partner": ("partner_name", "''", "''"),
+}
+
+def _apply_rollups(c, where_sql: str, params, sign: int):
+    """
+    WHERE句に一致する注文明細をロールアップに加算（sign=1）/ 減算（sign=-1）
+    明細の INSERT 後・DELETE 前に同じ接続（トランザクション）で呼ぶ
+    明細は1回だけ読み、最も細かい粒度で集計した一時表から各集計軸に足し込む
+    """
+    c.execute("DROP TABLE IF EXISTS temp.rollup_delta")
+    c.execute(f"""
+        CREATE TEMP TABLE rollup_delta AS
+        SELECT COALESCE(company, '') AS company,
+               {", ".join(f"{sql} AS {date_type}_day" for date_type, sql in _ROLLUP_DAYS.items())},
+               COALESCE(account_name, '') AS account_name, COALESCE(partner_name, '') AS partner_name,
+               COALESCE(product_name, '') AS product_name, COALESCE(size, '') AS size, COALESCE(unit, '') AS unit,
+               COUNT(*) AS lines, COALESCE(SUM(quantity), 0) AS quantity, COALESCE(SUM(amount_yen), 0) AS amount_yen
+        FROM order_lines
+        WHERE {where_sql}
+        GROUP BY 1, 2, 3, 4, 5, 6, 7, 8, 9
+    """, params)
+    for date_type in _ROLLUP_DAYS:
+        for dim, (name_col, size_col, unit_col) in _ROLLUP_DIMS.items():
+            c.execute(f"""
+                INSERT INTO order_rollups
+                (company, date_type, day, dim, name, size, unit, lines, quantity, amount_yen)
+                SELECT company, '{date_type}', {date_type}_day, '{dim}', {name_col}, {size_col}, {unit_col},
+                       {sign} * SUM(lines), {sign} * SUM(quantity), {sign} * SUM(amount_yen)
+                FROM rollup_delta
+                GROUP BY 1, 3, 5, 6, 7
+                ON CONFLICT(company, date_type, dim, day, name, size, unit) DO UPDATE SET
+                    lines = lines + excluded.lines,
+                    quantity = quantity + excluded.quantity,
+                    amount_yen = amount_yen + excluded.amount_yen
+            """)
+    c.execute("DROP TABLE temp.rollup_delta")
+    if sign < 0:
+        c.execute("DELETE FROM order_rollups WHERE lines <= 0")
+
+def delete_order_lines(ids) -> int:
+    """注文明細を行IDで削除（ロールアップも減算）し、削除件数を返す"""
+    ids = [int(i) for i in ids]
+    deleted = 0
+    with _conn() as c:
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            where_sql = f"id IN ({','.join('?' * len(chunk))})"
+            _apply_rollups(c, where_sql, chunk, -1)
+            deleted += _delete_order_rows(c, where_sql, chunk)
+        _bump_data_version(c)
+    return deleted
+
+def delete_batch(batch_id: str) -> int:
+    """バッチとその注文明細を削除（ロールアップも減算）し、削除した明細数を返す"""
+    with _conn() as c:
+        _apply_rollups(c, "batch_id = ?", (batch_id,), -1)
+        deleted = _delete_order_rows(c, "batch_id = ?", (batch_id,))
+        c.execute("DELETE FROM batches WHERE batch_id = ?", (batch_id,))
+        _bump_data_version(c)
+    return deleted
+
+def delete_all_order_lines() -> tuple:
+    """全注文明細・全バッチ・ロールアップを削除し、(明細数, バッチ数) を返す"""
+    with _conn() as c:
+        deleted_rows = _delete_order_rows(c, "1 = 1")
+        deleted_batches = c.execute("DELETE FROM batches").rowcount
+        c.execute("DELETE FROM order_rollups")
+        _bump_data_version(c)
+    return deleted_rows, deleted_batches
+
+def get_org_summary(company: str, date_type: str = "created", day_from: int = None, day_to: int = None):
+    """
+    組織内集計をロールアップから取得
+    date_type: order / delivery / created、day_from / day_to: YYYYMMDD（Noneなら期間指定なし）
+    戻り値: (アカウント別, 商品別, 取引先別) のDataFrame
+    """
+    where = ["company = ?", "date_type = ?", "dim = ?"]
+    params = [company, date_type]
+    if day_from is not None or day_to is not None:
+        # 日付のない行（day = 0）は期間を指定したときは含めない
+        where.append("day > 0")
+    if day_from is not None:
+        where.append("day >= ?")
+        params.append(day_from)
+    if day_to is not None:
+        where.append("day <= ?")
+        params.append(day_to)
+    where_sql = " AND ".join(where)
+
+    with _conn() as c:
+        def _query(dim, select_sql, group_sql, order_sql, columns):
+            rows = c.execute(f"""
+                SELECT {select_sql} FROM order_rollups
+                WHERE {where_sql}
+                GROUP BY {group_sql}
+                HAVING SUM(lines) > 0
+                ORDER BY {order_sql}
+            """, [*params[:2], dim, *params[2:]]).fetchall()
+            return pd.DataFrame(rows, columns=columns)
+
+        df_acc = _query("account", "name, SUM(lines), SUM(amount_yen)", "name", "3 DESC",
+                        ["アカウント", "行数", "金額合計"])
+        df_prd = _query("product", "name, size, unit, SUM(quantity), SUM(amount_yen)", "name, size, unit", "4 DESC",
+                        ["商品名", "サイズ", "単位", "数量合計", "金額合計"])
+        df_ptn = _query("partner", "name, SUM(lines), SUM(amount_yen)", "name", "3 DESC",
+                        ["取引先名", "行数", "金額合計"])
+    return df_acc, df_prd, df_ptn
+
+
+# ========= 履歴（DB）タブ =========
+# 絞り込み条件 filters: {"date_type": order/delivery/created, "day_from"/"day_to": YYYYMMDD,
+#                       "partner": 取引先名, "product": 商品名の部分一致, "batch_id": バッチID,
+#                       "search": キーワード（商品名・備考・取引先名・伝票番号の全文検索）}
+# ページ送りは (created_at, id) の降順キーセット（OFFSETを使わない）
+
+_HISTORY_SELECT = """
+    SELECT
+        id,
+        order_id     AS '伝票番号',
+        order_date   AS '発注日',
+        delivery_date AS '納品日',
+        partner_name AS '取引先名',
+        product_code AS '商品コード',
+        product_name AS '商品名',
+        size         AS 'サイズ',
+        quantity     AS '数量',
+        unit         AS '単位',
+        unit_price   AS '単価',
+        amount       AS '金額',
+        remark       AS '備考',
+        data_source  AS 'データ元',
+        batch_id     AS 'バッチID',
+        created_at   AS '登録日時',
+        account_name AS '登録アカウント'
+    FROM order_lines
+"""
+
+def _history_where(account_email: str, filters: dict = None, match_in_where: bool = True):
+    """
+    履歴の絞り込み条件を (WHERE句, パラメータ) にする
+    filters["search"] はキーワード検索（スペース区切りでAND）。match_in_where=False なら
+    全文検索索引の条件は呼び出し側で結合する（関連度順に並べる場合）
+    """
+    filters = filters or {}
+    where, params = ["account_email = ?"], [account_email]
+    date_type = filters.get("date_type", "created")
+    for key, op in (("day_from", ">="), ("day_to", "<=")):
+        day = filters.get(key)
+        if day is None:
+            continue
+        if date_type == "created":
+            d = str(day)
+            where.append(f"created_at {op} ?")
+            params.append(f"{d[:4]}-{d[4:6]}-{d[6:]}T" + ("00:00:00" if op == ">=" else "23:59:59"))
+        else:
+            where.append(f"{'order_day' if date_type == 'order' else 'delivery_day'} {op} ?")
+            params.append(int(day))
+    if filters.get("partner"):
+        where.append("partner_name = ?")
+        params.append(filters["partner"])
+    if filters.get("product"):
+        where.append("product_name LIKE ? ESCAPE '\\'")
+        params.append(_like_pattern(filters["product"]))
+    if filters.get("batch_id"):
+        where.append("batch_id = ?")
+        params.append(filters["batch_id"])
+    if filters.get("search"):
+        match, short_terms = _search_terms(filters["search"])
+        with _conn() as c:
+            use_index = match is not None and _has_search_index(c)
+        if use_index and match_in_where:
+            where.append("id IN (SELECT rowid FROM order_search WHERE order_search MATCH ?)")
+            params.append(match)
+        like_terms = short_terms if use_index else filters["search"].split()
+        for term in like_terms:
+            where.append("(" + " OR ".join(f"{col} LIKE ? ESCAPE '\\'" for col in _SEARCH_COLS) + ")")
+            params.extend([_like_pattern(term)] * len(_SEARCH_COLS))
+    return " AND ".join(where), params
+
+def count_history(account_email: str, filters: dict = None) -> dict:
+    """絞り込み結果の行数・バッチ数・最新登録日時"""
+    where_sql, params = _history_where(account_email, filters)
+    with _conn() as c:
+        rows, batches, latest = c.execute(f"""
+            SELECT COUNT(*), COUNT(DISTINCT batch_id), MAX(created_at)
+            FROM order_lines WHERE {where_sql}
+        """, params).fetchone()
+    return {"rows": rows, "batches": batches, "latest": latest}
+
+def list_history_page(account_email: str, filters: dict = None, after: tuple = None, limit: int = 100):
+    """
+    履歴を新しい順に1ページ分取得
+    after: 前ページ最後の行の (登録日時, id)。limit=None なら絞り込み結果をすべて返す
+    """
+    where_sql, params = _history_where(account_email, filters)
+    if after:
+        where_sql += " AND (created_at, id) < (?, ?)"
+        params = [*params, *after]
+    sql = f"{_HISTORY_SELECT} WHERE {where_sql} ORDER BY created_at DESC, id DESC"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    with _conn() as c:
+        cur = c.execute(sql, params)
+        rows = cur.fetchall()
+        cols = [d[0] for d in cur.description]
+    return pd.DataFrame(rows, columns=cols)
+
+def iter_history_rows(account_email: str, filters: dict = None, chunk_rows: int = 5000):
+    """
+    履歴を新しい順に chunk_rows 行ずつ (列名, 行タプルのリスト) で返すジェネレーター（エクスポート用）
+    チャンクごとに別クエリ（キーセット）で読むため、全件をメモリに載せない
+    """
+    where_sql, params = _history_where(account_email, filters)
+    after = None
+    while True:
+        page_where = where_sql + (" AND (created_at, id) < (?, ?)" if after else "")
+        with _conn() as c:
+            cur = c.execute(f"{_HISTORY_SELECT} WHERE {page_where} ORDER BY created_at DESC, id DESC LIMIT ?",
+                            [*params, *(after or ()), chunk_rows])
+            rows = cur.fetchall()
+            cols = [d[0] for d in cur.description]
+        if not rows:
+            return
+        yield cols, rows
+        if len(rows) < chunk_rows:
+            return
+        after = (rows[-1][cols.index("登録日時")], rows[-1][0])
+
+def search_history_page(account_email: str, filters: dict, offset: int = 0, limit: int = 100):
+    """
+    キーワード検索の結果を関連度（bm25）順、同点は新しい順に1ページ分取得
+    索引が使えない（短い語だけ・FTS5なし）場合は新しい順
+    """
+    match, _ = _search_terms(filters.get("search"))
+    with _conn() as c:
+        ranked = match is not None and _has_search_index(c)
+    where_sql, params = _history_where(account_email, filters, match_in_where=not ranked)
+    if ranked:
+        sql = f"""{_HISTORY_SELECT}
+            JOIN (SELECT rowid AS hit_id, bm25(order_search) AS score
+                  FROM order_search WHERE order_search MATCH ?) hits ON hits.hit_id = order_lines.id
+            WHERE {where_sql}
+            ORDER BY hits.score, created_at DESC, id DESC"""
+        params = [match, *params]
+    else:
+        sql = f"{_HISTORY_SELECT} WHERE {where_sql} ORDER BY created_at DESC, id DESC"
+    sql += f" LIMIT {int(limit)} OFFSET {int(offset)}"
+    with _conn() as c:
+        cur = c.execute(sql, params)
+        rows = cur.fetchall()
+        cols = [d[0] for d in cur.description]
+    return pd.DataFrame(rows, columns=cols)
+
+def list_history_batches(account_email: str, filters: dict = None) -> list:
+    """絞り込み結果に含まれるバッチ [(バッチID, 行数, 最終登録日時)]（新しい順）"""
+    where_sql, params = _history_where(account_email, filters)
+    with _conn() as c:
+        return c.execute(f"""
+            SELECT batch_id, COUNT(*), MAX(created_at)
+            FROM order_lines WHERE {where_sql}
+            GROUP BY batch_id
+            ORDER BY MAX(created_at) DESC
+        """, params).fetchall()
+
+def list_history_partners(account_email: str) -> list:
+    """履歴に登場する取引先名（絞り込みの選択肢）"""
+    with _conn() as c:
+        return [r[0] for r in c.execute("""
+            SELECT DISTINCT partner_name FROM order_lines
+            WHERE account_email = ? AND partner_name IS NOT NULL AND partner_name != ''
+            ORDER BY partner_name
+        """, (account_email,)).fetchall()]
+
+def history_ids(account_email: str, filters: dict = None) -> list:
+    """絞り込み結果の行ID（絞り込み結果の一括削除用）"""
+    where_sql, params = _history_where(account_email, filters)
+    with _conn() as c:
+        return [r[0] for r in c.execute(f"SELECT id FROM order_lines WHERE {where_sql}", params).fetchall()]
+
+
+# ========= LINE注文キュー =========
+
+_LINE_ORDER_COLS = ["line_account", "sender_name", "order_date", "timestamp",
+                    "message_text", "image_filename", "processed", "parsed_data"]
+
+def _line_order_from_row(row) -> dict:
+    """line_orders の1行を従来のorders.jsonと同じ形のdictに変換"""
+    order = dict(zip(_LINE_ORDER_COLS, row))
+    order["processed"] = bool(order["processed"])
+    order["parsed_data"] = json.loads(order["parsed_data"]) if order["parsed_data"] else None
+    return order
+
+def _line_order_params(order: dict) -> tuple:
+    parsed = order.get("parsed_data")
+    return (order.get("line_account"), order.get("sender_name"), order.get("order_date"),
+            order.get("timestamp"), order.get("message_text", ""), order.get("image_filename"),
+            1 if order.get("processed", False) else 0,
+            json.dumps(parsed, ensure_ascii=False) if parsed is not None else None)
+
+def insert_line_order(order: dict):
+    """LINE注文を1件キューに追加（1行INSERT）"""
+    with _conn() as c:
+        c.execute(f"""
+            INSERT INTO line_orders ({", ".join(_LINE_ORDER_COLS)})
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, _line_order_params(order))
+
+def _mark_parsed(c, table: str, results) -> int:
+    """
+    line_orders / text_orders に解析結果を書き込み処理済みにする（呼び出し側のトランザクション内で実行）
+    同timestampが複数ある場合は未処理→古い順で1件だけ更新する
+    """
+    updated = 0
+    for timestamp, parsed_data in results:
+        cur = c.execute(f"""
+            UPDATE {table} SET parsed_data = ?, processed = 1
+            WHERE id = (
+                SELECT id FROM {table} WHERE timestamp = ?
+                ORDER BY processed ASC, id ASC LIMIT 1
+            )
+        """, (json.dumps(parsed_data, ensure_ascii=False), timestamp))
+        updated += cur.rowcount
+    return updated
+
+def mark_line_order_parsed(timestamp: str, parsed_data) -> bool:
+    """
+    解析結果を保存して処理済みにする（1行UPDATE）
+    同timestampが複数ある場合は未処理→古い順で1件だけ更新する
+    """
+    return mark_line_orders_parsed([(timestamp, parsed_data)]) > 0
+
+def mark_line_orders_parsed(results) -> int:
+    """
+    複数の解析結果を1トランザクションでまとめて保存する
+    results: [(timestamp, parsed_data), ...]
+    戻り値は更新できた件数
+    """
+    with _conn() as c:
+        return _mark_parsed(c, "line_orders", results)
+
+def list_line_orders(line_account: str = None) -> list:
+    """LINE注文を登録順で取得（line_account指定時はそのアカウント分のみ）"""
+    sql = f"SELECT {', '.join(_LINE_ORDER_COLS)} FROM line_orders"
+    params = ()
+    if line_account is not None:
+        sql += " WHERE line_account = ?"
+        params = (line_account,)
+    with _conn() as c:
+        rows = c.execute(sql + " ORDER BY id", params).fetchall()
+    return [_line_order_from_row(r) for r in rows]
+
+def delete_line_orders_by_timestamp(timestamp: str) -> list:
+    """指定timestampのLINE注文を削除し、削除した画像ファイル名のリストを返す"""
+    with _conn() as c:
+        files = [r[0] for r in c.execute(
+            "SELECT image_filename FROM line_orders WHERE timestamp = ?", (timestamp,)).fetchall()]
+        c.execute("DELETE FROM line_orders WHERE timestamp = ?", (timestamp,))
+    return files
+
+def delete_processed_line_order_rows() -> list:
+    """処理済みLINE注文を削除し、削除した画像ファイル名のリストを返す"""
+    with _conn() as c:
+        files = [r[0] for r in c.execute(
+            "SELECT image_filename FROM line_orders WHERE processed = 1").fetchall()]
+        c.execute("DELETE FROM line_orders WHERE processed = 1")
+    return files
+
+def import_line_orders_json(json_path) -> int:
+    """
+    旧形式の line_orders/orders.json を line_orders テーブルへ一度だけ取り込む
+    - 取り込み済みのtimestampはスキップ（途中で落ちても再実行で重複しない）
+    - 完了後は orders.json を orders.json.migrated にリネーム
+    """
+    json_path = Path(json_path)
+    if not json_path.exists():
+        return 0
+
+    with open(json_path, "r", encoding="utf-8") as f:
+        orders = json.load(f) or []
+
+    with _conn() as c:
+        existing = {r[0] for r in c.execute("SELECT timestamp FROM line_orders").fetchall()}
+        new_orders = [o for o in orders if o.get("timestamp") and o["timestamp"] not in existing]
+        c.executemany(f"""
+            INSERT INTO line_orders ({", ".join(_LINE_ORDER_COLS)})
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, [_line_order_params(o) for o in new_orders])
+
+    json_path.replace(json_path.with_name(json_path.name + ".migrated"))
+    return len(new_orders)
+
+
+# ========= テキスト注文キュー =========
+
+_TEXT_ORDER_COLS = ["account", "customer_name", "message_text", "order_date",
+                    "delivery_date_opt", "timestamp", "processed", "parsed_data"]
+
+def _text_order_from_row(row) -> dict:
+    """text_orders の1行を従来のorders.jsonと同じ形のdictに変換"""
+    order = dict(zip(_TEXT_ORDER_COLS, row))
+    order["processed"] = bool(order["processed"])
+    order["parsed_data"] = json.loads(order["parsed_data"]) if order["parsed_data"] else None
+    return order
+
+def _text_order_params(order: dict) -> tuple:
+    parsed = order.get("parsed_data")
+    return (order.get("account"), order.get("customer_name"), order.get("message_text"),
+            order.get("order_date"), order.get("delivery_date_opt", ""), order.get("timestamp"),
+            1 if order.get("processed", False) else 0,
+            json.dumps(parsed, ensure_ascii=False) if parsed is not None else None)
+
+def insert_text_order(order: dict):
+    """テキスト注文を1件キューに追加（1行INSERT）"""
+    with _conn() as c:
+        c.execute(f"""
+            INSERT INTO text_orders ({", ".join(_TEXT_ORDER_COLS)})
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, _text_order_params(order))
+
+def mark_text_orders_parsed(results) -> int:
+    """
+    複数の解析結果を1トランザクションでまとめて保存する
+    results: [(timestamp, parsed_data), ...]
+    戻り値は更新できた件数
+    """
+    with _conn() as c:
+        return _mark_parsed(c, "text_orders", results)
+
+def list_text_orders(account: str = None) -> list:
+    """テキスト注文を登録順で取得（account指定時はそのアカウント分のみ）"""
+    sql = f"SELECT {', '.join(_TEXT_ORDER_COLS)} FROM text_orders"
+    params = ()
+    if account is not None:
+        sql += " WHERE account = ?"
+        params = (account,)
+    with _conn() as c:
+        rows = c.execute(sql + " ORDER BY id", params).fetchall()
+    return [_text_order_from_row(r) for r in rows]
+
+def delete_text_orders_by_timestamp(timestamp: str) -> int:
+    """指定timestampのテキスト注文を削除し、削除件数を返す"""
+    with _conn() as c:
+        return c.execute("DELETE FROM text_orders WHERE timestamp = ?", (timestamp,)).rowcount
+
+def delete_processed_text_order_rows() -> int:
+    """処理済みテキスト注文を削除し、削除件数を返す"""
+    with _conn() as c:
+        return c.execute("DELETE FROM text_orders WHERE processed = 1").rowcount
+
+def import_text_orders_json(json_path) -> int:
+    """
+    旧形式の text_orders/orders.json を text_orders テーブルへ一度だけ取り込む
+    （取り込み方針は import_line_orders_json と同じ）
+    """
+    json_path = Path(json_path)
+    if not json_path.exists():
+        return 0
+
+    with open(json_path, "r", encoding="utf-8") as f:
+        orders = json.load(f) or []
+
+    with _conn() as c:
+        existing = {r[0] for r in c.execute("SELECT timestamp FROM text_orders").fetchall()}
+        new_orders = [o for o in orders if o.get("timestamp") and o["timestamp"] not in existing]
+        c.executemany(f"""
+            INSERT INTO text_orders ({", ".join(_TEXT_ORDER_COLS)})
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, [_text_order_params(o) for o in new_orders])
+
+    json_path.replace(json_path.with_name(json_path.name + ".migrated"))
+    return len(new_orders)
+
+
+def unprocessed_order_counts(account: str) -> dict:
+    """未解析のLINE注文・テキスト注文の件数（バックログ表示用）"""
+    with _conn() as c:
+        line = c.execute("SELECT COUNT(*) FROM line_orders WHERE line_account = ? AND processed = 0",
+                         (account,)).fetchone()[0]
+        text = c.execute("SELECT COUNT(*) FROM text_orders WHERE account = ? AND processed = 0",
+                         (account,)).fetchone()[0]
+    return {"line": line, "text": text}
+
+
+# ========= アカウント設定 =========
+
+def get_account_setting(account: str, key: str, default=None):
+    """アカウントごとの設定値を取得（未設定なら default）"""
+    with _conn() as c:
+        row = c.execute("SELECT value FROM account_settings WHERE account = ? AND key = ?",
+                        (account, key)).fetchone()
+    return row[0] if row else default
+
+def set_account_setting(account: str, key: str, value):
+    """アカウントごとの設定値を保存"""
+    with _conn() as c:
+        c.execute("""
+            INSERT INTO account_settings (account, key, value) VALUES (?, ?, ?)
+            ON CONFLICT(account, key) DO UPDATE SET value = excluded.value
+        """, (account, key, None if value is None else str(value)))
+
+
+# ========= LLM解析ジョブ =========
+# Streamlit側は enqueue_job() で登録して状態を参照するだけ。解析は llm_worker.py が行う
+# - lease_jobs(): 優先度の高い順に取り出し、一定時間のリース（lease_until）を付ける
+# - heartbeat_jobs(): 処理中のリースを延長。ワーカーが落ちればリース切れで他のワーカーが再取得する
+# - fail_job(): 指数バックオフで再試行し、max_attempts を超えたら dead（デッドレター）にする
+# - claim_job_results(): 完了した手書きPDFの結果を取り込み済みにして返す（アカウント単位。登録した画面でなくてもよい）
+
+_JOB_COLS = ["id", "kind", "ref", "account", "payload", "priority", "status", "attempts",
+             "max_attempts", "lease_owner", "lease_until", "available_at", "result", "error",
+             "created_at", "updated_at", "imported_at"]
+
+def _job_from_row(row) -> dict:
+    job = dict(zip(_JOB_COLS, row))
+    job["payload"] = json.loads(job["payload"]) if job["payload"] else {}
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+def enqueue_job(kind: str, ref: str, account: str, payload: dict,
+                priority: int = 0, max_attempts: int = 3) -> int:
+    """
+    解析ジョブを登録してジョブIDを返す
+    同じ kind/ref のジョブが待機中・処理中なら新規登録せず、優先度だけ引き上げてそのIDを返す
+    """
+    now = time.time()
+    with _conn() as c:
+        row = c.execute("""
+            SELECT id FROM llm_jobs
+            WHERE kind = ? AND ref = ? AND status IN ('queued', 'running')
+            ORDER BY id LIMIT 1
+        """, (kind, ref)).fetchone()
+        if row:
+            c.execute("UPDATE llm_jobs SET priority = MAX(priority, ?), updated_at = ? WHERE id = ?",
+                      (priority, now, row[0]))
+            return row[0]
+        cur = c.execute("""
+            INSERT INTO llm_jobs (kind, ref, account, payload, priority, max_attempts,
+                                  available_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (kind, ref, account, json.dumps(payload, ensure_ascii=False), priority, max_attempts,
+              now, now, now))
+        return cur.lastrowid
+
+def lease_jobs(owner: str, limit: int, lease_seconds: float) -> list:
+    """
+    実行可能なジョブを優先度順に最大 limit 件リースする（1文のUPDATEで取り合いを防ぐ）
+    リース切れの処理中ジョブも対象。再試行回数を使い切ったリース切れジョブは dead にする
+    """
+    now = time.time()
+    with _conn() as c:
+        c.execute("""
+            UPDATE llm_jobs SET status = 'dead', lease_owner = NULL, updated_at = ?,
+                   error = COALESCE(error, 'リース期限切れ（ワーカー停止）')
+            WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts
+        """, (now, now))
+        rows = c.execute(f"""
+            UPDATE llm_jobs
+            SET status = 'running', lease_owner = ?, lease_until = ?,
+                attempts = attempts + 1, updated_at = ?
+            WHERE id IN (
+                SELECT id FROM llm_jobs
+                WHERE (status = 'queued' AND available_at <= ?)
+                   OR (status = 'running' AND lease_until < ?)
+                ORDER BY priority DESC, available_at, id
+                LIMIT ?
+            )
+            RETURNING {", ".join(_JOB_COLS)}
+        """, (owner, now + lease_seconds, now, now, now, int(limit))).fetchall()
+    jobs = [_job_from_row(r) for r in rows]
+    jobs.sort(key=lambda j: (-j["priority"], j["id"]))
+    return jobs
+
+def heartbeat_jobs(owner: str, job_ids, lease_seconds: float) -> int:
+    """処理中ジョブのリースを延長し、延長できた件数を返す"""
+    job_ids = list(job_ids)
+    if not job_ids:
+        return 0
+    now = time.time()
+    with _conn() as c:
+        return c.executemany("""
+            UPDATE llm_jobs SET lease_until = ?, updated_at = ?
+            WHERE id = ? AND lease_owner = ? AND status = 'running'
+        """, [(now + lease_seconds, now, job_id, owner) for job_id in job_ids]).rowcount
+
+def complete_job(job_id: int, owner: str, result) -> bool:
+    """
+    ジョブを完了にする。LINE/テキストは同じトランザクションで注文キューへ解析結果を書き込む
+    リースを失っていた（他のワーカーに再取得された）場合は何もせず False
+    """
+    now = time.time()
+    with _conn() as c:
+        row = c.execute("SELECT kind, ref FROM llm_jobs WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                        (job_id, owner)).fetchone()
+        if not row:
+            return False
+        kind, ref = row
+        c.execute("""
+            UPDATE llm_jobs SET status = 'done', result = ?, error = NULL,
+                   lease_owner = NULL, lease_until = NULL, updated_at = ?
+            WHERE id = ?
+        """, (json.dumps(result, ensure_ascii=False), now, job_id))
+        if kind == "line":
+            _mark_parsed(c, "line_orders", [(ref, result)])
+        elif kind == "text":
+            _mark_parsed(c, "text_orders", [(ref, result)])
+    return True
+
+def fail_job(job_id: int, owner: str, error: str, permanent: bool = False) -> str:
+    """
+    ジョブの失敗を記録し、新しい状態（queued / dead）を返す
+    再試行は 15秒, 30秒, 60秒...（最大5分）後。permanent=True なら即 dead
+    """
+    now = time.time()
+    with _conn() as c:
+        row = c.execute("SELECT attempts, max_attempts FROM llm_jobs WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                        (job_id, owner)).fetchone()
+        if not row:
+            return ""
+        attempts, max_attempts = row
+        status = "dead" if permanent or attempts >= max_attempts else "queued"
+        delay = min(300, 15 * 2 ** max(0, attempts - 1))
+        c.execute("""
+            UPDATE llm_jobs SET status = ?, error = ?, available_at = ?,
+                   lease_owner = NULL, lease_until = NULL, updated_at = ?
+            WHERE id = ?
+        """, (status, str(error)[:2000], now + delay, now, job_id))
+    return status
+
+def get_jobs(job_ids) -> dict:
+    """ジョブIDのリストから {id: ジョブ} を取得"""
+    job_ids = list(job_ids)
+    if not job_ids:
+        return {}
+    with _conn() as c:
+        rows = c.execute(f"""
+            SELECT {", ".join(_JOB_COLS)} FROM llm_jobs
+            WHERE id IN ({", ".join("?" * len(job_ids))})
+        """, job_ids).fetchall()
+    return {r[0]: _job_from_row(r) for r in rows}
+
+def claim_job_results(account: str, kind: str) -> list:
+    """
+    完了済みで未取り込みのジョブを取り込み済みにして古い順に返す
+    1文のUPDATEで印を付けるため、同じアカウントの画面が複数あっても結果は1回だけ返る
+    """
+    now = time.time()
+    with _conn() as c:
+        rows = c.execute(f"""
+            UPDATE llm_jobs SET imported_at = ?
+            WHERE account = ? AND kind = ? AND status = 'done' AND imported_at IS NULL
+            RETURNING {", ".join(_JOB_COLS)}
+        """, (now, account, kind)).fetchall()
+    jobs = [_job_from_row(r) for r in rows]
+    jobs.sort(key=lambda j: j["id"])
+    return jobs
+
+def list_jobs(account: str = None, statuses=None, limit: int = 100) -> list:
+    """ジョブを新しい順に取得（account / 状態で絞り込み）"""
+    where, params = [], []
+    if account is not None:
+        where.append("account = ?")
+        params.append(account)
+    if statuses:
+        where.append(f"status IN ({', '.join('?' * len(statuses))})")
+        params.extend(statuses)
+    sql = f"SELECT {', '.join(_JOB_COLS)} FROM llm_jobs"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    with _conn() as c:
+        rows = c.execute(sql + " ORDER BY id DESC LIMIT ?", (*params, int(limit))).fetchall()
+    return [_job_from_row(r) for r in rows]
+
+def job_counts(account: str = None) -> dict:
+    """状態ごとのジョブ件数 {queued, running, done, dead}"""
+    sql = "SELECT status, COUNT(*) FROM llm_jobs"
+    params = ()
+    if account is not None:
+        sql += " WHERE account = ?"
+        params = (account,)
+    counts = {"queued": 0, "running": 0, "done": 0, "dead": 0}
+    with _conn() as c:
+        for status, n in c.execute(sql + " GROUP BY status", params):
+            counts[status] = n
+    return counts
+
+def active_job_refs(kind: str, account: str = None) -> set:
+    """待機中・処理中ジョブの ref（注文のtimestamp等）の集合"""
+    sql = "SELECT ref FROM llm_jobs WHERE kind = ? AND status IN ('queued', 'running')"
+    params = [kind]
+    if account is not None:
+        sql += " AND account = ?"
+        params.append(account)
+    with _conn() as c:
+        return {r[0] for r in c.execute(sql, params)}
+
+def requeue_job(job_id: int) -> bool:
+    """デッドレターのジョブを再試行回数をリセットして待機中に戻す"""
+    now = time.time()
+    with _conn() as c:
+        return c.execute("""
+            UPDATE llm_jobs SET status = 'queued', attempts = 0, error = NULL,
+                   available_at = ?, updated_at = ?
+            WHERE id = ? AND status = 'dead'
+        """, (now, now, job_id)).rowcount > 0
+
+def delete_job(job_id: int) -> dict:
+    """ジョブを削除し、削除したジョブ（なければ None）を返す"""
+    with _conn() as c:
+        row = c.execute(f"SELECT {', '.join(_JOB_COLS)} FROM llm_jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row:
+            return None
+        c.execute("DELETE FROM llm_jobs WHERE id = ?", (job_id,))
+    return _job_from_row(row)
+
+def purge_finished_jobs(older_than_seconds: float) -> int:
+    """完了済みジョブのうち古いものを削除し、削除件数を返す（デッドレターは残す）"""
+    with _conn() as c:
+        return c.execute("DELETE FROM llm_jobs WHERE status = 'done' AND updated_at < ?",
+                         (time.time() - older_than_seconds,)).rowcount
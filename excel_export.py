@@ -0,0 +1,192 @@
+# excel_export.py
+# 注文一覧・組織内集計のExcelブック生成
+# - 画面の再実行ごとには作らず、「Excelを作成」ボタンが押されたときだけ生成する
+# - 生成結果は「入力DataFrameのハッシュ + 書式プロファイル」をキーにメモリへ保持（同じ内容なら再生成しない）
+# - 生成時間の内訳（シートごとの書き込み・書式・圧縮）を記録し、管理者の診断表示に使う
+import io
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, deque
+import pandas as pd
+from config import get_excel_cache_max_mb
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# 書式プロファイル（内容を変えたら version を上げる → 以前のキャッシュは使われない）
+ORDER_PROFILE = {
+    "name": "注文一覧",
+    "version": 1,
+    "widths": {"発注日": 105, "納品日": 105, "商品名": 244, "備考": 244},
+    "fit_to_pages": (1, 0),      # 横1ページ・縦は制限なし（0 = 制限なし）
+    "print_quality": 600,
+    "clear_page_breaks": True,
+}
+ORG_PROFILE = {
+    "name": "組織内集計",
+    "version": 1,
+    "widths": {},
+    "fit_to_pages": (1, 0),
+    "skip_empty": True,          # 空の集計はシートを作らない
+}
+
+_cache = OrderedDict()          # key -> bytes（古い参照順に追い出す）
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+_recent = deque(maxlen=10)      # 直近の生成記録（管理者の診断表示用）
+
+
+def frame_digest(df: pd.DataFrame) -> str:
+    """DataFrameの内容（列名・型・値）のハッシュ"""
+    h = hashlib.sha256()
+    h.update(json.dumps([str(c) for c in df.columns], ensure_ascii=False).encode("utf-8"))
+    h.update(json.dumps([str(t) for t in df.dtypes]).encode("utf-8"))
+    try:
+        h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    except TypeError:
+        # セルにリスト等のハッシュできない値がある場合
+        h.update(df.to_csv(index=False).encode("utf-8"))
+    return h.hexdigest()
+
+def _workbook_key(sheets, profile) -> str:
+    h = hashlib.sha256()
+    h.update(json.dumps([profile["name"], profile["version"]], ensure_ascii=False).encode("utf-8"))
+    for sheet_name, df in sheets:
+        h.update(sheet_name.encode("utf-8"))
+        h.update(frame_digest(df).encode("ascii"))
+    return h.hexdigest()
+
+def _cache_get(key):
+    with _cache_lock:
+        data = _cache.get(key)
+        if data is not None:
+            _cache.move_to_end(key)
+        return data
+
+def _cache_put(key, data: bytes):
+    global _cache_bytes
+    limit = get_excel_cache_max_mb() * 1024 * 1024
+    if len(data) > limit:
+        return
+    with _cache_lock:
+        if key in _cache:
+            return
+        _cache[key] = data
+        _cache_bytes += len(data)
+        while _cache_bytes > limit and _cache:
+            _, old = _cache.popitem(last=False)
+            _cache_bytes -= len(old)
+
+
+def _build(sheets, profile):
+    """ブックを生成（戻り値: (bytes, [(工程, 秒), ...])）"""
+    timings = []
+    started = time.perf_counter()
+    output = io.BytesIO()
+    writer = pd.ExcelWriter(output, engine='xlsxwriter')
+    workbook = writer.book
+    header_format = workbook.add_format({'bold': False, 'border': 0})
+    # 罫線フォーマット（薄い黒 RGB:50,50,50）
+    border_format = workbook.add_format({'border': 1, 'border_color': '#323232'})
+
+    written = []
+    for sheet_name, df in sheets:
+        if df.empty and profile.get("skip_empty"):
+            continue
+        t = time.perf_counter()
+        df.to_excel(writer, index=False, sheet_name=sheet_name, startrow=1, header=False)
+        ws = writer.sheets[sheet_name]
+        for col_num, value in enumerate(df.columns.values):
+            ws.write(0, col_num, value, header_format)
+        timings.append((f"シート「{sheet_name}」{len(df):,}行", time.perf_counter() - t))
+        written.append((ws, df))
+
+    t = time.perf_counter()
+    for ws, df in written:
+        # 列幅（ピクセル指定）
+        for i, label in enumerate(df.columns):
+            if label in profile["widths"]:
+                ws.set_column_pixels(i, i, profile["widths"][label])
+        # 表全体に罫線
+        if not df.empty:
+            ws.conditional_format(0, 0, len(df), len(df.columns) - 1, {
+                'type': 'cell',
+                'criteria': '>=',
+                'value': 0,
+                'format': border_format
+            })
+        # 印刷設定
+        ws.set_landscape()     # 横向き
+        ws.set_paper(9)        # A4
+        ws.fit_to_pages(*profile["fit_to_pages"])
+        ws.set_margins(left=0.3, right=0.3, top=0.5, bottom=0.5)
+        ws.repeat_rows(0, 0)   # 1行目（見出し）を各ページに繰り返し
+        # 印刷品質・改ページのクリア（XlsxWriterのバージョンによってはメソッドが無いのでスキップ）
+        try:
+            if profile.get("print_quality"):
+                ws.set_print_quality(profile["print_quality"])
+        except AttributeError:
+            pass
+        try:
+            if profile.get("clear_page_breaks"):
+                ws.set_h_pagebreaks([])
+                ws.set_v_pagebreaks([])
+        except AttributeError:
+            pass
+    timings.append(("書式・印刷設定", time.perf_counter() - t))
+
+    t = time.perf_counter()
+    writer.close()
+    timings.append(("保存（xlsx圧縮）", time.perf_counter() - t))
+    data = output.getvalue()
+    timings.append(("合計", time.perf_counter() - started))
+    return data, timings
+
+def get_workbook(sheets, profile) -> tuple:
+    """
+    シート一覧 [(シート名, DataFrame), ...] からExcelブックを取得（同じ内容・書式なら保持済みのものを返す）
+    戻り値: (bytes, stats)  stats = {"profile", "cached", "bytes", "timings", "at"}
+    """
+    t = time.perf_counter()
+    key = _workbook_key(sheets, profile)
+    hash_seconds = time.perf_counter() - t
+    data = _cache_get(key)
+    cached = data is not None
+    if cached:
+        timings = [("ハッシュ", hash_seconds)]
+    else:
+        data, timings = _build(sheets, profile)
+        timings.insert(0, ("ハッシュ", hash_seconds))
+        _cache_put(key, data)
+        logger.info(f"[Excel生成] {profile['name']} {len(data):,}バイト {timings[-1][1]:.2f}秒")
+    stats = {"profile": profile["name"], "cached": cached, "bytes": len(data), "timings": timings,
+             "at": time.strftime("%H:%M:%S")}
+    _recent.append(stats)
+    return data, stats
+
+def order_workbook(edited_df, df_sorted, df_agg) -> tuple:
+    """編集タブの3シート（注文一覧 / 注文一覧(層別結果) / 集計結果）"""
+    return get_workbook([
+        ("注文一覧", edited_df),
+        ("注文一覧(層別結果)", df_sorted),
+        ("集計結果", df_agg),
+    ], ORDER_PROFILE)
+
+def org_summary_workbook(df_acc, df_prd, df_ptn) -> tuple:
+    """組織内集計の3シート（空の集計は省略）"""
+    return get_workbook([
+        ("アカウント別集計", df_acc),
+        ("商品別集計", df_prd),
+        ("取引先別集計", df_ptn),
+    ], ORG_PROFILE)
+
+def recent_builds() -> list:
+    """直近のExcel生成記録（新しい順）"""
+    return list(reversed(_recent))
+
+def cache_info() -> dict:
+    with _cache_lock:
+        return {"entries": len(_cache), "bytes": _cache_bytes}
@@ -0,0 +1,194 @@
+# format_detect.py
+# アップロードファイルの形式・エンコーディング判定（全パーサー共通）
+# - CSV/TXT は先頭の数十KBだけをデコードしてエンコーディングと形式（Infomart / IPORTER）を1回で決める
+#   （先頭がASCIIだけのときは、ASCII以外のバイトが出てくるまで読み進めてエンコーディングを決める）
+# - XLSX は read-only で開いて判定に必要なセル（B5）だけを読み、開いたブックをそのままパーサーに渡す
+# - 判定結果には所要時間と確からしさ（confidence）を含める
+import io
+import time
+import codecs
+import logging
+from dataclasses import dataclass, field, replace
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+SNIFF_BYTES = 64 * 1024
+PARSEABLE_FORMATS = ("infomart", "iporter", "mitsubishi")
+_UTF8_BOM = codecs.BOM_UTF8
+_XLSX_MAGIC = b"PK\x03\x04"
+
+
+@dataclass
+class Detection:
+    """判定結果（source はパーサーにそのまま渡せる入力: BytesIO または openpyxl のブック）"""
+    format: str                      # infomart / iporter / mitsubishi / pdf / unknown
+    encoding: str = None
+    confidence: float = 0.0          # 0〜1
+    seconds: float = 0.0
+    log: list = field(default_factory=list)
+    source: object = None
+
+    def close(self):
+        """開いたブックを閉じる（read-only のブックはファイルを開いたままにするため）"""
+        if hasattr(self.source, "close") and not isinstance(self.source, io.IOBase):
+            self.source.close()
+
+
+def sniff_encoding(head: bytes) -> tuple:
+    """
+    先頭バイト列からエンコーディングを判定
+    戻り値: (エンコーディング, confidence)。読めなければ (None, 0.0)
+    """
+    if head.startswith(_UTF8_BOM):
+        return "utf-8-sig", 1.0
+    for enc in ("utf-8", "cp932"):
+        try:
+            # 末尾で途切れた文字は許容（final=False）
+            codecs.getincrementaldecoder(enc)().decode(head, final=False)
+        except UnicodeDecodeError:
+            continue
+        if head.isascii():
+            # ASCIIだけでは区別できない（国内の出力はShift_JIS系が多いので cp932 とする）
+            return "cp932", 0.5
+        # Shift_JIS系の日本語がUTF-8として偶然正しく読めることはほぼない
+        return enc, 0.99 if enc == "utf-8" else 0.9
+    return None, 0.0
+
+def sniff_file_encoding(file) -> tuple:
+    """
+    ファイル（バイナリ）のエンコーディングを判定（ファイル位置は先頭に戻す）
+    先頭がASCIIだけで区別できないときは、ASCII以外のバイトが出てくるまで読み進めて判定する
+    戻り値: (エンコーディング, confidence, 判定に読んだバイト数)
+    """
+    file.seek(0)
+    chunk = file.read(SNIFF_BYTES)
+    enc, conf = sniff_encoding(chunk)
+    read = len(chunk)
+    while enc is not None and chunk.isascii() and len(chunk) == SNIFF_BYTES:
+        # 直前までASCIIなので、次のかたまりは文字の途中から始まらない
+        chunk = file.read(SNIFF_BYTES)
+        read += len(chunk)
+        if not chunk.isascii():
+            enc, conf = sniff_encoding(chunk)
+    file.seek(0)
+    return enc, conf, read
+
+def decodes_as(file, encoding: str) -> bool:
+    """ファイル全体が encoding で読めるか（少しずつデコードして確かめる。ファイル位置は先頭に戻す）"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    file.seek(0)
+    try:
+        for chunk in iter(lambda: file.read(SNIFF_BYTES), b""):
+            decoder.decode(chunk)
+        decoder.decode(b"", final=True)
+        return True
+    except UnicodeDecodeError:
+        return False
+    finally:
+        file.seek(0)
+
+def _first_cell(text: str) -> str:
+    first_line = text.split("\n", 1)[0].strip().split(",")
+    return first_line[0].replace('"', '').replace("'", '').strip() if first_line else ""
+
+def _detect_csv(content: bytes, det: Detection):
+    source = io.BytesIO(content)
+    head = content[:SNIFF_BYTES]
+    enc, enc_conf, sniffed = sniff_file_encoding(source)
+    det.log.append(f"[エンコーディング] {enc}（confidence={enc_conf:.2f}, 先頭{sniffed:,}バイトで判定）")
+    if enc is None:
+        det.format = "unknown"
+        return
+    text = codecs.getincrementaldecoder(enc)().decode(head, final=False)
+    cell0 = _first_cell(text)
+    det.log.append(f"[{enc}] first_cell={cell0!r}")
+    det.encoding = enc
+    if cell0 == "H":
+        det.format = "infomart"
+        # 2行目の見出し（［伝票No］）まで確認できれば確度を上げる
+        second = text.split("\n", 2)[1] if text.count("\n") >= 1 else ""
+        det.confidence = enc_conf if "［伝票No］" in second else enc_conf * 0.8
+    elif cell0 == "伝票番号":
+        det.format = "iporter"
+        det.confidence = enc_conf
+    else:
+        det.format = "unknown"
+        return
+    det.source = source
+
+def _detect_xlsx(content: bytes, det: Detection):
+    import openpyxl
+    if not content.startswith(_XLSX_MAGIC):
+        det.format = "unknown"
+        det.log.append("XLSX（ZIP）形式ではありません")
+        return
+    wb = openpyxl.load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+    ws = wb.worksheets[0]
+    b5 = next(ws.iter_rows(min_row=5, max_row=5, min_col=2, max_col=2, values_only=True), (None,))[0]
+    det.log.append(f"[{ws.title}] B5={b5!r}")
+    if str(b5).strip() == "伝票番号":
+        det.format = "mitsubishi"
+        det.confidence = 1.0
+        det.source = wb
+    else:
+        det.format = "unknown"
+        wb.close()
+
+def detect_upload(content: bytes, filename: str) -> Detection:
+    """アップロードファイルの形式を判定（CSV/TXT・XLSX・PDF）"""
+    started = time.perf_counter()
+    det = Detection(format="unknown")
+    name = (filename or "").lower()
+    try:
+        if name.endswith((".txt", ".csv")):
+            _detect_csv(content, det)
+        elif name.endswith(".xlsx"):
+            _detect_xlsx(content, det)
+        elif name.endswith(".pdf"):
+            det.format = "pdf"
+            det.confidence = 1.0 if content.startswith(b"%PDF") else 0.5
+            det.source = content
+    except Exception as e:
+        det.format = "unknown"
+        det.log.append(f"判定エラー: {e}")
+    det.seconds = time.perf_counter() - started
+    det.log.append(f"判定: {det.format}（confidence={det.confidence:.2f}, {det.seconds * 1000:.1f}ms）")
+    logger.info(f"[形式判定] {filename}: {det.format} enc={det.encoding} confidence={det.confidence:.2f} {det.seconds * 1000:.1f}ms")
+    return det
+
+def parse_detected(det: Detection, filename: str, order_filter=None) -> list:
+    """判定済みの入力を対応するパーサーで解析（CSV/XLSX のみ。PDFは呼び出し側で扱う）"""
+    # パーサー側がこのモジュールの sniff_encoding を使うため、ここで import する
+    from parser_infomart import parse_infomart
+    from parser_iporter import parse_iporter
+    from parser_mitsubishi import parse_mitsubishi
+    if det.format == "infomart":
+        return parse_infomart(det.source, filename, order_filter=order_filter, encoding=det.encoding)
+    if det.format == "iporter":
+        return parse_iporter(det.source, filename, encoding=det.encoding, order_filter=order_filter)
+    if det.format == "mitsubishi":
+        try:
+            return parse_mitsubishi(det.source, filename, order_filter=order_filter)
+        finally:
+            det.close()
+    raise ValueError(f"{filename} は未対応のフォーマットです")
+
+def parse_upload(content: bytes, filename: str, order_filter=None) -> dict:
+    """
+    判定から解析までを1回で実行（プロセスプールで並列に呼べるよう、結果は pickle できる dict で返す）
+    戻り値: {"format", "encoding", "confidence", "log", "detect_seconds", "parse_seconds", "records", "skipped_slips"}
+    未対応の形式は records=None
+    """
+    det = detect_upload(content, filename)
+    result = {"format": det.format, "encoding": det.encoding, "confidence": det.confidence, "log": det.log,
+              "detect_seconds": det.seconds, "parse_seconds": 0.0, "records": None, "skipped_slips": 0}
+    if det.format not in PARSEABLE_FORMATS:
+        return result
+    # 除外数はファイルごとに数える（並列実行中に他のファイルと数が混ざらないよう複製）
+    order_filter = replace(order_filter, skipped_slips=0) if order_filter is not None else None
+    started = time.perf_counter()
+    result["records"] = parse_detected(det, filename, order_filter=order_filter)
+    result["parse_seconds"] = time.perf_counter() - started
+    result["skipped_slips"] = order_filter.skipped_slips if order_filter is not None else 0
+    return result
@@ -0,0 +1,169 @@
+# history_export.py
+# 履歴（DB）のエクスポート
+# - SQLiteからチャンク単位で読み、xlsxwriter の constant_memory モード / CSV / Parquet に逐次書き込む
+# - 出力は APP_DATA_DIR/exports の一時ファイル（全件をメモリに載せないため、履歴の量に関係なくメモリ使用量は一定）
+# - Excelの1シートの行数上限を超える場合はシートを分割（全注文履歴, 全注文履歴_2, ...）
+import os
+import csv
+import time
+import logging
+import tempfile
+from pathlib import Path
+import xlsxwriter
+from config import load_config
+from db import iter_history_rows
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet出力は pyarrow がある環境のみ
+    pa = pq = None
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+CONFIG = load_config()
+EXPORT_DIR = Path(CONFIG.get("app_data_dir")) / "exports"
+EXPORT_MAX_AGE = 86400
+EXCEL_MAX_DATA_ROWS = 1_048_575  # 1,048,576行 - 見出し行
+CHUNK_ROWS = 5000
+
+FORMATS = {
+    "xlsx": ("Excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": ("CSV", "text/csv"),
+}
+if pq is not None:
+    FORMATS["parquet"] = ("Parquet", "application/vnd.apache.parquet")
+
+
+def _format_created(value):
+    """登録日時の表示形式（2025-09-15T07:27:18 → 2025/09/15）"""
+    return value.split('T')[0].replace('-', '/') if value and 'T' in str(value) else value
+
+def _display_rows(cols, rows):
+    i = cols.index("登録日時")
+    for row in rows:
+        row = list(row)
+        row[i] = _format_created(row[i])
+        yield row
+
+def prune_exports(max_age: float = EXPORT_MAX_AGE):
+    """古いエクスポートファイルを削除"""
+    if not EXPORT_DIR.exists():
+        return
+    limit = time.time() - max_age
+    for f in EXPORT_DIR.iterdir():
+        try:
+            if f.is_file() and f.stat().st_mtime < limit:
+                f.unlink()
+        except OSError:
+            pass
+
+
+def _write_xlsx(path, chunks) -> int:
+    """constant_memory モードで行を逐次書き込む（行数上限でシートを分割）"""
+    workbook = xlsxwriter.Workbook(str(path), {"constant_memory": True})
+    header_format = workbook.add_format({'bold': False, 'border': 0})
+    border_format = workbook.add_format({'border': 1, 'border_color': '#323232'})  # 薄い黒 RGB(50,50,50)
+    widths = {"発注日": 105, "納品日": 105, "商品名": 244, "備考": 244}
+    sheet, sheet_rows, total, cols = None, 0, 0, None
+
+    def _finish(ws, data_rows):
+        # 罫線・印刷設定（constant_memory でも条件付き書式はシート単位で最後に書き出される）
+        if data_rows:
+            ws.conditional_format(0, 0, data_rows, len(cols) - 1, {
+                'type': 'cell', 'criteria': '>=', 'value': 0, 'format': border_format
+            })
+        ws.set_landscape()
+        ws.set_paper(9)
+        ws.fit_to_pages(1, 0)
+        ws.set_margins(left=0.3, right=0.3, top=0.5, bottom=0.5)
+        ws.repeat_rows(0, 0)
+
+    def _new_sheet(n):
+        ws = workbook.add_worksheet("全注文履歴" if n == 1 else f"全注文履歴_{n}")
+        for i, label in enumerate(cols):
+            if label in widths:
+                ws.set_column_pixels(i, i, widths[label])
+        ws.write_row(0, 0, cols, header_format)
+        return ws
+
+    sheet_no = 0
+    for chunk_cols, rows in chunks:
+        cols = chunk_cols
+        for row in _display_rows(cols, rows):
+            if sheet is None or sheet_rows >= EXCEL_MAX_DATA_ROWS:
+                if sheet is not None:
+                    _finish(sheet, sheet_rows)
+                sheet_no += 1
+                sheet, sheet_rows = _new_sheet(sheet_no), 0
+            sheet_rows += 1
+            sheet.write_row(sheet_rows, 0, row)
+            total += 1
+    if sheet is None:
+        workbook.add_worksheet("全注文履歴")
+    else:
+        _finish(sheet, sheet_rows)
+    workbook.close()
+    return total
+
+def _write_csv(path, chunks) -> int:
+    total = 0
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:  # BOM付き（Excelでそのまま開ける）
+        writer = csv.writer(f)
+        header_written = False
+        for cols, rows in chunks:
+            if not header_written:
+                writer.writerow(cols)
+                header_written = True
+            writer.writerows(_display_rows(cols, rows))
+            total += len(rows)
+    return total
+
+def _write_parquet(path, chunks) -> int:
+    total, writer = 0, None
+    schema = None
+    try:
+        for cols, rows in chunks:
+            columns = list(zip(*_display_rows(cols, rows)))
+            if schema is None:
+                # 数値列は float、それ以外は文字列に揃える（チャンクごとに型がぶれないように）
+                numeric = {"id", "数量", "単価", "金額"}
+                schema = pa.schema([(c, pa.float64() if c in numeric else pa.string()) for c in cols])
+                writer = pq.ParquetWriter(str(path), schema, compression="zstd")
+            arrays = [pa.array([None if v is None else (float(v) if f.type == pa.float64() else str(v))
+                                for v in col], type=f.type)
+                      for col, f in zip(columns, schema)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            total += len(rows)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        pq.write_table(pa.table({}), str(path))
+    return total
+
+_WRITERS = {"xlsx": _write_xlsx, "csv": _write_csv, "parquet": _write_parquet}
+
+def export_history(account_email: str, fmt: str = "xlsx", filters: dict = None) -> dict:
+    """
+    履歴をファイルに書き出す（全件をメモリに載せない）
+    戻り値: {"path", "rows", "bytes", "seconds", "mime"}
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"未対応の形式です: {fmt}")
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    prune_exports()
+    started = time.perf_counter()
+    fd, tmp = tempfile.mkstemp(prefix="history_", suffix=f".{fmt}", dir=EXPORT_DIR)
+    os.close(fd)
+    path = Path(tmp)
+    try:
+        rows = _WRITERS[fmt](path, iter_history_rows(account_email, filters, chunk_rows=CHUNK_ROWS))
+    except Exception:
+        path.unlink(missing_ok=True)
+        raise
+    seconds = time.perf_counter() - started
+    size = path.stat().st_size
+    logger.info(f"[履歴エクスポート] {fmt} {rows}行 {size:,}バイト {seconds:.2f}秒")
+    return {"path": str(path), "rows": rows, "bytes": size, "seconds": seconds, "mime": FORMATS[fmt][1]}
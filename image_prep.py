@@ -0,0 +1,164 @@
+# image_prep.py
+# OpenAI Vision送信前の画像前処理
+# - 実際の形式を判定（拡張子やラベルに頼らない）
+# - 余白を切り取り、ほぼ無彩色の画像はグレースケール化
+# - 長辺を IMAGE_TARGET_LONG_EDGE 以下に縮小し、JPEG/PNGの小さい方で再エンコード
+# - 文字密度から detail（low / high）を選択
+# - 送信バイト数・推定トークン数の削減量をログに出す
+import io
+import os
+import math
+import base64
+import logging
+from PIL import Image, ImageChops, ImageFilter, ImageOps, ImageStat
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+_MIME = {"PNG": "image/png", "JPEG": "image/jpeg", "GIF": "image/gif", "WEBP": "image/webp"}
+
+def _target_long_edge():
+    try:
+        return max(256, int(os.getenv("IMAGE_TARGET_LONG_EDGE", "1536")))
+    except ValueError:
+        return 1536
+
+def _low_detail_max_density():
+    try:
+        return float(os.getenv("IMAGE_LOW_DETAIL_MAX_DENSITY", "0.02"))
+    except ValueError:
+        return 0.02
+
+def prep_signature() -> str:
+    """前処理の設定（解析キャッシュのキーに含める）"""
+    return f"prep1:{_target_long_edge()}:{_low_detail_max_density()}"
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """
+    画像1枚の推定トークン数（OpenAIの計算方法に準拠）
+    low: 85固定 / high: 2048四方に収め、短辺768に縮小した上で512pxタイル数×170+85
+    """
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    w, h = width * scale, height * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    return 85 + 170 * math.ceil(w / 512) * math.ceil(h / 512)
+
+def _crop_to_content(img: Image.Image, margin: int = 12) -> Image.Image:
+    """四隅の背景色と異なる領域だけを残す（削れる面積が5%未満なら何もしない）"""
+    gray = img.convert("L")
+    corners = [gray.getpixel(p) for p in ((0, 0), (gray.width - 1, 0), (0, gray.height - 1),
+                                          (gray.width - 1, gray.height - 1))]
+    bg = Image.new("L", gray.size, sorted(corners)[len(corners) // 2])
+    diff = ImageChops.difference(gray, bg).point(lambda v: 255 if v > 24 else 0)
+    bbox = diff.getbbox()
+    if not bbox:
+        return img
+    left, top, right, bottom = bbox
+    bbox = (max(0, left - margin), max(0, top - margin),
+            min(img.width, right + margin), min(img.height, bottom + margin))
+    if (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) > 0.95 * img.width * img.height:
+        return img
+    return img.crop(bbox)
+
+def _is_nearly_gray(img: Image.Image) -> bool:
+    """チャンネル間の差がごく小さい（スキャン・FAXなど）か"""
+    if img.mode in ("L", "1"):
+        return True
+    small = img.convert("RGB")
+    small.thumbnail((256, 256))
+    r, g, b = small.split()
+    diff = ImageStat.Stat(ImageChops.add(ImageChops.difference(r, g), ImageChops.difference(g, b))).mean[0]
+    return diff < 8
+
+def _text_density(img: Image.Image) -> float:
+    """512px相当に縮小したときのエッジ画素の割合（文字が多いほど大きい）"""
+    small = img.convert("L")
+    small.thumbnail((512, 512))
+    edges = small.filter(ImageFilter.FIND_EDGES).point(lambda v: 255 if v > 48 else 0)
+    return ImageStat.Stat(edges).mean[0] / 255
+
+def _encode(img: Image.Image):
+    """PNG / JPEG でエンコードして小さい方を返す"""
+    png = io.BytesIO()
+    img.save(png, format="PNG", optimize=True)
+    jpg = io.BytesIO()
+    img.convert("L" if img.mode == "L" else "RGB").save(jpg, format="JPEG", quality=85, optimize=True)
+    if jpg.tell() < png.tell():
+        return jpg.getvalue(), "image/jpeg"
+    return png.getvalue(), "image/png"
+
+def prepare_image(data: bytes, label: str = "") -> dict:
+    """
+    画像バイト列を前処理して Vision 送信用の image_url パーツ用情報を返す
+    戻り値: {"url": data URL, "detail": "low"/"high", "bytes", "tokens", "saved_bytes", "saved_tokens"}
+    前処理できない画像は元のバイト列を実際の形式のMIMEで返す
+    """
+    try:
+        img = Image.open(io.BytesIO(data))
+        fmt = img.format
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+            # 透過部分は白背景に合成
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.split()[3])
+        elif img.mode not in ("L", "RGB"):
+            img = img.convert("RGB")
+        orig_w, orig_h = img.size
+        orig_tokens = estimate_image_tokens(orig_w, orig_h)
+
+        img = _crop_to_content(img)
+        if _is_nearly_gray(img):
+            img = img.convert("L")
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+
+        limit = _target_long_edge()
+        if max(img.size) > limit:
+            img.thumbnail((limit, limit), Image.LANCZOS)
+
+        detail = "low" if _text_density(img) < _low_detail_max_density() else "high"
+        out, mime = _encode(img)
+        if detail == "high" and len(out) >= len(data) and fmt in _MIME and img.size == (orig_w, orig_h):
+            out, mime = data, _MIME[fmt]  # 加工しても小さくならなければ元のまま
+        tokens = estimate_image_tokens(*img.size, detail)
+        result = {
+            "url": f"data:{mime};base64,{base64.b64encode(out).decode('utf-8')}",
+            "detail": detail,
+            "bytes": len(out),
+            "tokens": tokens,
+            "saved_bytes": len(data) - len(out),
+            "saved_tokens": orig_tokens - tokens,
+        }
+        logger.info(f"[画像前処理] {label} {fmt} {orig_w}x{orig_h} → {img.width}x{img.height} {img.mode} "
+                    f"detail={detail} バイト {len(data):,}→{len(out):,} 推定トークン {orig_tokens}→{tokens}")
+        return result
+    except Exception as e:
+        logger.warning(f"[画像前処理スキップ] {label}: {e}")
+        return {
+            "url": f"data:{detect_mime(data)};base64,{base64.b64encode(data).decode('utf-8')}",
+            "detail": "high",
+            "bytes": len(data),
+            "tokens": 0,
+            "saved_bytes": 0,
+            "saved_tokens": 0,
+        }
+
+def detect_mime(data: bytes) -> str:
+    """先頭バイトから画像のMIMEタイプを判定（不明ならPNG扱い）"""
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+def image_part(prepared: dict) -> dict:
+    """prepare_image() の結果を chat.completions の image_url パーツにする"""
+    return {"type": "image_url", "image_url": {"url": prepared["url"], "detail": prepared["detail"]}}
@@ -0,0 +1,180 @@
+# llm_cache.py
+# OpenAI解析結果のコンテンツアドレス型キャッシュ
+# - キー: 入力（バイト列/テキスト）・プロンプト版・モデル・基準日 のSHA-256
+# - 保存先: APP_DATA_DIR/llm_cache.db（アプリ本体の app.db とは別ファイル）
+# - 追い出し: 最大保持日数を過ぎたもの → 合計サイズ上限を超えた分を古い参照順に削除
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+from pathlib import Path
+from contextlib import contextmanager
+from config import load_config
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+CONFIG = load_config()
+CACHE_DB_PATH = Path(CONFIG.get("app_data_dir")) / "llm_cache.db"
+
+def _max_bytes():
+    try:
+        return int(float(os.getenv("LLM_CACHE_MAX_MB", "200")) * 1024 * 1024)
+    except ValueError:
+        return 200 * 1024 * 1024
+
+def _max_age_seconds():
+    try:
+        return float(os.getenv("LLM_CACHE_MAX_AGE_DAYS", "30")) * 86400
+    except ValueError:
+        return 30 * 86400
+
+def is_enabled():
+    """キャッシュが有効かどうか（LLM_CACHE_ENABLED=0 で無効化）"""
+    return os.getenv("LLM_CACHE_ENABLED", "1") not in ("0", "false", "False")
+
+_initialized = False
+
+@contextmanager
+def _conn():
+    """キャッシュDB接続のコンテキストマネージャー"""
+    global _initialized
+    CACHE_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(CACHE_DB_PATH, timeout=10)
+    try:
+        if not _initialized:
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,            -- line / text / pdf
+                prompt_version TEXT NOT NULL,
+                model TEXT NOT NULL,
+                value TEXT NOT NULL,           -- 解析結果（JSON文字列）
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            );
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_access ON cache_entries(last_access);")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_created ON cache_entries(created_at);")
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_counters (
+                kind TEXT PRIMARY KEY,
+                hits INTEGER NOT NULL DEFAULT 0,
+                misses INTEGER NOT NULL DEFAULT 0
+            );
+            """)
+            _initialized = True
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+def prompt_version(prompt_text: str) -> str:
+    """プロンプト本文から版（短いハッシュ）を求める。プロンプトが変われば別キーになる"""
+    return hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()[:16]
+
+def make_key(kind: str, payload, prompt_ver: str, model: str, reference_date: str = "", extra=()) -> str:
+    """入力・プロンプト版・モデル・基準日（と補助情報）からキャッシュキーを作る"""
+    h = hashlib.sha256()
+    for part in (kind, prompt_ver, model, reference_date or "", *[str(e) for e in extra]):
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    h.update(payload if isinstance(payload, (bytes, bytearray)) else str(payload).encode("utf-8"))
+    return h.hexdigest()
+
+def _count(c, kind: str, hit: bool):
+    col = "hits" if hit else "misses"
+    c.execute(f"""
+        INSERT INTO cache_counters (kind, {col}) VALUES (?, 1)
+        ON CONFLICT(kind) DO UPDATE SET {col} = {col} + 1
+    """, (kind,))
+
+def get(key: str, kind: str):
+    """キャッシュを参照。ヒットすれば解析結果（dict等）、なければ None"""
+    if not is_enabled():
+        return None
+    try:
+        now = time.time()
+        with _conn() as c:
+            row = c.execute("SELECT value, created_at FROM cache_entries WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] <= _max_age_seconds():
+                c.execute("UPDATE cache_entries SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key))
+                _count(c, kind, True)
+                return json.loads(row[0])
+            _count(c, kind, False)
+    except Exception as e:
+        logger.warning(f"[キャッシュ参照エラー] {e}")
+    return None
+
+def put(key: str, kind: str, prompt_ver: str, model: str, value):
+    """解析結果を保存し、必要なら古いエントリを追い出す"""
+    if not is_enabled():
+        return
+    try:
+        text = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with _conn() as c:
+            c.execute("""
+                INSERT OR REPLACE INTO cache_entries
+                (key, kind, prompt_version, model, value, size, created_at, last_access, hits)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
+            """, (key, kind, prompt_ver, model, text, len(text.encode("utf-8")), now, now))
+            _evict(c, now)
+    except Exception as e:
+        logger.warning(f"[キャッシュ保存エラー] {e}")
+
+def _evict(c, now: float):
+    """期限切れ → サイズ上限超過分（参照の古い順）の順に削除"""
+    c.execute("DELETE FROM cache_entries WHERE created_at < ?", (now - _max_age_seconds(),))
+    total = c.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+    limit = _max_bytes()
+    if total <= limit:
+        return
+    freed = 0
+    victims = []
+    for key, size in c.execute("SELECT key, size FROM cache_entries ORDER BY last_access ASC"):
+        victims.append((key,))
+        freed += size
+        if total - freed <= limit:
+            break
+    c.executemany("DELETE FROM cache_entries WHERE key = ?", victims)
+
+def stats() -> dict:
+    """件数・サイズ・ヒット/ミス数（種類別と合計）"""
+    with _conn() as c:
+        entries, size = c.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries").fetchone()
+        by_kind = {kind: {"hits": hits, "misses": misses}
+                   for kind, hits, misses in c.execute("SELECT kind, hits, misses FROM cache_counters")}
+    hits = sum(v["hits"] for v in by_kind.values())
+    misses = sum(v["misses"] for v in by_kind.values())
+    return {
+        "entries": entries,
+        "bytes": size,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        "by_kind": by_kind,
+    }
+
+def invalidate_stale(current_versions: dict) -> int:
+    """
+    現行プロンプト版と一致しないエントリを削除（プロンプトファイル変更後の掃除）
+    current_versions: {kind: prompt_version}
+    """
+    with _conn() as c:
+        deleted = 0
+        for kind, ver in current_versions.items():
+            deleted += c.execute("DELETE FROM cache_entries WHERE kind = ? AND prompt_version != ?",
+                                 (kind, ver)).rowcount
+        return deleted
+
+def clear() -> int:
+    """キャッシュを全削除（ヒット/ミス数もリセット）"""
+    with _conn() as c:
+        deleted = c.execute("DELETE FROM cache_entries").rowcount
+        c.execute("DELETE FROM cache_counters")
+        return deleted
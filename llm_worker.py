@@ -0,0 +1,274 @@
+# llm_worker.py
+# LLM解析ジョブのワーカープロセス
+# - llm_jobs テーブルからジョブをリースし、LINE画像 / テキスト注文 / 手書きPDF を解析する
+# - 処理中はハートビートでリースを延長。プロセスが落ちてもリース切れ後に再取得される
+# - 失敗は db.fail_job() で再試行、上限に達したらデッドレター（dead）
+#
+# 起動方法:
+#   python llm_worker.py                 # 常駐（LLM_WORKER_MODE=external 向け）
+#   python llm_worker.py --idle-exit 600 # 600秒ジョブがなければ終了（embedded モードでアプリが起動）
+import os
+import sys
+import time
+import socket
+import hashlib
+import argparse
+import logging
+import threading
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import filelock
+import openai
+from openai_client import MissingApiKeyError
+from config import load_config, get_llm_max_concurrency, get_llm_worker_mode
+from config import get_text_pack_size, get_text_pack_max_chars
+from db import (init_db, enqueue_job, lease_jobs, heartbeat_jobs, complete_job, fail_job,
+                purge_finished_jobs)
+from parser_line import parse_line_order_with_openai
+from parser_text import plan_text_order_requests, parse_text_order_group
+from parser_pdf import parse_pdf_handwritten
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+CONFIG = load_config()
+DATA_DIR = Path(CONFIG.get("app_data_dir"))
+LINE_ORDERS_DIR = DATA_DIR / "line_orders"
+PDF_JOBS_DIR = DATA_DIR / "pdf_jobs"
+WORKER_LOCK_PATH = DATA_DIR / "llm_worker.lock"
+
+# ジョブの優先度（大きいほど先に処理）
+PRIORITY_INTERACTIVE = 10  # 個別の「解析開始」・PDFアップロード
+PRIORITY_BATCH = 5         # 一括解析
+PRIORITY_EAGER = 1         # 受信と同時の自動解析（手動操作より後回し）
+
+LEASE_SECONDS = 180
+HEARTBEAT_INTERVAL = 30
+POLL_INTERVAL = 1.0
+PURGE_DONE_AFTER = 7 * 86400
+
+# 再試行しても結果が変わらないエラー（即デッドレター）
+_PERMANENT_ERRORS = (FileNotFoundError, MissingApiKeyError, openai.AuthenticationError,
+                     openai.PermissionDeniedError, openai.BadRequestError)
+
+
+# ========= ジョブ登録（Streamlit側から使用） =========
+
+def enqueue_line_order(order: dict, account: str, priority: int = PRIORITY_BATCH) -> int:
+    """LINE注文の解析ジョブを登録"""
+    payload = {k: order.get(k, "") for k in ("timestamp", "image_filename", "sender_name",
+                                             "message_text", "order_date")}
+    return enqueue_job("line", order["timestamp"], account, payload, priority)
+
+def enqueue_text_order(order: dict, account: str, priority: int = PRIORITY_BATCH) -> int:
+    """テキスト注文の解析ジョブを登録"""
+    payload = {k: order.get(k, "") for k in ("timestamp", "customer_name", "message_text",
+                                             "order_date", "delivery_date_opt")}
+    return enqueue_job("text", order["timestamp"], account, payload, priority)
+
+def enqueue_pdf(pdf_bytes: bytes, filename: str, account: str, priority: int = PRIORITY_INTERACTIVE) -> int:
+    """手書きPDFの解析ジョブを登録（PDF本体は pdf_jobs/<SHA-256>.pdf に保存）"""
+    digest = hashlib.sha256(pdf_bytes).hexdigest()
+    PDF_JOBS_DIR.mkdir(parents=True, exist_ok=True)
+    path = PDF_JOBS_DIR / f"{digest}.pdf"
+    if not path.exists():
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(pdf_bytes)
+        tmp.replace(path)
+    return enqueue_job("pdf", digest, account, {"filename": filename, "sha256": digest}, priority)
+
+def remove_pdf_job_file(job: dict):
+    """PDFジョブの保存ファイルを削除"""
+    if job and job.get("kind") == "pdf":
+        try:
+            (PDF_JOBS_DIR / f"{job['ref']}.pdf").unlink()
+        except FileNotFoundError:
+            pass
+
+def ensure_worker_running() -> bool:
+    """
+    embedded モードでワーカーが動いていなければ起動する
+    ワーカーは生存中ずっとロックファイルを保持するため、ロックが取れれば停止中と判断できる
+    """
+    if get_llm_worker_mode() != "embedded":
+        return False
+    lock = filelock.FileLock(str(WORKER_LOCK_PATH))
+    try:
+        lock.acquire(timeout=0)
+    except filelock.Timeout:
+        return True
+    lock.release()
+    subprocess.Popen([sys.executable, str(Path(__file__).resolve()), "--idle-exit", "600"],
+                     cwd=str(Path(__file__).resolve().parent), start_new_session=True)
+    logger.info("[LLMワーカー] ワーカープロセスを起動しました")
+    return True
+
+
+# ========= ワーカー本体 =========
+
+class _Heartbeat(threading.Thread):
+    """処理中ジョブのリースを定期的に延長するスレッド"""
+
+    def __init__(self, owner: str):
+        super().__init__(daemon=True)
+        self.owner = owner
+        self._ids = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def add(self, job_ids):
+        with self._lock:
+            self._ids.update(job_ids)
+
+    def discard(self, job_id):
+        with self._lock:
+            self._ids.discard(job_id)
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            with self._lock:
+                ids = list(self._ids)
+            try:
+                heartbeat_jobs(self.owner, ids, LEASE_SECONDS)
+            except Exception as e:
+                logger.warning(f"[LLMワーカー] ハートビート失敗: {e}")
+
+
+def _parse_line_job(job):
+    p = job["payload"]
+    image_path = LINE_ORDERS_DIR / p["image_filename"]
+    if not image_path.exists():
+        raise FileNotFoundError(f"画像ファイルが見つかりません: {p['image_filename']}")
+    return parse_line_order_with_openai(str(image_path), p["sender_name"],
+                                        p.get("message_text", ""), p["order_date"])
+
+def _parse_pdf_job(job):
+    p = job["payload"]
+    path = PDF_JOBS_DIR / f"{p['sha256']}.pdf"
+    if not path.exists():
+        raise FileNotFoundError(f"PDFファイルが見つかりません: {p['filename']}")
+    return parse_pdf_handwritten(path.read_bytes(), p["filename"])
+
+def _plan_units(jobs):
+    """リースしたジョブを実行単位に分ける（テキストは短文をまとめて1リクエスト）"""
+    units = [[job] for job in jobs if job["kind"] != "text"]
+    text_jobs = {job["payload"]["timestamp"]: job for job in jobs if job["kind"] == "text"}
+    groups = plan_text_order_requests([job["payload"] for job in text_jobs.values()],
+                                      get_text_pack_size(), get_text_pack_max_chars())
+    units += [[text_jobs[t["timestamp"]] for t in group] for group in groups]
+    return units
+
+def _is_permanent(error) -> bool:
+    """再試行しても結果が変わらないエラーか（パーサーは例外を包み直すので __cause__ をたどって判定）"""
+    while error is not None:
+        if isinstance(error, _PERMANENT_ERRORS):
+            return True
+        error = error.__cause__
+    return False
+
+def _run_unit(unit, owner, heartbeat):
+    """1実行単位を解析し、ジョブごとに完了/失敗を記録する"""
+    try:
+        if unit[0]["kind"] == "text":
+            outcomes = parse_text_order_group([job["payload"] for job in unit])
+            by_ts = {t["timestamp"]: parsed for t, parsed in outcomes}
+            outcomes = [(job, by_ts.get(job["ref"], Exception("解析結果がありません"))) for job in unit]
+        elif unit[0]["kind"] == "line":
+            outcomes = [(unit[0], _parse_line_job(unit[0]))]
+        elif unit[0]["kind"] == "pdf":
+            outcomes = [(unit[0], _parse_pdf_job(unit[0]))]
+        else:
+            outcomes = [(unit[0], ValueError(f"不明なジョブ種別: {unit[0]['kind']}"))]
+    except Exception as e:
+        outcomes = [(job, e) for job in unit]
+
+    for job, result in outcomes:
+        heartbeat.discard(job["id"])
+        if isinstance(result, Exception):
+            status = fail_job(job["id"], owner, f"{type(result).__name__}: {result}",
+                              permanent=_is_permanent(result))
+            logger.warning(f"[LLMワーカー] ジョブ{job['id']}（{job['kind']}）失敗 → {status}: {result}")
+        elif complete_job(job["id"], owner, result):
+            if job["kind"] == "pdf":
+                remove_pdf_job_file(job)
+            logger.info(f"[LLMワーカー] ジョブ{job['id']}（{job['kind']}）完了")
+        else:
+            logger.warning(f"[LLMワーカー] ジョブ{job['id']}のリースを失ったため結果を破棄しました")
+
+def run_worker(idle_exit: float = 0):
+    """
+    ジョブを取り出して解析し続ける
+    空きスロット分だけリースするため、長いPDF解析が他のジョブを待たせない
+    idle_exit > 0 なら、その秒数ジョブがなければ終了する
+    """
+    init_db()
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    concurrency = get_llm_max_concurrency()
+    heartbeat = _Heartbeat(owner)
+    heartbeat.start()
+    logger.info(f"[LLMワーカー] 開始 owner={owner} 同時実行数={concurrency}")
+
+    in_flight = set()
+    last_activity = time.monotonic()
+    last_purge = 0.0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            free = concurrency - len(in_flight)
+            if free > 0:
+                try:
+                    jobs = lease_jobs(owner, free, LEASE_SECONDS)
+                except Exception as e:
+                    logger.warning(f"[LLMワーカー] ジョブ取得失敗: {e}")
+                    jobs = []
+                if jobs:
+                    heartbeat.add(job["id"] for job in jobs)
+                    for unit in _plan_units(jobs):
+                        in_flight.add(pool.submit(_run_unit, unit, owner, heartbeat))
+                    last_activity = time.monotonic()
+
+            if in_flight:
+                done, _ = wait(in_flight, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight.discard(future)
+                    if future.exception():
+                        logger.error(f"[LLMワーカー] 想定外のエラー: {future.exception()}")
+                last_activity = time.monotonic()
+                continue
+
+            if idle_exit and time.monotonic() - last_activity > idle_exit:
+                logger.info("[LLMワーカー] ジョブがないため終了します")
+                break
+            if time.monotonic() - last_purge > 3600:
+                purge_finished_jobs(PURGE_DONE_AFTER)
+                last_purge = time.monotonic()
+            time.sleep(POLL_INTERVAL)
+    heartbeat.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM解析ジョブのワーカー")
+    parser.add_argument("--idle-exit", type=float, default=0,
+                        help="この秒数ジョブがなければ終了（0で常駐）")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    # 1ホストにつき1プロセス（同時実行数はプロセス内のスレッドで確保する）
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    lock = filelock.FileLock(str(WORKER_LOCK_PATH))
+    try:
+        lock.acquire(timeout=0)
+    except filelock.Timeout:
+        logger.info("[LLMワーカー] 既に起動中のため終了します")
+        return
+    try:
+        run_worker(idle_exit=args.idle_exit)
+    finally:
+        lock.release()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# openai_client.py
+# プロセス共通のOpenAIクライアントとレート制限スケジューラ
+# - クライアントは1プロセス1つ（keep-aliveで接続・TLSを使い回す）
+# - RPM（リクエスト数）とTPM（推定トークン数）の2つのトークンバケットで送信を調整
+# - 429 / 5xx / 接続エラーはジッター付き指数バックオフで再試行
+import os
+import time
+import random
+import threading
+import logging
+import httpx
+import openai
+from config import get_openai_api_key, get_openai_rate_limits
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+# 画像1枚あたりの推定トークン数（detail=high の目安）
+IMAGE_TOKEN_ESTIMATE = 1100
+
+class MissingApiKeyError(Exception):
+    """OPENAI_API_KEY が設定されていない（設定するまで再試行しても失敗する）"""
+
+
+_client = None
+_client_key = None
+_client_lock = threading.Lock()
+
+def get_client() -> openai.OpenAI:
+    """
+    プロセス共通のOpenAIクライアントを返す
+    APIキーが変わった場合（開発環境のサイドバー入力など）は作り直す
+    """
+    global _client, _client_key
+    api_key = get_openai_api_key()
+    if not api_key:
+        raise MissingApiKeyError("OPENAI_API_KEYが設定されていません")
+    with _client_lock:
+        if _client is None or _client_key != api_key:
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60),
+                timeout=httpx.Timeout(120.0, connect=10.0),
+            )
+            # 再試行はスケジューラ側で行うためSDKの自動再試行は無効化
+            _client = openai.OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+            _client_key = api_key
+        return _client
+
+
+class _TokenBucket:
+    """1分あたり rate_per_min を補充するトークンバケット"""
+
+    def __init__(self, rate_per_min: float):
+        self.capacity = float(rate_per_min)
+        self.rate = float(rate_per_min) / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        amount = min(amount, self.capacity)  # 上限を超える要求で永久待ちにならないように
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+    def give_back(self, amount: float):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RequestScheduler:
+    """
+    RPM/TPMの予算内でリクエストを送り出すスケジューラ（プロセス内の全セッションで共有）
+    - acquire() で予算が空くまで待ち、release() で実使用トークンとの差分を返却
+    - 429を受けたら pause() で全スレッドの送信を一時停止
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self._cond = threading.Condition()
+        self._requests = _TokenBucket(rpm)
+        self._tokens = _TokenBucket(tpm)
+        self._paused_until = 0.0
+        self._waiting = 0
+        self._in_flight = 0
+        self._stats = {"requests": 0, "retries": 0, "rate_limited": 0, "errors": 0,
+                       "wait_total": 0.0, "wait_max": 0.0}
+
+    def acquire(self, est_tokens: int) -> float:
+        """予算が確保できるまで待機し、待ち時間（秒）を返す"""
+        start = time.monotonic()
+        with self._cond:
+            self._waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = max(self._paused_until - now,
+                               self._requests.wait_time(1, now),
+                               self._tokens.wait_time(est_tokens, now))
+                    if wait <= 0:
+                        self._requests.take(1)
+                        self._tokens.take(est_tokens)
+                        break
+                    self._cond.wait(timeout=wait)
+            finally:
+                self._waiting -= 1
+            self._in_flight += 1
+            waited = time.monotonic() - start
+            self._stats["requests"] += 1
+            self._stats["wait_total"] += waited
+            self._stats["wait_max"] = max(self._stats["wait_max"], waited)
+        return waited
+
+    def release(self, est_tokens: int, actual_tokens: int = None):
+        """送信完了。実使用トークンが推定より少なければ差分を返却"""
+        with self._cond:
+            self._in_flight -= 1
+            if actual_tokens is not None and actual_tokens < est_tokens:
+                self._tokens.give_back(est_tokens - actual_tokens)
+            self._cond.notify_all()
+
+    def pause(self, seconds: float):
+        """429応答時に全スレッドの送信を一時停止"""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def record(self, key: str):
+        with self._cond:
+            self._stats[key] += 1
+
+    def metrics(self) -> dict:
+        """キュー深さ・送信中件数・待ち時間などの指標"""
+        with self._cond:
+            now = time.monotonic()
+            requests = self._stats["requests"]
+            return {
+                "queue_depth": self._waiting,
+                "in_flight": self._in_flight,
+                "requests": requests,
+                "retries": self._stats["retries"],
+                "rate_limited": self._stats["rate_limited"],
+                "errors": self._stats["errors"],
+                "avg_wait_ms": (self._stats["wait_total"] / requests * 1000) if requests else 0.0,
+                "max_wait_ms": self._stats["wait_max"] * 1000,
+                "rpm_available": int(self._requests.tokens + (now - self._requests.updated) * self._requests.rate),
+                "tpm_available": int(self._tokens.tokens + (now - self._tokens.updated) * self._tokens.rate),
+                "paused_for_s": max(0.0, self._paused_until - now),
+            }
+
+
+_rpm, _tpm = get_openai_rate_limits()
+scheduler = RequestScheduler(_rpm, _tpm)
+
+def estimate_tokens(messages, max_tokens: int) -> int:
+    """
+    送信トークン数の概算（TPM予算用）
+    日本語は1文字≒1トークン前後のため文字数をそのまま使い、画像は1枚あたりの目安値、出力は max_tokens で見積もる
+    """
+    total = max_tokens
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, str):
+            total += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    total += len(part.get("text", ""))
+                elif part.get("type") == "image_url":
+                    detail = part.get("image_url", {}).get("detail", "high")
+                    total += 85 if detail == "low" else IMAGE_TOKEN_ESTIMATE
+    return total
+
+def _retry_after(error) -> float:
+    """Retry-Afterヘッダーがあればその秒数を返す"""
+    try:
+        value = error.response.headers.get("retry-after")
+        return float(value) if value else 0.0
+    except Exception:
+        return 0.0
+
+def chat_completion(messages, model="gpt-4o", max_tokens=2000, temperature=0.1, **kwargs):
+    """
+    スケジューラ経由で chat.completions.create を呼び出す
+    - 429 / 5xx / 接続エラー / タイムアウトは最大 LLM_MAX_RETRIES 回まで再試行
+    - それ以外のエラー（400, 401 など）はそのまま送出
+    """
+    client = get_client()
+    est_tokens = estimate_tokens(messages, max_tokens)
+    max_retries = int(os.getenv("LLM_MAX_RETRIES", "5"))
+
+    for attempt in range(max_retries + 1):
+        scheduler.acquire(est_tokens)
+        actual_tokens = None
+        try:
+            response = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **kwargs
+            )
+            if getattr(response, "usage", None) is not None:
+                actual_tokens = response.usage.total_tokens
+            return response
+        except (openai.RateLimitError, openai.InternalServerError,
+                openai.APIConnectionError, openai.APITimeoutError) as e:
+            if isinstance(e, openai.RateLimitError):
+                scheduler.record("rate_limited")
+            if attempt >= max_retries:
+                scheduler.record("errors")
+                raise
+            # フルジッター付き指数バックオフ（Retry-Afterがあればそれ以上待つ）
+            delay = max(_retry_after(e), random.uniform(0, min(30.0, 2 ** attempt)))
+            if isinstance(e, openai.RateLimitError):
+                scheduler.pause(delay)
+            scheduler.record("retries")
+            logger.warning(f"[OpenAI再試行] {type(e).__name__}: {delay:.1f}秒後に再試行 ({attempt + 1}/{max_retries})")
+            time.sleep(delay)
+        except Exception:
+            scheduler.record("errors")
+            raise
+        finally:
+            scheduler.release(est_tokens, actual_tokens)
+
+def metrics() -> dict:
+    """スケジューラの指標（管理者ダッシュボード表示用）"""
+    return scheduler.metrics()
@@ -0,0 +1,85 @@
+# order_filter.py
+# 解析時の絞り込み条件（納品日の範囲・取引先・伝票番号）
+# - 各パーサーは伝票の見出し（伝票番号・納品日・取引先名）の時点で判定し、対象外の伝票は明細を組み立てない
+# - 納品日が読み取れない伝票は、日付条件では除外しない（取りこぼしを防ぐため）
+import re
+from dataclasses import dataclass, field
+from datetime import date
+
+_YMD_COMPACT_RE = re.compile(r"(?<!\d)(\d{4})(\d{2})(\d{2})(?!\d)")
+_YMD_RE = re.compile(r"(\d{2,4})[/\-.年](\d{1,2})[/\-.月](\d{1,2})")
+
+
+def to_day(value):
+    """日付（date / 'YYYY/MM/DD' / 'YY/MM/DD' / 'YYYYMMDD' / 'YYYY-MM-DD HH:MM:SS' 等）を YYYYMMDD の整数に（読めなければ None）"""
+    if value is None:
+        return None
+    if isinstance(value, date):
+        return value.year * 10000 + value.month * 100 + value.day
+    text = str(value).strip()
+    m = _YMD_RE.search(text) or _YMD_COMPACT_RE.search(text)
+    if not m:
+        return None
+    y, mo, d = (int(g) for g in m.groups())
+    if y < 100:
+        y += 2000
+    if not (1 <= mo <= 12 and 1 <= d <= 31):
+        return None
+    return y * 10000 + mo * 100 + d
+
+def split_terms(text: str) -> list:
+    """カンマ・読点・空白・改行区切りの入力を語のリストに"""
+    return [t for t in re.split(r"[,\s、，]+", text or "") if t]
+
+
+@dataclass
+class OrderFilter:
+    """解析時の絞り込み条件（空の条件は判定しない）"""
+    delivery_from: int = None           # YYYYMMDD
+    delivery_to: int = None             # YYYYMMDD
+    partners: tuple = ()                # 取引先名（部分一致のいずれか）
+    order_ids: frozenset = frozenset()  # 伝票番号（完全一致）
+    skipped_slips: int = field(default=0, compare=False)  # 除外した伝票数（表示用）
+
+    @classmethod
+    def build(cls, delivery_from=None, delivery_to=None, partners=None, order_ids=None):
+        """画面の入力から作る（条件が何もなければ None）"""
+        spec = cls(
+            delivery_from=to_day(delivery_from),
+            delivery_to=to_day(delivery_to),
+            partners=tuple(p.strip() for p in (partners or []) if str(p).strip()),
+            order_ids=frozenset(str(o).strip() for o in (order_ids or []) if str(o).strip()),
+        )
+        return spec if spec.is_active else None
+
+    @property
+    def is_active(self) -> bool:
+        return bool(self.delivery_from or self.delivery_to or self.partners or self.order_ids)
+
+    def accepts(self, order_id=None, delivery_date=None, partner_name=None) -> bool:
+        """伝票の見出しで判定（対象外なら skipped_slips を数える）"""
+        ok = True
+        if self.order_ids and str(order_id or "").strip() not in self.order_ids:
+            ok = False
+        elif self.partners and not any(p in str(partner_name or "") for p in self.partners):
+            ok = False
+        elif self.delivery_from or self.delivery_to:
+            day = to_day(delivery_date)
+            if day is not None and ((self.delivery_from and day < self.delivery_from) or
+                                    (self.delivery_to and day > self.delivery_to)):
+                ok = False
+        if not ok:
+            self.skipped_slips += 1
+        return ok
+
+    def describe(self) -> str:
+        """条件の表示用テキスト"""
+        parts = []
+        if self.delivery_from or self.delivery_to:
+            fmt = lambda d: f"{d // 10000}/{d // 100 % 100:02d}/{d % 100:02d}" if d else ""
+            parts.append(f"納品日 {fmt(self.delivery_from)}〜{fmt(self.delivery_to)}")
+        if self.partners:
+            parts.append("取引先 " + "・".join(self.partners))
+        if self.order_ids:
+            parts.append("伝票番号 " + "・".join(sorted(self.order_ids)))
+        return " / ".join(parts)
@@ -1,15 +1,25 @@
 import csv
 import io
+from format_detect import sniff_file_encoding, decodes_as
 
-def parse_infomart(file_buffer, filename):
+def parse_infomart(file_buffer, filename, order_filter=None, encoding=None):
     """
     Infomart CSVファイルのfile_bufferとファイル名を受け取り、
     [{...}] 形式の注文明細リストとして返す。
+    order_filter（order_filter.OrderFilter）を渡すと、対象外の伝票の行は明細を作らずに飛ばす。
+    encoding は判定済みならそれを使い、省略時は先頭を見て判定する（読めなければShift_JIS）。
+    cp932 と判定されてもShift_JISで読めるファイルは従来どおりShift_JISで読む
+    （「−」「～」などが cp932 では別の文字になり、保存済みの商品名と合わなくなるため）。
     """
     orders = []
-    # file_bufferをShift_JISでテキストとしてラップ
+    current_order_id, current_ok = None, True
+    if encoding is None:
+        encoding = sniff_file_encoding(file_buffer)[0] or "shift_jis"
+    if encoding == "cp932" and decodes_as(file_buffer, "shift_jis"):
+        encoding = "shift_jis"
+    # file_bufferを判定済みのエンコーディングでテキストとしてラップ（逐次デコード）
     file_buffer.seek(0)
-    reader = csv.reader(io.TextIOWrapper(file_buffer, encoding="shift_jis"))
+    reader = csv.reader(io.TextIOWrapper(file_buffer, encoding=encoding))
     next(reader)  # 1行目は空白なのでスキップ
     header = next(reader)  # 2行目がヘッダー
 
@@ -37,6 +47,14 @@ def parse_infomart(file_buffer, filename):
         ):
             continue
 
+        # 絞り込み（同じ伝票の行は続くので、判定は伝票が変わったときだけ）
+        if order_filter is not None:
+            if row[idx_order_id] != current_order_id:
+                current_order_id = row[idx_order_id]
+                current_ok = order_filter.accepts(current_order_id, row[idx_delivery_date], row[idx_partner_name])
+            if not current_ok:
+                continue
+
         # 注文明細をフラットに出力
         orders.append({
             "order_id": row[idx_order_id],
@@ -1,66 +1,165 @@
+# parser_iporter.py
+# IPORTER CSV の解析
+# - 1行目が見出し、以降は27行で1伝票のブロック（1行目: 伝票情報、3〜12行目: 明細）
+# - ファイルは1行ずつ読んで逐次デコードし、伝票単位で明細を返す（全行をメモリに載せない）
+# - 伝票の先頭バイト位置の索引を作れば、特定の伝票番号やページだけを読み直せる
 import csv
 import re
-import io
+import codecs
+from itertools import islice
+import format_detect
 
-def parse_iporter(file, filename=None):
-    # --- エンコーディング自動判定 ---
-    content = file.read()
-    encodings = ["utf-8-sig", "cp932", "shift_jis"]
-    for enc in encodings:
+SLIP_ROWS = 27                 # 1伝票のブロック行数
+_ITEM_ROWS = range(2, 12)      # ブロック内の明細行（3〜12行目）
+_MAIN_MIN_COLS = 54            # 伝票情報行に必要な列数
+_ORDER_DATE_RE = re.compile(r"発注日:(\d{4}/\d{2}/\d{2})")
+_DELIVERY_DATE_RE = re.compile(r"納品予定日:(\d{4}/\d{2}/\d{2})")
+
+
+def sniff_encoding(file) -> str:
+    """先頭を読んでエンコーディングを判定（ファイル位置は先頭に戻す）"""
+    encoding = format_detect.sniff_file_encoding(file)[0]
+    if encoding is None:
+        raise RuntimeError("どのエンコーディングでもファイルが読めませんでした。")
+    return encoding
+
+
+class _Lines:
+    """バイト列を1行ずつ読み、行頭のバイト位置を記録しながら逐次デコードする"""
+
+    def __init__(self, file, encoding: str, offset: int):
+        self.file = file
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.offset = offset
+        self.base = 0          # starts[0] が何行目（0始まり）か
+        self.starts = []       # まだ行として使い終わっていない物理行の先頭位置
+
+    def __iter__(self):
+        # cp932 / UTF-8 では改行バイト(0x0A)が2バイト文字の一部にならないので、バイト単位で行に分けてよい
+        for line in iter(self.file.readline, b""):
+            self.starts.append(self.offset)
+            self.offset += len(line)
+            yield self.decoder.decode(line)
+        tail = self.decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
+    def row_start(self, line_num: int) -> int:
+        """line_num 行目（0始まり）から始まる行の先頭位置を返し、それより前の記録を捨てる"""
+        start = self.starts[line_num - self.base]
+        del self.starts[:line_num - self.base]
+        self.base = line_num
+        return start
+
+
+def _rows(file, encoding: str, offset: int):
+    """(行の先頭バイト位置, CSVの1行) を順に返す"""
+    file.seek(offset)
+    lines = _Lines(file, encoding, offset)
+    reader = csv.reader(lines)
+    while True:
+        line_num = reader.line_num
         try:
-            text = content.decode(enc)
+            row = next(reader)
+        except StopIteration:
+            return
+        yield lines.row_start(line_num), row
+
+def _slip_header(main) -> tuple:
+    """伝票情報行から (伝票番号, 発注日, 納品日, 取引先名)"""
+    order_id = main[0].strip()
+    date_info = main[5] if len(main) > 5 else ""
+    partner_name = main[7] if len(main) > 7 else ""
+    # 正規表現で日付抜き出し
+    m = _ORDER_DATE_RE.search(date_info)
+    order_date = m.group(1) if m else ""
+    m2 = _DELIVERY_DATE_RE.search(date_info)
+    delivery_date = m2.group(1) if m2 else ""
+    return order_id, order_date, delivery_date, partner_name
+
+def _slip_records(block, header, filename) -> list:
+    """1伝票ブロック（最大27行）から明細を作る"""
+    order_id, order_date, delivery_date, partner_name = header
+    records = []
+    for idx in _ITEM_ROWS:
+        if idx >= len(block):
+            break
+        row = block[idx]
+        # 商品名が空白ならそのブロックはそれ以上出力不要！
+        if len(row) <= 55 or not row[46].strip():
             break
-        except Exception:
+        records.append({
+            "order_id": order_id,
+            "order_date": order_date,
+            "delivery_date": delivery_date,
+            "partner_name": partner_name,
+            "product_code": row[44].strip(),
+            "product_name": row[46].strip(),
+            "size": "",  # 追加：IPORTERはサイズ空
+            "quantity": row[47].strip(),
+            "unit": row[48].strip(),
+            "unit_price": row[51].replace("円", "").replace(",", "").strip(),
+            "amount": row[53].replace("円", "").replace(",", "").strip(),
+            "remark": row[55].strip(),
+            "data_source": filename if filename else ""
+        })
+    return records
+
+def _blocks(file, encoding: str, offset: int = None):
+    """(伝票の先頭バイト位置, 27行ブロック) を順に返す（offset 省略時は見出し行を飛ばして先頭から）"""
+    rows = _rows(file, encoding, offset or 0)
+    if offset is None:
+        next(rows, None)  # 1行目は見出し
+    while True:
+        block = list(islice(rows, SLIP_ROWS))
+        if not block:
+            return
+        yield block[0][0], [row for _, row in block]
+
+def iter_iporter_slips(file, filename=None, encoding: str = None, offset: int = None, order_filter=None):
+    """
+    伝票単位に {"order_id", "offset", "records"} を返すジェネレーター
+    offset に索引の位置を渡すと、その伝票から読み始める（見出し行の読み飛ばしはしない）
+    order_filter（order_filter.OrderFilter）を渡すと、対象外の伝票は明細を作らずに飛ばす
+    """
+    encoding = encoding or sniff_encoding(file)
+    for start, block in _blocks(file, encoding, offset):
+        if len(block[0]) < _MAIN_MIN_COLS:
             continue
-    else:
-        raise RuntimeError("どのエンコーディングでもファイルが読めませんでした。")
-    reader = csv.reader(io.StringIO(text))
-    rows = list(reader)
+        header = _slip_header(block[0])
+        if order_filter is not None and not order_filter.accepts(header[0], header[2], header[3]):
+            continue
+        yield {"order_id": header[0], "offset": start, "records": _slip_records(block, header, filename)}
+
+def build_iporter_index(file, encoding: str = None) -> dict:
+    """
+    伝票の先頭バイト位置の索引を作る（明細は組み立てない）
+    戻り値: {"encoding", "slips": [(伝票番号, 先頭バイト位置), ...]}
+    """
+    encoding = encoding or sniff_encoding(file)
+    slips = [(block[0][0].strip(), start)
+             for start, block in _blocks(file, encoding) if len(block[0]) >= _MAIN_MIN_COLS]
+    return {"encoding": encoding, "slips": slips}
 
+def read_iporter_slips(file, index: dict, order_ids=None, start: int = 0, limit: int = None, filename=None) -> list:
+    """
+    索引を使って一部の伝票だけを解析（ファイル全体は読み直さない）
+    order_ids を渡すとその伝票番号だけ、省略時は索引の start 番目から limit 件（ページ送り用）
+    """
+    slips = index["slips"]
+    if order_ids is not None:
+        wanted = {str(o).strip() for o in order_ids}
+        targets = [offset for order_id, offset in slips if order_id in wanted]
+    else:
+        targets = [offset for _, offset in slips[start:start + limit if limit is not None else None]]
     records = []
-    i = 1  # 2行目（index=1）から開始
-    while i < len(rows):
-        main = rows[i]
-        if len(main) < 54:
-            i += 27
-            continue
-        order_id = main[0].strip()
-        date_info = main[5] if len(main) > 5 else ""
-        partner_name = main[7] if len(main) > 7 else ""
-        # 正規表現で日付抜き出し
-        m = re.search(r"発注日:(\d{4}/\d{2}/\d{2})", date_info)
-        order_date = m.group(1) if m else ""
-        m2 = re.search(r"納品予定日:(\d{4}/\d{2}/\d{2})", date_info)
-        delivery_date = m2.group(1) if m2 else ""
-
-        # 4～13行目が注文内容（index 3～12）
-        for j in range(3, 13):
-            idx = i + j - 1
-            if idx >= len(rows):
-                break
-            row = rows[idx]
-            # 商品名が空白ならそのブロックはそれ以上出力不要！
-            # 配列範囲チェックを修正: len(row) > 55 に変更
-            if len(row) <= 55 or not row[46].strip():
-                break
-
-            # データ取得（安全な配列アクセス）
-            record = {
-                "order_id": order_id,
-                "order_date": order_date,
-                "delivery_date": delivery_date,
-                "partner_name": partner_name,
-                "product_code": row[44].strip() if len(row) > 44 else "",
-                "product_name": row[46].strip() if len(row) > 46 else "",
-                "size": "",  # 追加：IPORTERはサイズ空
-                "quantity": row[47].strip() if len(row) > 47 else "",
-                "unit": row[48].strip() if len(row) > 48 else "",
-                "unit_price": row[51].replace("円", "").replace(",", "").strip() if len(row) > 51 else "",
-                "amount": row[53].replace("円", "").replace(",", "").strip() if len(row) > 53 else "",
-                "remark": row[55].strip() if len(row) > 55 else "",
-                "data_source": filename if filename else ""
-            }
-            records.append(record)
-        i += 27
-    
+    for offset in targets:
+        slip = next(iter_iporter_slips(file, filename, index["encoding"], offset), None)
+        if slip:
+            records += slip["records"]
     return records
+
+def parse_iporter(file, filename=None, encoding: str = None, order_filter=None):
+    """IPORTER CSV の全明細を返す（伝票単位に逐次解析、order_filter で伝票を絞り込み）"""
+    return [record for slip in iter_iporter_slips(file, filename, encoding, order_filter=order_filter)
+            for record in slip["records"]]
@@ -0,0 +1,82 @@
+# parser_line.py
+import json
+import llm_cache
+from image_prep import prepare_image, image_part, prep_signature
+import openai_client
+from config import get_openai_api_key
+from prompt_line import get_line_order_prompt
+
+def parse_line_order_with_openai(image_path, sender_name, message_text="", order_date=""):
+    """
+    OpenAI APIを使用してLINE注文画像を解析
+    """
+    try:
+        with open(image_path, "rb") as image_file:
+            image_bytes = image_file.read()
+
+        # 同じ画像・送信者・メッセージ・受信日の解析結果があればAPIを呼ばずに返す
+        prompt_ver = llm_cache.prompt_version(get_line_order_prompt())
+        cache_key = llm_cache.make_key("line", image_bytes, prompt_ver, "gpt-4o", order_date,
+                                       extra=(sender_name, message_text, prep_signature()))
+        cached = llm_cache.get(cache_key, "line")
+        if cached is not None:
+            return cached
+
+        api_key = get_openai_api_key()
+        if not api_key:
+            raise openai_client.MissingApiKeyError("OPENAI_API_KEYが設定されていません")
+        
+        # 実際の形式を判定し、切り抜き・縮小・detail選択をしてから送信
+        prepared = prepare_image(image_bytes, label=image_path)
+        
+        # システムプロンプト
+        system_prompt = get_line_order_prompt()
+        
+        # 受信日時を含むユーザーメッセージ
+        user_message = f"送信者: {sender_name}\n受信日: {order_date}\nメッセージ: {message_text}\n\nこのLINE注文を解析してください。受信日を基準に納品日を計算してください。"
+        
+        # OpenAI APIを呼び出し（共通クライアント・レート制限スケジューラ経由）
+        response = openai_client.chat_completion(
+            model="gpt-4o",
+            messages=[
+                {
+                    "role": "system",
+                    "content": system_prompt
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": user_message},
+                        image_part(prepared)
+                    ]
+                }
+            ],
+            max_tokens=2000,
+            temperature=0.1
+        )
+        
+        # レスポンスを解析
+        content = response.choices[0].message.content
+        
+        # JSONとして解析
+        try:
+            cleaned_content = content.strip()
+            if cleaned_content.startswith('```json'):
+                cleaned_content = cleaned_content[7:]
+            if cleaned_content.endswith('```'):
+                cleaned_content = cleaned_content[:-3]
+            cleaned_content = cleaned_content.strip()
+            
+            parsed_data = json.loads(cleaned_content)
+            
+            # 発注日が空の場合は受信日を設定
+            if not parsed_data.get("order_date"):
+                parsed_data["order_date"] = order_date
+            
+            llm_cache.put(cache_key, "line", prompt_ver, "gpt-4o", parsed_data)
+            return parsed_data
+        except json.JSONDecodeError as e:
+            raise Exception(f"JSON解析エラー: {e}") from e
+            
+    except Exception as e:
+        raise Exception(f"LINE注文解析エラー: {e}") from e
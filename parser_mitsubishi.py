@@ -1,5 +1,13 @@
 # parser_mitsubishi.py
+# 三菱食品 発注書（XLSX）の解析
+# - 1シート66列以上あるがほとんど空なので、read-only で1回だけ走査し、使うセルの列（見出し B/J/T/BA、明細 F/H/N/R/W/AA/AC/BD/BN）だけを取り出す
+# - 取り出した列は列ごとに型推定する（数値だけの列は数値、空欄は NaN。従来の DataFrame 全体読み込みと同じ値）
+# - 明細は11行目から2行おき（次の行は備考の続き）
+import numpy as np
+import openpyxl
 import pandas as pd
+from openpyxl.cell.cell import ERROR_CODES
+from openpyxl.workbook.workbook import Workbook
 from datetime import datetime
 import logging
 from typing import Union, BinaryIO, TextIO
@@ -7,15 +15,81 @@ from typing import Union, BinaryIO, TextIO
 # ロガーの設定
 logger = logging.getLogger(__name__)
 
-def parse_mitsubishi(file_path: Union[str, BinaryIO, TextIO], file_name: str) -> list[dict]:
-    df = pd.read_excel(file_path, sheet_name=0, header=None)
+# 読み取る列（0始まり）
+_COL_B, _COL_J, _COL_T, _COL_BA = 1, 9, 19, 52          # 伝票番号 / 納品日 / 店名 / 得意先名・発注日
+_COL_F, _COL_H, _COL_N, _COL_R = 5, 7, 13, 17            # 商品コード / 商品名 / 備考 / 規格
+_COL_W, _COL_AA, _COL_AC, _COL_BD, _COL_BN = 23, 27, 29, 55, 65  # 数量 / 単位 / 単価 / 備考 / 備考
+_COLUMNS = sorted({_COL_B, _COL_J, _COL_T, _COL_BA, _COL_F, _COL_H, _COL_N, _COL_R,
+                   _COL_W, _COL_AA, _COL_AC, _COL_BD, _COL_BN})
+_ITEM_FIRST_ROW = 10       # Excel上11行目
+# read_excel が既定で欠損値として読む文字列
+_NA_TEXT = frozenset(["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+                      "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"])
+_REMARK_CELLS = [(0, _COL_R), (0, _COL_BD), (1, _COL_H), (1, _COL_N), (1, _COL_BD), (1, _COL_BN)]  # (次の行か, 列)
+
+
+def _cell_value(value):
+    """read_excel（openpyxl）と同じセル値の変換（空・エラー値・"NA" などの文字列 → NaN、整数値の小数 → int）"""
+    if value is None or (isinstance(value, str) and (value in _NA_TEXT or value in ERROR_CODES)):
+        return np.nan
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def read_columns(file_path, columns=_COLUMNS) -> pd.DataFrame:
+    """
+    先頭シートを read-only で1回走査し、指定列だけの DataFrame を返す（列名は元の列番号）
+    file_path はファイル / バッファ / 形式判定で開いた openpyxl のブック（読み直さない・閉じない）のいずれか
+    attrs["shape"] に read_excel で読んだ場合の (行数, 列数) を入れる
+    """
+    if isinstance(file_path, Workbook):
+        wb, opened = file_path, False
+    else:
+        wb, opened = openpyxl.load_workbook(file_path, read_only=True, data_only=True, keep_links=False), True
+    try:
+        ws = wb.worksheets[0]
+        if hasattr(ws, "reset_dimensions"):
+            # read-only では記録されたシート範囲が不正確なことがあるので実データで数える
+            ws.reset_dimensions()
+        picked, n_rows, n_cols = [], 0, 0
+        for values in ws.iter_rows(values_only=True):
+            width = len(values)
+            while width and (values[width - 1] is None or values[width - 1] == ""):
+                width -= 1
+            picked.append([_cell_value(values[c]) if c < width else np.nan for c in columns])
+            if width:
+                n_rows, n_cols = len(picked), max(n_cols, width)
+    finally:
+        if opened:
+            wb.close()
+    del picked[n_rows:]   # 末尾の空行は read_excel と同じく除く
+    # 列ごとの型推定（数値にできる値だけの列は数値、日時だけの列は日時、それ以外はそのまま）
+    df = pd.DataFrame(picked, columns=list(columns), dtype=object)
+    for col in df.columns:
+        try:
+            df[col] = pd.to_numeric(df[col])
+        except (ValueError, TypeError):
+            df[col] = df[col].infer_objects()
+    df.attrs["shape"] = (n_rows, n_cols)
+    return df
+
+def _filled(value) -> bool:
+    """空欄でないセルか"""
+    return pd.notna(value) and str(value).strip() != ""
+
+def parse_mitsubishi(file_path: Union[str, BinaryIO, TextIO, Workbook], file_name: str, order_filter=None) -> list[dict]:
+    # file_path はファイル / バッファ / 形式判定で開いた openpyxl のブック（読み直さない）のいずれか
+    df = read_columns(file_path)
+    n_rows, n_cols = df.attrs["shape"]
 
     # 基本情報の抽出
     try:
-        denpyo_no = str(df.iloc[5, 1])
-        order_date_text = df.iloc[3, 52]
-        delivery_date_raw = df.iloc[5, 9]
-        customer_name = f"{df.iloc[0, 52]} {df.iloc[5, 19]}"
+        if n_rows <= 5 or n_cols <= _COL_BA:
+            raise IndexError("single positional indexer is out-of-bounds")
+        denpyo_no = str(df.at[5, _COL_B])
+        order_date_text = df.at[3, _COL_BA]
+        delivery_date_raw = df.at[5, _COL_J]
+        customer_name = f"{df.at[0, _COL_BA]} {df.at[5, _COL_T]}"
     except Exception as e:
         error_msg = f"[基本情報の抽出エラー] {file_name}: {e}"
         logger.error(error_msg)
@@ -32,6 +106,11 @@ def parse_mitsubishi(file_path: Union[str, BinaryIO, TextIO], file_name: str) ->
         warning_msg = f"[納品日変換失敗] {file_name}: '{delivery_date_raw}'"
         logger.warning(warning_msg)
 
+    # 絞り込み（1ファイル1伝票なので、対象外なら発注日の推定・明細の抽出をしない）
+    if order_filter is not None and not order_filter.accepts(denpyo_no, delivery_date or delivery_date_raw, customer_name):
+        logger.info(f"[絞り込み] {file_name}: 伝票 {denpyo_no} は対象外")
+        return []
+
     # 発注日（(発注日 MM/DD) ～）から MM/DD 抽出し YYYY/MM/DD に変換
     # 納品日の年を基準に年跨ぎ誤判定を防止
     try:
@@ -82,53 +161,40 @@ def parse_mitsubishi(file_path: Union[str, BinaryIO, TextIO], file_name: str) ->
         warning_msg = f"[発注日変換失敗] {file_name}: '{order_date_text}' → {order_date}"
         logger.warning(warning_msg)
 
+    # 商品情報の抽出（Excel上11行目 = row=10 から2行おき、次の行は備考の続き。最終行なら同じ行）
+    cells = {col: df[col].tolist() for col in _COLUMNS}   # 列ごとのセル値（行番号で引く）
     result = []
-
-    # 商品情報の抽出（Excel上11行目 = row=10 から2行おき）
-    for row in range(10, df.shape[0], 2):
-        code_cell = df.iloc[row, 5]  # F列
-        if pd.isna(code_cell) or str(code_cell).strip() == "":
+    for row in range(_ITEM_FIRST_ROW, n_rows, 2):
+        code_cell = cells[_COL_F][row]
+        if not _filled(code_cell):
             continue
+        next_row = min(row + 1, n_rows - 1)
 
-        next_row = row + 1 if row + 1 < df.shape[0] else row
-
-        # 数量・単価を取得（新しい列番号）
-        quantity_raw = df.iloc[row, 23]  # W列（23列目）
-        unit_price_raw = df.iloc[row, 29]  # AC列（29列目）
-        
-        # 金額を計算（数量×単価）
+        # 金額を計算（数量×単価、空欄は0、数値にできない値があれば0）
+        quantity_raw, unit_price_raw = cells[_COL_W][row], cells[_COL_AC][row]
         try:
             quantity_num = float(quantity_raw) if pd.notna(quantity_raw) else 0
             unit_price_num = float(unit_price_raw) if pd.notna(unit_price_raw) else 0
             amount_calculated = quantity_num * unit_price_num
         except (ValueError, TypeError):
             amount_calculated = 0
-        
-        item = {
+
+        # 備考（規格・備考欄・次の行の補足を空白区切りで連結）
+        remark_cells = [cells[col][next_row if is_next else row] for is_next, col in _REMARK_CELLS]
+        result.append({
             "order_id": denpyo_no,
             "order_date": order_date,
             "delivery_date": delivery_date,
             "partner_name": customer_name,
-            "product_code": str(df.iloc[row, 5]),  # F列（5列目）- 変更なし
-            "product_name": str(df.iloc[row, 7]),  # H列（7列目）- 変更なし
+            "product_code": str(code_cell),  # F列（5列目）
+            "product_name": str(cells[_COL_H][row]),  # H列（7列目）
             "size": "",  # 追加：三菱はサイズ空
             "quantity": str(quantity_raw),  # W列（23列目）
-            "unit": str(df.iloc[row, 27]),  # AA列（27列目）
+            "unit": str(cells[_COL_AA][row]),  # AA列（27列目）
             "unit_price": str(unit_price_raw),  # AC列（29列目）
             "amount": str(amount_calculated),  # 数量×単価の計算結果
-            "remark": " ".join(
-                str(cell) for cell in [
-                    df.iloc[row, 17],
-                    df.iloc[row, 55],
-                    df.iloc[next_row, 7],
-                    df.iloc[next_row, 13],
-                    df.iloc[next_row, 55],
-                    df.iloc[next_row, 65],
-                ]
-                if pd.notna(cell) and str(cell).strip() != ""
-            ).strip(),
+            "remark": " ".join(str(cell) for cell in remark_cells if _filled(cell)).strip(),
             "data_source": file_name
-        }
-        result.append(item)
+        })
 
     return result
@@ -1,76 +1,66 @@
-import openai
-import pdfplumber
-import io
 import json
 import os
-from PIL import Image
-import base64
+import logging
 from prompt_pdf import PDF_ORDER_SYSTEM_PROMPT
+import llm_cache
+import openai_client
+from image_prep import image_part, prep_signature
+from pdf_document import PdfDocument
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
 
 def extract_text_from_pdf(pdf_bytes):
     """
     PDFからテキストを抽出する
     """
     try:
-        with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-            text = ""
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-        return text
+        with PdfDocument(pdf_bytes) as doc:
+            return doc.text
     except Exception as e:
-        raise Exception(f"PDFテキスト抽出エラー: {e}")
+        raise Exception(f"PDFテキスト抽出エラー: {e}") from e
 
 def extract_images_from_pdf(pdf_bytes):
     """
-    PDFから画像を抽出する
+    PDFから画像を抽出し、Vision送信用に前処理する
     """
     try:
-        with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
-            images = []
-            for page_num, page in enumerate(pdf.pages):
-                # ページの画像を抽出
-                page_images = page.images
-                for img in page_images:
-                    # 画像データを取得
-                    img_data = img['stream'].get_data()
-                    # base64エンコード
-                    img_base64 = base64.b64encode(img_data).decode('utf-8')
-                    images.append({
-                        'page': page_num + 1,
-                        'data': img_base64,
-                        'format': 'png'  # デフォルト形式
-                    })
-        return images
+        with PdfDocument(pdf_bytes) as doc:
+            return doc.vision_images()
     except Exception as e:
-        raise Exception(f"PDF画像抽出エラー: {e}")
+        raise Exception(f"PDF画像抽出エラー: {e}") from e
 
 def analyze_handwritten_order_with_openai(pdf_bytes, filename):
     """
     OpenAI APIを使用して手書き注文書を解析する
     """
+    # 同じPDF（バイト列）の解析結果があればAPIを呼ばずに返す（ファイル名はキーに含めない）
+    prompt_ver = llm_cache.prompt_version(PDF_ORDER_SYSTEM_PROMPT)
+    cache_key = llm_cache.make_key("pdf", pdf_bytes, prompt_ver, "gpt-4o", extra=(prep_signature(),))
+    cached = llm_cache.get(cache_key, "pdf")
+    if cached is not None:
+        return cached
+
     # OpenAI APIキーを取得
     from config import get_openai_api_key
     try:
         api_key = get_openai_api_key()
         if not api_key:
-            raise Exception("OPENAI_API_KEYが設定されていません")
+            raise openai_client.MissingApiKeyError("OPENAI_API_KEYが設定されていません")
     except Exception as e:
         # より詳細なエラー情報を提供
         import os
         is_render = os.getenv('RENDER', False)
         if is_render:
-            raise Exception(f"本番環境でのAPIキー取得エラー: {e}. Render Secrets Filesの設定を確認してください。")
+            raise Exception(f"本番環境でのAPIキー取得エラー: {e}. Render Secrets Filesの設定を確認してください。") from e
         else:
-            raise Exception(f"ローカル環境でのAPIキー取得エラー: {e}. .envファイルの設定を確認してください。")
-    
-    client = openai.OpenAI(api_key=api_key)
+            raise Exception(f"ローカル環境でのAPIキー取得エラー: {e}. .envファイルの設定を確認してください。") from e
     
     try:
-        # PDFからテキストと画像を抽出
-        text_content = extract_text_from_pdf(pdf_bytes)
-        images = extract_images_from_pdf(pdf_bytes)
+        # PDFを1回だけ開いてテキストと画像を取得（ページ画像はプレビュー時のキャッシュを再利用）
+        with PdfDocument(pdf_bytes, filename) as doc:
+            text_content = doc.text
+            images = doc.vision_images()
         
         # OpenAI APIに送信するメッセージを構築
         messages = [
@@ -91,12 +81,17 @@ def analyze_handwritten_order_with_openai(pdf_bytes, filename):
                     "role": "user",
                     "content": [
                         {"type": "text", "text": f"ページ{img['page']}の画像"},
-                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img['data']}"}}
+                        image_part(img['prepared'])
                     ]
                 })
         
-        # OpenAI APIを呼び出し
-        response = client.chat.completions.create(
+        if images:
+            saved_bytes = sum(img['prepared']['saved_bytes'] for img in images)
+            saved_tokens = sum(img['prepared']['saved_tokens'] for img in images)
+            logger.info(f"[画像前処理] {filename}: {len(images)}枚 削減 {saved_bytes:,}バイト / 推定{saved_tokens}トークン")
+        
+        # OpenAI APIを呼び出し（共通クライアント・レート制限スケジューラ経由）
+        response = openai_client.chat_completion(
             model="gpt-4o",  # または "gpt-4-vision-preview" 画像対応版
             messages=messages,
             max_tokens=2000,
@@ -117,13 +112,14 @@ def analyze_handwritten_order_with_openai(pdf_bytes, filename):
             cleaned_content = cleaned_content.strip()
             
             parsed_data = json.loads(cleaned_content)
+            llm_cache.put(cache_key, "pdf", prompt_ver, "gpt-4o", parsed_data)
             return parsed_data
         except json.JSONDecodeError as e:
             # JSON解析に失敗した場合、テキストから情報を抽出
             return extract_fallback_data(text_content, filename)
             
     except Exception as e:
-        raise Exception(f"OpenAI API解析エラー: {e}")
+        raise Exception(f"OpenAI API解析エラー: {e}") from e
 
 def extract_fallback_data(text_content, filename):
     """
@@ -262,4 +258,4 @@ def parse_pdf_handwritten(pdf_bytes, filename):
         return records
         
     except Exception as e:
-        raise Exception(f"PDF解析エラー: {e}") 
\ No newline at end of file
+        raise Exception(f"PDF解析エラー: {e}") from e
\ No newline at end of file
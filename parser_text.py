@@ -0,0 +1,207 @@
+# parser_text.py
+import json
+import logging
+import llm_cache
+import openai_client
+from config import get_openai_api_key, get_text_local_min_confidence
+from parser_text_rules import parse_text_order_locally
+from prompt_text import get_text_order_prompt, get_text_order_batch_instruction
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+def _strip_json_fence(content):
+    """```json ... ``` で囲まれた応答からJSON本文を取り出す"""
+    content = content.strip()
+    if content.startswith("```json"):
+        content = content[7:]
+    if content.endswith("```"):
+        content = content[:-3]
+    return content.strip()
+
+def _finalize_text_order(parsed, customer_name, order_date, delivery_date_override=""):
+    """テキスト注文の解析結果に最低限の補正（発注日/納品日/取引先名）をかける"""
+    if not parsed.get("order_date"):
+        parsed["order_date"] = order_date
+    if delivery_date_override:
+        parsed["delivery_date"] = delivery_date_override
+    if not parsed.get("partner_name"):
+        parsed["partner_name"] = customer_name
+    return parsed
+
+def _text_order_cache_key(customer_name, message_text, order_date):
+    """テキスト注文解析のキャッシュキーとプロンプト版を返す"""
+    prompt_ver = llm_cache.prompt_version(get_text_order_prompt())
+    key = llm_cache.make_key("text", message_text, prompt_ver, "gpt-4o", order_date, extra=(customer_name,))
+    return key, prompt_ver
+
+def parse_text_order_with_openai(customer_name, message_text, order_date, delivery_date_override=""):
+    """
+    OpenAI APIを使用してテキスト注文を解析
+    """
+    # 同じ本文・顧客名・受信日の解析結果があればAPIを呼ばずに返す
+    cache_key, prompt_ver = _text_order_cache_key(customer_name, message_text, order_date)
+    cached = llm_cache.get(cache_key, "text")
+    if cached is not None:
+        return _finalize_text_order(cached, customer_name, order_date, delivery_date_override)
+
+    try:
+        api_key = get_openai_api_key()
+        if not api_key:
+            raise openai_client.MissingApiKeyError("OPENAI_API_KEYが設定されていません")
+        
+        system_prompt = get_text_order_prompt()
+        user_text = (
+            f"顧客名: {customer_name}\n"
+            f"受信日(基準日): {order_date}\n"
+            f"本文:\n{message_text}\n"
+            "上記を解析して構造化JSONで返してください。"
+        )
+
+        # 共通クライアント・レート制限スケジューラ経由で呼び出し
+        resp = openai_client.chat_completion(
+            model="gpt-4o",
+            messages=[{"role":"system","content":system_prompt},
+                      {"role":"user","content":user_text}],
+            max_tokens=2000,
+            temperature=0.1
+        )
+        parsed = json.loads(_strip_json_fence(resp.choices[0].message.content))
+        llm_cache.put(cache_key, "text", prompt_ver, "gpt-4o", parsed)
+
+        # 最低限の補正（発注日/納品日）
+        return _finalize_text_order(parsed, customer_name, order_date, delivery_date_override)
+    except Exception as e:
+        raise Exception(f"テキスト注文解析エラー: {e}") from e
+
+def parse_text_orders_packed(text_orders):
+    """
+    複数の短いテキスト注文を1回のOpenAI APIリクエストでまとめて解析
+    - 戻り値は {timestamp: 解析結果dict}（応答に含まれなかった注文はキーなし）
+    - システムプロンプトは1回分で済むため、短文SMSのコストと待ち時間を削減できる
+    """
+    # キャッシュ済みの注文はリクエストに含めない
+    results = {}
+    cache_keys = {}
+    misses = []
+    for t in text_orders:
+        cache_key, prompt_ver = _text_order_cache_key(t["customer_name"], t["message_text"], t["order_date"])
+        cached = llm_cache.get(cache_key, "text")
+        if cached is not None:
+            results[t["timestamp"]] = _finalize_text_order(
+                cached, t["customer_name"], t["order_date"], t.get("delivery_date_opt", ""))
+        else:
+            cache_keys[t["timestamp"]] = (cache_key, prompt_ver)
+            misses.append(t)
+    text_orders = misses
+    if not text_orders:
+        return results
+
+    if len(text_orders) == 1:
+        t = text_orders[0]
+        results[t["timestamp"]] = parse_text_order_with_openai(
+            t["customer_name"], t["message_text"], t["order_date"], t.get("delivery_date_opt", ""))
+        return results
+    try:
+        api_key = get_openai_api_key()
+        if not api_key:
+            raise openai_client.MissingApiKeyError("OPENAI_API_KEYが設定されていません")
+
+        system_prompt = get_text_order_prompt() + "\n\n" + get_text_order_batch_instruction()
+        sections = [
+            f"### 注文ID: {t['timestamp']}\n"
+            f"顧客名: {t['customer_name']}\n"
+            f"受信日(基準日): {t['order_date']}\n"
+            f"本文:\n{t['message_text']}\n"
+            for t in text_orders
+        ]
+        user_text = "\n".join(sections) + "\n上記の各注文を解析して、注文IDをキーとする構造化JSONで返してください。"
+
+        # 共通クライアント・レート制限スケジューラ経由で呼び出し
+        resp = openai_client.chat_completion(
+            model="gpt-4o",
+            messages=[{"role":"system","content":system_prompt},
+                      {"role":"user","content":user_text}],
+            max_tokens=min(8000, 2000 * len(text_orders)),
+            temperature=0.1,
+            response_format={"type": "json_object"}
+        )
+        packed = json.loads(_strip_json_fence(resp.choices[0].message.content))
+    except Exception as e:
+        raise Exception(f"テキスト注文一括解析エラー: {e}") from e
+
+    for t in text_orders:
+        parsed = packed.get(t["timestamp"])
+        if isinstance(parsed, dict):
+            cache_key, prompt_ver = cache_keys[t["timestamp"]]
+            llm_cache.put(cache_key, "text", prompt_ver, "gpt-4o", parsed)
+            results[t["timestamp"]] = _finalize_text_order(
+                parsed, t["customer_name"], t["order_date"], t.get("delivery_date_opt", ""))
+    return results
+
+def plan_text_order_requests(text_orders, pack_size, max_chars):
+    """
+    テキスト注文をAPIリクエスト単位に分割する
+    - max_chars 以下の短文は pack_size 件ずつ1リクエストにまとめる
+    - 長文は1件1リクエスト
+    """
+    short = [t for t in text_orders if pack_size > 1 and len(t["message_text"]) <= max_chars]
+    long_ = [t for t in text_orders if not (pack_size > 1 and len(t["message_text"]) <= max_chars)]
+    groups = [short[i:i + pack_size] for i in range(0, len(short), pack_size)]
+    groups += [[t] for t in long_]
+    return groups
+
+def parse_text_order_fast(t):
+    """
+    ルールベース解析の結果が十分な信頼度ならそれを返す（それ以外は None でLLM解析へ）
+    t: テキスト注文（customer_name / message_text / order_date / delivery_date_opt）
+    """
+    min_confidence = get_text_local_min_confidence()
+    if min_confidence > 1:
+        return None
+    try:
+        parsed, confidence = parse_text_order_locally(
+            t["customer_name"], t["message_text"], t["order_date"], t.get("delivery_date_opt", ""))
+    except Exception as e:
+        logger.warning(f"[ルール解析エラー] {e}")
+        return None
+    if parsed is None or confidence < min_confidence:
+        return None
+    logger.info(f"[ルール解析] {t.get('timestamp', '')} 信頼度={confidence:.2f} 商品数={len(parsed['items'])}")
+    return parsed
+
+def parse_text_order_group(group):
+    """
+    plan_text_order_requests の1グループを解析し [(注文, 解析結果 or 例外), ...] を返す
+    - 単純な注文はルールベース解析で済ませ、残りだけをLLMに送る
+    - まとめた応答から漏れた注文は1件ずつ解析し直す
+    """
+    outcomes = []
+    remaining = []
+    for t in group:
+        parsed = parse_text_order_fast(t)
+        if parsed is not None:
+            outcomes.append((t, parsed))
+        else:
+            remaining.append(t)
+    group = remaining
+    if not group:
+        return outcomes
+
+    try:
+        parsed_map = parse_text_orders_packed(group)
+    except Exception as e:
+        if len(group) == 1:
+            return outcomes + [(group[0], e)]
+        parsed_map = {}
+
+    for t in group:
+        if t["timestamp"] in parsed_map:
+            outcomes.append((t, parsed_map[t["timestamp"]]))
+            continue
+        try:
+            outcomes.append((t, parse_text_order_with_openai(
+                t["customer_name"], t["message_text"], t["order_date"], t.get("delivery_date_opt", ""))))
+        except Exception as e:
+            outcomes.append((t, e))
+    return outcomes
@@ -0,0 +1,278 @@
+# parser_text_rules.py
+# SMS/メール短文注文のルールベース解析（OpenAI APIを呼ばない高速経路）
+# prompt_text.py の解析ルールをそのまま手続きにしたもの
+# - §0  全角/半角・漢数字の正規化、改行は空白扱い
+# - §4  相対日付（明日/明後日/N日後/来週/曜日）は受信日基準。商品名に続く・数量が続く m/d は日付にしない（白菜1/2 等）
+# - §8y 左から右へのトークン解析（商品候補 → 数量で確定 → 価格形容詞は pending_mods で右側の商品へ）
+# - §9  「なし/ナシ + 数量」は梨、「袋なし」等の語尾接続は直近の商品の備考
+# 解析しきれない語が残った場合は信頼度を下げ、呼び出し側でLLM解析に回す
+import re
+import unicodedata
+from datetime import datetime, timedelta
+
+UNITS = ["ケース", "パック", "キロ", "グラム", "ボール", "kg", "g", "個", "玉", "束", "箱",
+         "袋", "本", "株", "枚", "房", "把", "缶", "ケ", "コ", "P", "p"]
+_UNIT_ALIASES = {"キロ": "kg", "グラム": "g", "ケ": "個", "コ": "個", "p": "パック", "P": "パック"}
+
+# 価格形容詞（活用形 → 高い/安い）と品質指定
+_PRICE_WORDS = [
+    (r"高すぎ|高級|割高|値上げ|高めで|高め|高く|高い", "高い"),
+    (r"安すぎ|安価|特価|割安|値下げ|安めで|安め|安く|安い", "安い"),
+]
+_QUALITY_WORDS = r"大きめ|小さめ|大きい|小さい|新鮮な|新鮮"
+
+# 挨拶・依頼など、注文内容に関係しない定型句
+_FILLERS = (r"いつもありがとうございます|ありがとうございます|お世話になっております|お世話になります|"
+            r"お疲れ様です|おつかれさまです|よろしくお願いいたします|よろしくお願い致します|よろしくお願いします|"
+            r"宜しくお願いします|お願いいたします|お願い致します|お願いします|おねがいします|お願い|"
+            r"よろしく|宜しく|ください|下さい|です")
+
+# 商品名ではなく指示・変更を表す語（含まれていればLLMに任せる）
+_COMPLEX_WORDS = ("キャンセル", "変更", "取り消し", "取消", "追加", "訂正", "やめ", "以外", "じゃなく",
+                  "前回", "いつもの", "同じ", "?")
+
+# 商品名として扱わない語（金額・合計の見出し）
+_NON_PRODUCT_WORDS = ("合計", "小計", "総計", "総数", "計", "円", "税込", "税抜")
+
+# ひらがな表記 → 標準和名
+_PRODUCT_ALIASES = {"なし": "梨", "ナシ": "梨", "無し": "梨", "かき": "柿", "うめ": "梅", "もも": "桃"}
+
+_KANJI_DIGITS = {"〇": 0, "零": 0, "一": 1, "二": 2, "三": 3, "四": 4, "五": 5,
+                 "六": 6, "七": 7, "八": 8, "九": 9}
+_KANJI_UNITS = {"十": 10, "百": 100, "千": 1000}
+
+_UNIT_RE = "|".join(sorted((re.escape(u) for u in UNITS), key=len, reverse=True))
+_WEEKDAYS = "月火水木金土日"
+_DATE_SUFFIX = r"(?:の|に|で|まで|納品|着|配達|お届け|分)*"
+_TOKEN_RES = [
+    ("space", re.compile(r"\s+")),
+    ("filler", re.compile(_FILLERS)),
+    ("date", re.compile(r"(?P<d>(?P<week>再来週|来週|今週)?(?P<wd>[" + _WEEKDAYS + r"])曜日?|"
+                        r"明後日|あさって|明日|あした|本日|今日|来週|(?P<after>\d+)日後|"
+                        # m/d は商品名に続く（白菜1/2）・数量が続く（1/2 3個）ときは分数なので日付にしない
+                        r"(?<![^\W\d_])(?P<md_m>\d{1,2})/(?P<md_d>\d{1,2})(?!\s*(?:\d|" + _UNIT_RE + r"))|"
+                        r"(?P<jm>\d{1,2})月(?P<jd>\d{1,2})日|"
+                        r"(?P<day>\d{1,2})日(?!後))" + _DATE_SUFFIX)),
+    ("size", re.compile(r"(?P<size>[2-5]?L|LL|[2-3]?S|M)(?:サイズ)?(?![A-Za-z])(?=\s*\d|サイズ)|"
+                        r"(?P<size2>[2-5]?L|LL|[2-3]?S|M)サイズ|"
+                        r"(?P<size3>[2-5]?L|LL|[2-3]?S|M)(?=[ぁ-んァ-ヶ一-龥])")),   # L玉ねぎ
+    ("yen", re.compile(r"@\s*(?P<at>\d+(?:\.\d+)?)(?:\s*円)?|(?P<yen>\d+(?:\.\d+)?)\s*円")),
+    ("quantity", re.compile(r"(?P<num>\d+(?:\.\d+)?)(?:\s*(?P<unit>" + _UNIT_RE + r")(?!なし|無し|抜き|不要))?")),
+    ("price", re.compile("|".join(p for p, _ in _PRICE_WORDS))),
+    ("quality", re.compile(_QUALITY_WORDS)),
+    ("pear", re.compile(r"(?:なし|ナシ|無し)(?=\s*\d)")),
+    ("negation", re.compile(r"[^\s\d]{1,6}?(?:なし|無し|抜き|不要)(?!\s*\d)")),
+]
+# 商品候補の終わり（数字・空白・他のトークンの始まり）
+_PRODUCT_STOP = re.compile(r"\s|\d|[@×*]|" + "|".join(p for p, _ in _PRICE_WORDS) + "|" + _QUALITY_WORDS + "|"
+                           + _FILLERS + r"|明後日|明日|本日|今日|(?:再来週|来週|今週)?[" + _WEEKDAYS + r"]曜|来週|"
+                           r"(?:なし|ナシ|無し)(?=\s*\d)")
+
+
+def _kanji_to_int(s: str) -> int:
+    """漢数字（〜九千九百九十九）を整数に変換"""
+    total, digit = 0, None
+    for ch in s:
+        if ch in _KANJI_DIGITS:
+            digit = _KANJI_DIGITS[ch] if digit is None else digit * 10 + _KANJI_DIGITS[ch]
+        else:
+            total += (digit if digit is not None else 1) * _KANJI_UNITS[ch]
+            digit = None
+    return total + (digit or 0)
+
+def normalize_text(text: str) -> str:
+    """全角/半角・漢数字・改行を正規化（§0）"""
+    text = unicodedata.normalize("NFKC", text or "")
+    # 単位や空白・文末が続く漢数字だけを算用数字にする（「九条ねぎ」などの商品名は変えない）
+    text = re.sub(r"[〇零一二三四五六七八九十百千]+(?=\s*(?:" + _UNIT_RE + r")|\s|$|[、。,.!])",
+                  lambda m: str(_kanji_to_int(m.group(0))), text)
+    return re.sub(r"[、。,!・]+", " ", text)
+
+
+def _parse_date(m, order_dt: datetime):
+    """日付トークンを受信日基準で YYYY/MM/DD にする（§4）"""
+    word = m.group("d")
+    if m.group("wd"):
+        # 曜日: 来週/再来週は翌週/翌々週（月曜始まり）のその曜日、今週は今週のその曜日、指定なしは次に来るその曜日
+        weekday = _WEEKDAYS.index(m.group("wd"))
+        week = m.group("week")
+        if week:
+            monday = order_dt - timedelta(days=order_dt.weekday())
+            dt = monday + timedelta(days=7 * {"今週": 0, "来週": 1, "再来週": 2}[week] + weekday)
+            if dt < order_dt:
+                return None  # 今週の過ぎた曜日
+        else:
+            dt = order_dt + timedelta(days=(weekday - order_dt.weekday()) % 7 or 7)
+    elif word in ("明日", "あした"):
+        dt = order_dt + timedelta(days=1)
+    elif word in ("明後日", "あさって"):
+        dt = order_dt + timedelta(days=2)
+    elif word in ("本日", "今日"):
+        dt = order_dt
+    elif word == "来週":
+        dt = order_dt + timedelta(days=7)
+    elif m.group("after"):
+        dt = order_dt + timedelta(days=int(m.group("after")))
+    else:
+        month = int(m.group("md_m") or m.group("jm") or order_dt.month)
+        day = int(m.group("md_d") or m.group("jd") or m.group("day"))
+        try:
+            dt = order_dt.replace(month=month, day=day)
+            if dt < order_dt:
+                # 受信日より前の日付は翌月（日のみ）/翌年（月日）とみなす
+                if m.group("day"):
+                    dt = (order_dt.replace(day=1) + timedelta(days=32)).replace(day=day)
+                else:
+                    dt = dt.replace(year=dt.year + 1)
+        except ValueError:
+            return None
+    return dt.strftime("%Y/%m/%d")
+
+def _tokenize(text: str):
+    """正規化済みテキストを (種類, 値, match) のトークン列に分割"""
+    pos = 0
+    while pos < len(text):
+        for kind, pattern in _TOKEN_RES:
+            m = pattern.match(text, pos)
+            if m and m.end() > pos:
+                if kind != "space":
+                    yield kind, m.group(0), m
+                pos = m.end()
+                break
+        else:
+            # 商品候補: 次の区切りまで
+            stop = _PRODUCT_STOP.search(text, pos + 1)
+            end = stop.start() if stop else len(text)
+            word = text[pos:end]
+            # 「袋なし」のような語尾接続の否定は商品ではなく備考
+            if re.match(r"(.+?(?:なし|無し|抜き|不要))$", word):
+                yield "negation", word, None
+            elif _is_product_name(word):
+                yield "product", word, None
+            else:
+                yield "unknown", word, None
+            pos = end
+
+def _is_product_name(word: str) -> bool:
+    """記号だけ・1文字・合計等の見出しは商品名にしない（「柿」等の1文字の商品はLLM解析に任せる）"""
+    if len(word) < 2 or word in _NON_PRODUCT_WORDS:
+        return False
+    return any(unicodedata.category(ch).startswith("L") for ch in word)
+
+def _normalize_price(word: str) -> str:
+    for pattern, norm in _PRICE_WORDS:
+        if re.fullmatch(pattern, word):
+            return norm
+    return word
+
+def _new_item(name: str) -> dict:
+    return {"product_name": _PRODUCT_ALIASES.get(name, name), "size": "", "quantity": "", "unit": "",
+            "product_code": "", "unit_price": "", "amount": "", "remark": ""}
+
+def _add_remark(item: dict, words):
+    item["remark"] = " ".join(w for w in [item["remark"], *words] if w)
+
+
+def parse_text_order_locally(customer_name: str, message_text: str, order_date: str,
+                             delivery_date_override: str = ""):
+    """
+    短文テキスト注文をルールで解析し (解析結果, 信頼度0〜1) を返す
+    解析結果はLLM解析と同じ形（order_id/order_date/delivery_date/partner_name/items）
+    """
+    try:
+        order_dt = datetime.strptime(order_date, "%Y/%m/%d")
+    except (TypeError, ValueError):
+        return None, 0.0
+
+    text = normalize_text(message_text)
+    items = []
+    current = None        # 数量待ちの商品候補
+    pending_mods = []     # 確定直後〜次の商品候補までの形容詞（右側の商品へ）
+    pending_size = ""
+    dates = set()
+    problems = 0
+
+    for kind, value, m in _tokenize(text):
+        if kind == "filler":
+            continue
+        if kind == "date":
+            d = _parse_date(m, order_dt)
+            if d:
+                dates.add(d)
+            else:
+                problems += 1
+        elif kind == "product" or kind == "pear":
+            if current is not None:
+                problems += 1  # 数量のない語（§10: 商品として扱わない）
+            current = _new_item("梨" if kind == "pear" else value)
+            _add_remark(current, pending_mods)
+            pending_mods = []
+            if pending_size:
+                current["size"], pending_size = pending_size, ""
+        elif kind == "unknown":
+            problems += 1  # 商品名にならない語
+        elif kind == "yen":
+            price = m.group("at") or m.group("yen")
+            target = current if current is not None else (items[-1] if items else None)
+            if target is None or target["unit_price"]:
+                problems += 1  # どの商品の単価か決められない
+            else:
+                target["unit_price"] = price
+        elif kind == "quantity":
+            if current is None:
+                problems += 1  # 商品のない数量
+                continue
+            current["quantity"] = m.group("num")
+            unit = m.group("unit") or ""
+            current["unit"] = _UNIT_ALIASES.get(unit, unit)
+            items.append(current)
+            current = None
+        elif kind in ("price", "quality"):
+            word = _normalize_price(value) if kind == "price" else value
+            if current is not None:
+                _add_remark(current, [word])  # 商品と数量の間 → その商品
+            else:
+                pending_mods.append(word)     # 文頭・数量の直後 → 右側の商品（§8x）
+        elif kind == "negation":
+            if items and current is None:
+                _add_remark(items[-1], [value])  # 〜なし は直近の商品
+            elif current is not None:
+                _add_remark(current, [value])
+            else:
+                pending_mods.append(value)
+        elif kind == "size":
+            size = m.group("size") or m.group("size2") or m.group("size3")
+            if current is not None:
+                current["size"] = size
+            else:
+                pending_size = size
+
+    if current is not None:
+        problems += 1
+    if pending_mods:
+        if items:
+            _add_remark(items[-1], pending_mods)  # 文末の形容詞は最後の商品
+        else:
+            problems += 1
+    if pending_size:
+        problems += 1
+
+    parsed = {
+        "order_id": "",
+        "order_date": order_date,
+        "delivery_date": delivery_date_override or (sorted(dates)[0] if dates else order_date),
+        "partner_name": customer_name,
+        "items": items,
+    }
+
+    # 信頼度: 解析できない語・矛盾があるほど下げる
+    if not items:
+        return parsed, 0.0
+    confidence = 1.0 - 0.4 * problems
+    if len(dates) > 1:
+        confidence -= 0.3
+    if any(len(it["product_name"]) > 12 for it in items):
+        confidence -= 0.3  # 文章を商品名として拾っている可能性
+    if any(w in text for w in _COMPLEX_WORDS):
+        confidence = min(confidence, 0.3)
+    return parsed, round(max(0.0, min(1.0, confidence)), 2)
@@ -0,0 +1,309 @@
+# pdf_document.py
+# アップロードされたPDFの読み込みを1か所にまとめる
+# - PDFは1回だけ開き、テキストと埋め込み画像は1回のページ走査で取得
+# - 埋め込み画像の生画素は色空間（ICCBased の /N・Indexed のパレット等）から成分数を決め、
+#   データ長が合わないもの・扱えない色空間のものは推測せず、そのページを描画した画像で代替する
+# - ページ画像（プレビュー・Vision送信用）は必要になった時点で描画し、
+#   APP_DATA_DIR/pdf_renders/<SHA-256>_<DPI>dpi/page<N>.png にキャッシュ
+# - 複数ページの描画はアプリ全体で1つの（上限付きの）プロセスプールで並列化
+#   （pdfiumはスレッドセーフではないため、プロセス内で描画するときはロックで1つずつ）
+import io
+import os
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import pdfplumber
+from pdfminer.pdftypes import resolve1, PDFStream
+from pdfminer.psparser import PSLiteral
+from PIL import Image
+from batch_runner import process_context
+from config import load_config, get_pdf_render_dpi
+from image_prep import prepare_image
+
+# ロガーの設定
+logger = logging.getLogger(__name__)
+
+CONFIG = load_config()
+RENDER_CACHE_DIR = Path(CONFIG.get("app_data_dir")) / "pdf_renders"
+RENDER_CACHE_MAX_AGE = 7 * 86400
+RENDER_MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+_DEVICE_COMPONENTS = {"DeviceGray": 1, "CalGray": 1, "G": 1, "DeviceRGB": 3, "CalRGB": 3, "RGB": 3,
+                      "DeviceCMYK": 4, "CMYK": 4}
+_MODES = {1: "L", 3: "RGB", 4: "CMYK"}
+
+_pdfium_lock = threading.Lock()      # プロセス内で描画するとき（pdfiumはスレッドセーフではない）
+_pool_lock = threading.Lock()
+_render_pool = None
+
+
+def _name(obj) -> str:
+    obj = resolve1(obj)
+    return obj.name if isinstance(obj, PSLiteral) else str(obj)
+
+def _color_space(obj):
+    """
+    色空間を (成分数, パレット) にする（パレットは Indexed のときの RGB / グレーのバイト列）
+    扱えない色空間は None
+    """
+    obj = resolve1(obj)
+    if isinstance(obj, list) and len(obj) == 1:
+        obj = resolve1(obj[0])
+    if isinstance(obj, PSLiteral):
+        n = _DEVICE_COMPONENTS.get(obj.name)
+        return (n, None) if n else None
+    if not isinstance(obj, list) or not obj:
+        return None
+    family = _name(obj[0])
+    if family in ("CalGray", "CalRGB"):
+        return _DEVICE_COMPONENTS[family], None
+    if family == "ICCBased":
+        profile = resolve1(obj[1])
+        n = int(resolve1(profile.get("N", 0))) if isinstance(profile, PDFStream) else 0
+        return (n, None) if n in _MODES else None
+    if family in ("Indexed", "I"):
+        base = _color_space(obj[1])
+        if base is None or base[1] is not None or base[0] not in (1, 3):
+            return None
+        hival = int(resolve1(obj[2]))
+        lookup = resolve1(obj[3])
+        palette = lookup.get_data() if isinstance(lookup, PDFStream) else lookup
+        if isinstance(palette, str):
+            palette = palette.encode("latin-1")
+        if not isinstance(palette, bytes) or len(palette) < (hival + 1) * base[0]:
+            return None
+        palette = palette[:(hival + 1) * base[0]]
+        if base[0] == 1:
+            palette = bytes(b for v in palette for b in (v, v, v))
+        return 1, palette
+    return None  # Lab / Separation / DeviceN / Pattern 等
+
+def _pdf_image_bytes(img):
+    """
+    pdfplumberの画像オブジェクトから画像ファイルのバイト列を得る
+    JPEG等はそのまま、Flate等で展開された生画素は幅・高さ・色空間からPNGに組み立てる
+    組み立てられない（色空間が扱えない・データ長が合わない）ときは None（呼び出し側でページを描画して代替）
+    """
+    stream = img['stream']
+    data = stream.get_data()
+    try:
+        Image.open(io.BytesIO(data)).verify()
+        return data
+    except Exception:
+        pass
+    width, height = int(resolve1(stream['Width'])), int(resolve1(stream['Height']))
+    bits = int(resolve1(stream.get('BitsPerComponent', 8)) or 8)
+    if resolve1(stream.get('ImageMask')) or resolve1(stream.get('Decode')) is not None:
+        return None  # マスク・反転指定は描画に任せる
+    space = _color_space(stream.get('ColorSpace'))
+    if space is None:
+        return None
+    components, palette = space
+    if palette is not None:
+        if bits not in (1, 2, 4, 8):
+            return None
+        mode, rawmode = "P", ("P" if bits == 8 else f"P;{bits}")
+    elif components == 1 and bits == 1:
+        mode, rawmode = "1", "1"
+    elif bits == 8:
+        mode = rawmode = _MODES[components]
+    else:
+        return None
+    # 1行はバイト境界までパディングされる（8ビットなら width*height*成分数）
+    expected = (width * components * bits + 7) // 8 * height
+    if len(data) != expected:
+        logger.info(f"[PDF画像] 画素データの長さが合わないためページ描画で代替: {len(data)} != {expected} "
+                    f"({width}x{height}, {components}成分, {bits}bit)")
+        return None
+    pil_image = Image.frombytes(mode, (width, height), data, "raw", rawmode)
+    if palette is not None:
+        pil_image.putpalette(palette)
+    out = io.BytesIO()
+    pil_image.convert("L" if mode in ("1", "L") else "RGB").save(out, format="PNG")
+    return out.getvalue()
+
+def _render_page_to_file(pdf_path: str, page_index: int, dpi: int, out_path: str) -> str:
+    """1ページを描画してPNGに保存（プロセスプールのワーカー、または呼び出し元のプロセスで実行）"""
+    with pdfplumber.open(pdf_path) as pdf:
+        image = pdf.pages[page_index].to_image(resolution=dpi).original
+    # 同じPDFを同時に描画しても一時ファイルがぶつからないようにする
+    tmp = f"{out_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    image.save(tmp, format="PNG")
+    os.replace(tmp, out_path)
+    return out_path
+
+def _get_render_pool():
+    """描画用のプロセスプール（アプリ全体で1つ。複数ファイルの同時解析からも共有する）"""
+    global _render_pool
+    with _pool_lock:
+        if _render_pool is None:
+            _render_pool = ProcessPoolExecutor(max_workers=RENDER_MAX_WORKERS, mp_context=process_context())
+        return _render_pool
+
+def _reset_render_pool():
+    global _render_pool
+    with _pool_lock:
+        if _render_pool is not None:
+            _render_pool.shutdown(wait=False, cancel_futures=True)
+            _render_pool = None
+
+def _render_in_process(pdf_path: str, pages, dpi: int, paths):
+    with _pdfium_lock:
+        for i in pages:
+            _render_page_to_file(pdf_path, i, dpi, str(paths[i]))
+
+def prune_render_cache(max_age: float = RENDER_CACHE_MAX_AGE):
+    """一定期間使われていないページ画像キャッシュを削除"""
+    if not RENDER_CACHE_DIR.exists():
+        return
+    limit = time.time() - max_age
+    for d in RENDER_CACHE_DIR.iterdir():
+        try:
+            if d.is_dir() and d.stat().st_mtime < limit:
+                shutil.rmtree(d, ignore_errors=True)
+        except OSError:
+            pass
+
+
+class PdfDocument:
+    """
+    1つのPDFに対するテキスト・埋め込み画像・ページ画像の取得口
+    with PdfDocument(pdf_bytes, filename) as doc:
+        doc.text / doc.embedded_images() / doc.page_images() / doc.vision_images()
+    """
+
+    def __init__(self, pdf_bytes: bytes, filename: str = "", dpi: int = None):
+        self.pdf_bytes = pdf_bytes
+        self.filename = filename
+        self.dpi = dpi or get_pdf_render_dpi()
+        self.sha256 = hashlib.sha256(pdf_bytes).hexdigest()
+        # 描画解像度もキャッシュのキーに含める（PDF_RENDER_DPI を変えたら描き直す）
+        self.cache_dir = RENDER_CACHE_DIR / f"{self.sha256}_{self.dpi}dpi"
+        self._pdf = None
+        self._text = None
+        self._embedded = None
+        self._unreadable_pages = set()   # 埋め込み画像を組み立てられなかったページ（0始まり）
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._pdf is not None:
+            self._pdf.close()
+            self._pdf = None
+
+    @property
+    def pdf(self):
+        """pdfplumberのドキュメント（最初のアクセス時に1回だけ開く）"""
+        if self._pdf is None:
+            self._pdf = pdfplumber.open(io.BytesIO(self.pdf_bytes))
+        return self._pdf
+
+    @property
+    def page_count(self) -> int:
+        return len(self.pdf.pages)
+
+    def _scan(self):
+        """全ページを1回走査してテキストと埋め込み画像を集める"""
+        texts, embedded = [], []
+        for page_num, page in enumerate(self.pdf.pages):
+            page_text = page.extract_text()
+            if page_text:
+                texts.append(page_text + "\n")
+            for img in page.images:
+                try:
+                    data = _pdf_image_bytes(img)
+                except Exception as e:
+                    logger.warning(f"[PDF画像] {self.filename} ページ{page_num + 1}の画像を読み取れません: {e}")
+                    data = None
+                if data is None:
+                    self._unreadable_pages.add(page_num)
+                else:
+                    embedded.append({'page': page_num + 1, 'data': data})
+        self._text = "".join(texts)
+        self._embedded = embedded
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._scan()
+        return self._text
+
+    def embedded_images(self) -> list:
+        """埋め込み画像 [{'page', 'data'(画像バイト列)}]"""
+        if self._embedded is None:
+            self._scan()
+        return self._embedded
+
+    def _render_path(self, page_index: int) -> Path:
+        return self.cache_dir / f"page{page_index + 1}.png"
+
+    def render_pages(self, page_indexes=None) -> list:
+        """
+        ページを描画してキャッシュファイルのパスを返す（page_indexes 省略時は全ページ、キャッシュ済みのページは描画しない）
+        未描画のページが複数あれば共有のプロセスプールで並列に描画する
+        """
+        indexes = list(range(self.page_count)) if page_indexes is None else sorted(page_indexes)
+        paths = {i: self._render_path(i) for i in indexes}
+        missing = [i for i in indexes if not paths[i].exists()]
+        if missing:
+            if not self.cache_dir.exists():
+                prune_render_cache()
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            source = self.cache_dir / "source.pdf"
+            if not source.exists():
+                tmp = self.cache_dir / f"source.pdf.{os.getpid()}.{threading.get_ident()}.tmp"
+                tmp.write_bytes(self.pdf_bytes)
+                os.replace(tmp, source)
+            started = time.perf_counter()
+            if len(missing) == 1 or RENDER_MAX_WORKERS <= 1:
+                _render_in_process(str(source), missing, self.dpi, paths)
+            else:
+                try:
+                    pool = _get_render_pool()
+                    list(pool.map(_render_page_to_file, [str(source)] * len(missing), missing,
+                                  [self.dpi] * len(missing), [str(paths[i]) for i in missing]))
+                except BrokenProcessPool as e:
+                    # ワーカーが落ちた場合はプールを作り直し、今回はこのプロセスで描画
+                    logger.warning(f"[PDF描画] プロセスプールが停止したためプロセス内で描画します: {e}")
+                    _reset_render_pool()
+                    _render_in_process(str(source), [i for i in missing if not paths[i].exists()], self.dpi, paths)
+            logger.info(f"[PDF描画] {self.filename} {len(missing)}ページ ({self.dpi}dpi) "
+                        f"{(time.perf_counter() - started) * 1000:.0f}ms")
+        else:
+            os.utime(self.cache_dir)  # 参照日時を更新（キャッシュ削除の対象から外す）
+        return [paths[i] for i in indexes]
+
+    def page_images(self) -> list:
+        """ページ画像 [{'page', 'image'(PIL Image)}]（画面プレビュー用）"""
+        images = []
+        for i, path in enumerate(self.render_pages()):
+            with Image.open(path) as im:
+                images.append({'page': i + 1, 'image': im.copy()})
+        return images
+
+    def vision_images(self) -> list:
+        """
+        Vision送信用に前処理した画像 [{'page', 'prepared'}]
+        埋め込み画像（スキャン画像）があればそれを、なければページ画像を使う
+        """
+        sources = self.embedded_images()
+        if not sources:
+            sources = [{'page': i + 1, 'data': p.read_bytes()} for i, p in enumerate(self.render_pages())]
+        elif self._unreadable_pages:
+            # 組み立てられなかった埋め込み画像のページは、描画したページ画像で代替
+            rendered = self.render_pages(self._unreadable_pages)
+            sources = sorted(
+                [src for src in sources if src['page'] - 1 not in self._unreadable_pages] +
+                [{'page': i + 1, 'data': p.read_bytes()} for i, p in zip(sorted(self._unreadable_pages), rendered)],
+                key=lambda src: src['page'])
+        return [{'page': s['page'], 'prepared': prepare_image(s['data'], label=f"{self.filename} page{s['page']}")}
+                for s in sources]
@@ -335,3 +335,17 @@ def get_text_order_prompt():
 出力：ぶどう remark="袋なし"
 
 テキストを注意深く分析し、上記の形式で正確なデータを抽出してください。"""
+
+
+
+def get_text_order_batch_instruction():
+    """
+    複数のSMS/メール注文を1リクエストにまとめて解析するときの追加指示を取得
+    """
+    return """## 複数注文の一括解析
+この入力には複数の独立した注文が含まれます。各注文は「### 注文ID: ...」の見出しで区切られています。
+- 注文ごとに、上記の解析ルールをそれぞれ独立に適用してください（注文をまたいで商品・形容詞・日付を結び付けない）
+- 受信日・顧客名は各注文の見出し直下に記載された値を使用してください
+- 出力は、注文IDをキー、上記の出力形式のJSONを値とする1つのJSONオブジェクトにしてください
+  例: {"20250801_090000_000000": {"order_id": "", "order_date": "...", "delivery_date": "...", "partner_name": "...", "items": [...]}}
+- すべての注文IDを必ずキーとして含めてください（説明文は不要です）"""
@@ -0,0 +1,8 @@
+# tests/conftest.py
+# テスト共通設定（リポジトリ直下のモジュールを import し、DBは一時ディレクトリに作る）
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("APP_DATA_DIR", tempfile.mkdtemp(prefix="agrilive-test-"))
@@ -0,0 +1,65 @@
+# tests/test_db.py
+# 注文明細の保存（名前をディメンション表のIDに置き換える処理）の回帰テスト
+import pandas as pd
+import db
+
+db.init_db()
+
+ROW = {"伝票番号": "1", "発注日": "2025/08/01", "納品日": "2025/08/02", "取引先名": "テスト商店",
+       "商品コード": "", "商品名": "トマト", "サイズ": "", "数量": "1", "単位": "個",
+       "単価": "100", "金額": "100", "備考": "", "データ元": "test"}
+
+
+def _save_and_load(rows, batch_id):
+    db.save_order_lines(pd.DataFrame(rows), batch_id, account_email="test@example.com", company="テスト")
+    return db.load_batch(batch_id).sort_values("伝票番号").reset_index(drop=True)
+
+
+def test_numeric_product_name_is_saved_as_text():
+    # 商品名が数値だけの行（Excel由来の 123 など）も保存できる
+    loaded = _save_and_load([{**ROW, "商品名": 123}], "test-numeric")
+    assert loaded["商品名"].tolist() == ["123"]
+
+
+def test_mixed_type_names_are_saved():
+    # 同じ列に数値と文字列が混在していても保存でき、数値と同じ文字列の名前は同じIDにまとまる
+    rows = [{**ROW, "伝票番号": "1", "商品名": 123, "取引先名": 5},
+            {**ROW, "伝票番号": "2", "商品名": "トマト", "取引先名": "テスト商店"},
+            {**ROW, "伝票番号": "3", "商品名": "123", "取引先名": None}]
+    loaded = _save_and_load(rows, "test-mixed")
+    assert loaded["商品名"].tolist() == ["123", "トマト", "123"]
+    assert loaded["取引先名"].tolist()[:2] == ["5", "テスト商店"]
+
+
+def test_pdf_job_result_is_claimed_once_per_account():
+    # 手書きPDFの解析結果は登録した画面に関係なく、同じアカウントで1回だけ取り込まれる
+    job_id = db.enqueue_job("pdf", "claim-test", "owner@example.com", {"filename": "a.pdf", "sha256": "claim-test"})
+    leased = db.lease_jobs("test-worker", 10, 60)
+    assert job_id in [job["id"] for job in leased]
+    assert db.complete_job(job_id, "test-worker", [{"product_name": "トマト"}])
+    assert db.claim_job_results("other@example.com", "pdf") == []
+    claimed = db.claim_job_results("owner@example.com", "pdf")
+    assert [(job["id"], job["result"]) for job in claimed] == [(job_id, [{"product_name": "トマト"}])]
+    assert db.claim_job_results("owner@example.com", "pdf") == []
+
+
+def test_org_summary_period_excludes_undated_rows():
+    # 発注日のない行は、期間の片側だけを指定したときも集計に含めない（従来の order_date <= ? と同じ）
+    rows = [{**ROW, "伝票番号": "1", "発注日": "2025/08/01", "金額": "100"},
+            {**ROW, "伝票番号": "2", "発注日": "", "金額": "999"}]
+    db.save_order_lines(pd.DataFrame(rows), "test-summary", account_email="summary@example.com", company="集計テスト")
+    for day_from, day_to in [(None, 20250831), (20250101, None), (20250101, 20250831)]:
+        df_acc, _, _ = db.get_org_summary("集計テスト", "order", day_from, day_to)
+        assert (df_acc["行数"].sum(), df_acc["金額合計"].sum()) == (1, 100)
+    df_acc, _, _ = db.get_org_summary("集計テスト", "order")
+    assert (df_acc["行数"].sum(), df_acc["金額合計"].sum()) == (2, 1099)
+
+
+def test_saved_rows_are_searchable():
+    # 保存した明細は全文検索索引にまとめて登録され、削除すると索引からも消える
+    rows = [{**ROW, "伝票番号": str(i), "商品名": f"検索テスト用キャベツ{i}"} for i in range(3)]
+    db.save_order_lines(pd.DataFrame(rows), "test-search", account_email="search@example.com", company="テスト")
+    assert db.count_history("search@example.com", {"search": "検索テスト用キャベツ1"})["rows"] == 1
+    assert db.count_history("search@example.com", {"search": "検索テスト用"})["rows"] == 3
+    db.delete_batch("test-search")
+    assert db.count_history("search@example.com", {"search": "検索テスト用"})["rows"] == 0
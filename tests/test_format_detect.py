@@ -0,0 +1,43 @@
+# tests/test_format_detect.py
+# エンコーディング判定の回帰テスト
+import io
+from pathlib import Path
+from format_detect import SNIFF_BYTES, detect_upload, sniff_file_encoding
+from parser_infomart import parse_infomart
+
+ROOT = Path(__file__).resolve().parent.parent
+ASCII_HEAD = b"code,name,qty\r\n" * (SNIFF_BYTES // 15 + 100)
+
+
+def test_utf8_after_ascii_head_is_utf8():
+    # 先頭64KBがASCIIだけでも、後ろの日本語がUTF-8なら utf-8 と判定する
+    enc, _, sniffed = sniff_file_encoding(io.BytesIO(ASCII_HEAD + "1,トマト,3\r\n".encode("utf-8")))
+    assert enc == "utf-8"
+    assert sniffed > SNIFF_BYTES
+
+
+def test_cp932_after_ascii_head_is_cp932():
+    enc, _, _ = sniff_file_encoding(io.BytesIO(ASCII_HEAD + "1,トマト,3\r\n".encode("cp932")))
+    assert enc == "cp932"
+
+
+def test_ascii_only_file_is_cp932():
+    assert sniff_file_encoding(io.BytesIO(ASCII_HEAD))[:2] == ("cp932", 0.5)
+
+
+def test_infomart_keeps_shift_jis_characters():
+    # cp932 と判定されても、Shift_JISで読めるファイルは従来どおりの文字（U+2212 の「−」）で読む
+    content = (ROOT / "インフォマート.csv").read_bytes()
+    det = detect_upload(content, "インフォマート.csv")
+    assert (det.format, det.encoding) == ("infomart", "cp932")
+    names = [r["product_name"] for r in parse_infomart(det.source, "インフォマート.csv", encoding=det.encoding)]
+    assert "赤アンディ−ブ" in names
+    assert names == [r["product_name"] for r in parse_infomart(io.BytesIO(content), "インフォマート.csv")]
+
+
+def test_infomart_with_cp932_only_characters_is_read_as_cp932():
+    # NEC特殊文字（①）のようにShift_JISでは読めないファイルは cp932 で読む
+    content = (ROOT / "インフォマート.csv").read_bytes().replace("赤アンディ−ブ".encode("shift_jis"),
+                                                                   "①アンディ".encode("cp932"), 1)
+    names = [r["product_name"] for r in parse_infomart(io.BytesIO(content), "インフォマート.csv")]
+    assert "①アンディ" in names
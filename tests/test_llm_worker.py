@@ -0,0 +1,35 @@
+# tests/test_llm_worker.py
+# 解析ジョブの失敗を再試行するかどうかの判定
+import httpx
+import openai
+from llm_worker import _is_permanent
+from openai_client import MissingApiKeyError
+
+_REQUEST = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def _wrapped(error):
+    # パーサーと同じく Exception で包み直した例外を作る
+    try:
+        try:
+            raise error
+        except Exception as e:
+            raise Exception(f"PDF解析エラー: {e}") from e
+    except Exception as wrapped:
+        return wrapped
+
+
+def _api_error(cls, status):
+    return cls("error", response=httpx.Response(status, request=_REQUEST), body=None)
+
+
+def test_wrapped_client_errors_are_permanent():
+    assert _is_permanent(_wrapped(_api_error(openai.AuthenticationError, 401)))
+    assert _is_permanent(_wrapped(_api_error(openai.PermissionDeniedError, 403)))
+    assert _is_permanent(_wrapped(_api_error(openai.BadRequestError, 400)))
+    assert _is_permanent(_wrapped(MissingApiKeyError("OPENAI_API_KEYが設定されていません")))
+
+
+def test_wrapped_transient_errors_are_retried():
+    assert not _is_permanent(_wrapped(_api_error(openai.RateLimitError, 429)))
+    assert not _is_permanent(Exception("JSON解析エラー"))
@@ -0,0 +1,85 @@
+# tests/test_parser_text_rules.py
+# ルールベース解析の誤読（高い信頼度のままLLMを通らずに保存される）の回帰テスト
+import pytest
+from config import get_text_local_min_confidence
+from parser_text_rules import parse_text_order_locally
+
+ORDER_DATE = "2025/08/27"   # 水曜日
+THRESHOLD = get_text_local_min_confidence()
+
+
+def _parse(text, order_date=ORDER_DATE):
+    parsed, confidence = parse_text_order_locally("テスト商店", text, order_date)
+    items = [(it["product_name"], it["size"], it["quantity"], it["unit"], it["unit_price"]) for it in parsed["items"]]
+    return parsed, items, confidence
+
+
+@pytest.mark.parametrize("order_date", ["2025/08/27", "2025/08/31"])
+def test_fraction_glued_to_product_is_not_a_date(order_date):
+    # 「白菜1/2」は1/2カット（1月2日ではない）→ LLM解析に回す
+    parsed, _, confidence = _parse("白菜1/2 3個", order_date)
+    assert parsed["delivery_date"] == order_date
+    assert confidence < THRESHOLD
+
+def test_fraction_followed_by_quantity_is_not_a_date():
+    parsed, _, confidence = _parse("白菜 1/2 3個")
+    assert parsed["delivery_date"] == ORDER_DATE
+    assert confidence < THRESHOLD
+
+def test_standalone_month_day_is_still_a_date():
+    parsed, items, confidence = _parse("キャベツ3個 8/30納品")
+    assert parsed["delivery_date"] == "2025/08/30"
+    assert items == [("キャベツ", "", "3", "個", "")]
+    assert confidence == 1.0
+
+def test_at_price_is_unit_price():
+    _, items, confidence = _parse("大根 2本 @150")
+    assert items == [("大根", "", "2", "本", "150")]
+    assert confidence >= THRESHOLD
+
+def test_yen_is_price_not_quantity():
+    _, items, confidence = _parse("トマト 1000円 3個")
+    assert items == [("トマト", "", "3", "個", "1000")]
+    assert confidence >= THRESHOLD
+
+def test_multiplier_symbol_is_not_a_product():
+    _, items, confidence = _parse("トマト3個、きゅうり2本 ×2")
+    assert [name for name, *_ in items] == ["トマト", "きゅうり"]
+    assert confidence < THRESHOLD
+
+def test_total_is_not_a_product():
+    _, items, confidence = _parse("ネギ3束 合計5束")
+    assert [name for name, *_ in items] == ["ネギ"]
+    assert confidence < THRESHOLD
+
+def test_single_character_product_goes_to_llm():
+    _, _, confidence = _parse("柿3個")
+    assert confidence < THRESHOLD
+
+def test_size_prefix_is_extracted():
+    _, items, confidence = _parse("L玉ねぎ 2箱")
+    assert items == [("玉ねぎ", "L", "2", "箱", "")]
+    assert confidence >= THRESHOLD
+
+@pytest.mark.parametrize("text, expected", [
+    ("来週月曜 キャベツ3個", "2025/09/01"),    # 翌週の月曜（+7日の水曜ではない）
+    ("月曜 キャベツ3個", "2025/09/01"),        # 次に来る月曜
+    ("金曜日 キャベツ3個", "2025/08/29"),
+    ("今週金曜 キャベツ3個", "2025/08/29"),
+    ("再来週火曜 キャベツ3個", "2025/09/09"),
+    ("水曜 キャベツ3個", "2025/09/03"),        # 受信日と同じ曜日は翌週
+])
+def test_weekday_delivery_date(text, expected):
+    parsed, _, confidence = _parse(text)
+    assert parsed["delivery_date"] == expected
+    assert confidence >= THRESHOLD
+
+def test_past_weekday_this_week_goes_to_llm():
+    _, _, confidence = _parse("今週月曜 キャベツ3個")
+    assert confidence < THRESHOLD
+
+def test_plain_order_keeps_full_confidence():
+    parsed, items, confidence = _parse("明日 トマト3個 きゅうり2本")
+    assert parsed["delivery_date"] == "2025/08/28"
+    assert items == [("トマト", "", "3", "個", ""), ("きゅうり", "", "2", "本", "")]
+    assert confidence == 1.0